@@ -4,6 +4,6 @@
 scripts/build_server.sh
 
 # NB: 'preview should not be mandatory, I guess it's we use a pre-installed not up-to-date gcloud command line on travis, we should clean that
-gcloud preview app deploy src/server/app.yaml --stop-previous-version --quiet
+gcloud preview app deploy src/server/app.yaml src/server/index.yaml --stop-previous-version --quiet
 
 scripts/clean_server_build.sh
\ No newline at end of file
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+def _unit_weight(_):
+    return 1
+
+
+class LruTtlCache(object):  # pylint: disable=too-many-instance-attributes
+    """
+    In-process cache with a max size (least recently used entries are evicted first) and a time to live
+    (an entry older than ttl_seconds is never returned). It is thread safe, so it can be shared by server threads.
+    NB: None is used to signal a missing entry, so None values should not be cached.
+    """
+
+    def __init__(self, max_size, ttl_seconds, clock=time.time, weigher=_unit_weight):
+        """
+        :param max_size: max total weight of the entries kept in the cache (max number of entries with default weigher)
+        :param ttl_seconds: number of seconds an entry is valid after it has been put in the cache
+        :param clock: function returning the current time in seconds, injected for tests
+        :param weigher: function returning the weight of a value (e.g. its approximate size in bytes)
+        """
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._weigher = weigher
+        # key -> (expiration_time, value, weight), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._total_weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: value cached for key, or None if there is no entry or if it has expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    self._total_weight -= entry[2]
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # re-insertion makes it the most recently used entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        weight = self._weigher(value)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (self._clock() + self._ttl_seconds, value, weight)
+            self._total_weight += weight
+            while self._total_weight > self._max_size:
+                _, (_, _, evicted_weight) = self._entries.popitem(last=False)
+                self._total_weight -= evicted_weight
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_weight = 0
+
+    def weight(self):
+        """
+        :return: total weight of the entries in the cache, expired entries included until they are accessed or evicted
+        """
+        return self._total_weight
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_weight -= entry[2]
+
+    def __len__(self):
+        return len(self._entries)
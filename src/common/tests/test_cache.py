@@ -0,0 +1,99 @@
+import unittest
+from common.cache import LruTtlCache
+
+
+class ClockMock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LruTtlCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = ClockMock()
+
+    def test_get_return_put_value_and_count_hits_and_misses(self):
+        cache = LruTtlCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        self.assertIsNone(cache.get('k1'))
+        cache.put('k1', 'v1')
+        self.assertEquals('v1', cache.get('k1'))
+        self.assertEquals('v1', cache.get('k1'))
+        self.assertEquals(2, cache.hits)
+        self.assertEquals(1, cache.misses)
+
+    def test_expired_entry_is_not_returned(self):
+        cache = LruTtlCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        cache.put('k1', 'v1')
+        self.clock.now = 9.9
+        self.assertEquals('v1', cache.get('k1'))
+        self.clock.now = 10.0
+        self.assertIsNone(cache.get('k1'))
+        self.assertEquals(0, len(cache))
+
+    def test_put_existing_key_reset_value_and_ttl(self):
+        cache = LruTtlCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        cache.put('k1', 'v1')
+        self.clock.now = 5.0
+        cache.put('k1', 'v2')
+        self.clock.now = 12.0
+        self.assertEquals('v2', cache.get('k1'))
+        self.assertEquals(1, len(cache))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LruTtlCache(max_size=2, ttl_seconds=10, clock=self.clock)
+        cache.put('k1', 'v1')
+        cache.put('k2', 'v2')
+        cache.get('k1')  # k2 becomes the least recently used
+        cache.put('k3', 'v3')
+        self.assertEquals(2, len(cache))
+        self.assertEquals('v1', cache.get('k1'))
+        self.assertIsNone(cache.get('k2'))
+        self.assertEquals('v3', cache.get('k3'))
+
+    def test_invalidate_and_clear(self):
+        cache = LruTtlCache(max_size=3, ttl_seconds=10, clock=self.clock)
+        cache.put('k1', 'v1')
+        cache.put('k2', 'v2')
+        cache.put('k3', 'v3')
+        cache.invalidate('k1')
+        cache.invalidate('unknown_key')
+        self.assertIsNone(cache.get('k1'))
+        self.assertEquals('v2', cache.get('k2'))
+        cache.clear()
+        self.assertEquals(0, len(cache))
+        self.assertIsNone(cache.get('k3'))
+
+    def test_weigher_evicts_least_recently_used_entries_above_max_size(self):
+        cache = LruTtlCache(max_size=10, ttl_seconds=10, clock=self.clock, weigher=len)
+        cache.put('k1', 'abcd')
+        cache.put('k2', 'abcd')
+        cache.put('k1', 'abc')  # k1 is updated and becomes the most recently used
+        self.assertEquals(7, cache.weight())
+        cache.put('k3', 'abcde')  # k2 is evicted
+        self.assertEquals(8, cache.weight())
+        self.assertIsNone(cache.get('k2'))
+        self.assertEquals('abc', cache.get('k1'))
+        cache.put('k4', 'abcdefghijk')  # heavier than max_size, so all entries are evicted
+        self.assertEquals(0, len(cache))
+        self.assertEquals(0, cache.weight())
+
+    def test_weight_is_updated_by_expiration_invalidate_and_clear(self):
+        cache = LruTtlCache(max_size=10, ttl_seconds=10, clock=self.clock, weigher=len)
+        cache.put('k1', 'ab')
+        cache.put('k2', 'abc')
+        cache.invalidate('k1')
+        self.assertEquals(3, cache.weight())
+        self.clock.now = 10.0
+        cache.get('k2')
+        self.assertEquals(0, cache.weight())
+        cache.put('k3', 'abc')
+        cache.clear()
+        self.assertEquals(0, cache.weight())
+
+
+if __name__ == '__main__':
+    unittest.main()
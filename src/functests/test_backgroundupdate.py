@@ -3,11 +3,12 @@
 
 import unittest
 import os
+import tempfile
 import subprocess32 as subprocess
 from common.environment import IS_DEV_ENV, IS_COVERAGE
 from userdocmatch.dal import Dal
 from userdocmatch.frontendstructs import FeatureSet, TopicModelDescription
-from userdocmatch.structinit import UserCreator
+from userdocmatch.structinit import UserCreator, ProfileInitializerCache
 
 
 class BackgroundUpdateTests(unittest.TestCase):
@@ -30,7 +31,8 @@ class BackgroundUpdateTests(unittest.TestCase):
         nb_docs = str(9)
 
         interests = [' w' + str(i) for i in range(200)]  # choose 200 of the 500 words used in topic model description
-        user = UserCreator().create_user_in_db(user_name, interests, self.dal)
+        user_creator = UserCreator(ProfileInitializerCache(artifacts_dir=tempfile.mkdtemp(), ref_check_seconds=0))
+        user = user_creator.create_user_in_db(user_name, interests, self.dal)
 
         directory = os.path.dirname(os.path.abspath(__file__))
         root_dir = directory + '/../..'
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Time decay kernels of the UserProfiler: the relevance of an action (or of a previous profile) is multiplied by the
+discount factor between its date and the date of the profile computation.
+All kernels expose discount_factors(start_dates, end_date) and verify factor(d1, d2) * factor(d2, d3) = factor(d1, d3),
+required by the profiler to update a profile from its previous value instead of recomputing all the actions.
+Factors of the most frequent offsets are precomputed in a table, so a factor is an array lookup.
+"""
+
+import numpy as np
+
+
+class ExponentialDecay(object):
+    """
+    e**(-rt), with t the duration in years (counted in full days)
+    """
+
+    def __init__(self, annual_rate=1.0, nb_cached_days=3653):
+        """
+        :param annual_rate: r, decay rate by year
+        :param nb_cached_days: factors of offsets in [0, nb_cached_days) days are precomputed
+        """
+        self._annual_rate = annual_rate
+        self._factors_table = self._compute_factors(np.arange(nb_cached_days))
+
+    def discount_factors(self, start_dates, end_date):
+        """
+        :param start_dates: list of datetime
+        :param end_date: datetime
+        :return: numpy array of float, discount factor from each start date to end_date
+        """
+        day_offsets = np.array([(end_date - start_date).days for start_date in start_dates], dtype=np.int64)
+        return _lookup(self._factors_table, day_offsets, self._compute_factors)
+
+    def _compute_factors(self, day_offsets):
+        return np.exp(-self._annual_rate * (day_offsets / 365.25))
+
+
+class StepwiseHalfLifeDecay(object):
+    """
+    Factor is halved at each start of a period of half_life_days days. Periods are aligned on a fixed origin (and not
+    on the start date), otherwise a profile updated more often than half_life_days would never be discounted.
+    """
+
+    def __init__(self, half_life_days=180, nb_cached_steps=64):
+        """
+        :param half_life_days: duration of a period, in days
+        :param nb_cached_steps: factors of [0, nb_cached_steps) period starts are precomputed
+        """
+        self._half_life_days = half_life_days
+        self._factors_table = self._compute_factors(np.arange(nb_cached_steps))
+
+    def discount_factors(self, start_dates, end_date):
+        """
+        :param start_dates: list of datetime
+        :param end_date: datetime
+        :return: numpy array of float, discount factor from each start date to end_date
+        """
+        start_periods = np.array([start_date.toordinal() for start_date in start_dates], dtype=np.int64) // \
+            self._half_life_days
+        nb_steps = end_date.toordinal() // self._half_life_days - start_periods
+        return _lookup(self._factors_table, nb_steps, self._compute_factors)
+
+    @staticmethod
+    def _compute_factors(nb_steps):
+        return 0.5 ** nb_steps.astype(np.float64)
+
+
+def _lookup(factors_table, offsets, compute_factors):
+    """
+    :return: numpy array of factors of offsets, read in factors_table when offset is in table, else computed
+    """
+    in_table = (offsets >= 0) & (offsets < len(factors_table))
+    if in_table.all():
+        return factors_table[offsets]
+    factors = np.empty(len(offsets))
+    factors[in_table] = factors_table[offsets[in_table]]
+    factors[~in_table] = compute_factors(offsets[~in_table])
+    return factors
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Indexes to search the most similar vectors (cosine similarity) of a query vector among a fixed set of vectors.
+All indexes expose the same interface so they can be used interchangeably:
+    -candidates(query_matrix): for each query vector, indexes of the vectors that may be the most similar to it
+    -query(vector, nb_neighbours): indexes and similarities of the nb_neighbours most similar vectors
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags, issparse
+
+
+def normalize_rows(matrix):
+    """
+    :param matrix: numpy array or scipy.sparse matrix of dimension (n vectors, p features)
+    :return: float32 matrix of the same kind (C-contiguous numpy array or csr_matrix), each row is scaled to a L2 norm
+    of 1, zero rows are kept as is
+    """
+    if issparse(matrix):
+        matrix = csr_matrix(matrix, dtype=np.float32)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return csr_matrix(diags(1.0 / norms).dot(matrix), dtype=np.float32)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms[:, np.newaxis], dtype=np.float32)
+
+
+class BruteForceCosineIndex(object):
+    """
+    Exact index, all the vectors are candidates. It is the best choice up to a few thousands of vectors.
+    """
+
+    def __init__(self, matrix):
+        """
+        :param matrix: numpy array or scipy.sparse matrix of dimension (n vectors, p features)
+        """
+        self._normalized_matrix = normalize_rows(matrix)
+
+    def candidates(self, query_matrix):
+        """
+        :param query_matrix: numpy array or scipy.sparse matrix of dimension (m queries, p features)
+        :return: list of size m, each element is a numpy array of the indexes of the candidate vectors for this query
+        """
+        all_indexes = np.arange(self._normalized_matrix.shape[0])
+        return [all_indexes] * query_matrix.shape[0]
+
+    def query(self, vector, nb_neighbours):
+        """
+        :param vector: dense vector of size p features
+        :param nb_neighbours: max number of vectors returned
+        :return: tuple (indexes, similarities) of numpy arrays of the most similar vectors, by decreasing similarity
+        """
+        similarities = _similarities(self._normalized_matrix, vector)
+        return _top_k(np.arange(len(similarities)), similarities, nb_neighbours)
+
+
+class RandomProjectionCosineIndex(object):
+    """
+    Approximate index by locality-sensitive hashing with random hyperplanes: the smaller the angle between two vectors,
+    the higher the probability they are on the same side of a random hyperplane. In each table, vectors on the same side
+    of all the nb_bits hyperplanes of the table share a bucket, and the candidates of a query are the union of its buckets
+    in all the tables. More bits makes smaller buckets (faster queries), more tables increases the recall.
+    NB: on sparse positive vectors like topic classifications, the top neighbours of a vector are often weakly similar
+    to it, and the recall is low unless most vectors are candidates: TopFeaturesCosineIndex is a better fit for them.
+    """
+
+    def __init__(self, matrix, nb_tables=8, nb_bits=8, seed=0):
+        """
+        :param matrix: numpy array or scipy.sparse matrix of dimension (n vectors, p features)
+        :param nb_tables: number of hash tables
+        :param nb_bits: number of hyperplanes by table, buckets hold n / 2**nb_bits vectors on average
+        :param seed: seed of the random hyperplanes, so an index is reproducible
+        """
+        self._normalized_matrix = normalize_rows(matrix)
+        self._nb_tables = nb_tables
+        self._nb_bits = nb_bits
+        random_state = np.random.RandomState(seed)
+        # hyperplanes of all the tables are stacked to hash all the tables with a single matrix product
+        self._hyperplanes = random_state.randn(matrix.shape[1], nb_tables * nb_bits).astype(np.float32)
+        self._tables = [_build_buckets(codes) for codes in self._hash(self._normalized_matrix).T]
+
+    def candidates(self, query_matrix):
+        """
+        :param query_matrix: numpy array or scipy.sparse matrix of dimension (m queries, p features)
+        :return: list of size m, each element is a numpy array of the indexes of the candidate vectors for this query
+        """
+        empty_bucket = np.zeros(0, dtype=np.intp)
+        return [np.unique(np.concatenate([table.get(code, empty_bucket) for table, code in zip(self._tables, codes)]))
+                for codes in self._hash(query_matrix)]
+
+    def query(self, vector, nb_neighbours):
+        """
+        :param vector: dense vector of size p features
+        :param nb_neighbours: max number of vectors returned, less vectors are returned if there are not enough candidates
+        :return: tuple (indexes, similarities) of numpy arrays of the most similar vectors, by decreasing similarity
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        candidates = self.candidates(vector[np.newaxis, :])[0]
+        similarities = _similarities(self._normalized_matrix[candidates], vector)
+        return _top_k(candidates, similarities, nb_neighbours)
+
+    def _hash(self, matrix):
+        """
+        :return: numpy array of dimension (n vectors, nb_tables), the bucket code of each vector in each table
+        """
+        sides = np.asarray(matrix.dot(self._hyperplanes)) > 0
+        bit_values = 1 << np.arange(self._nb_bits)
+        return np.dot(sides.reshape(-1, self._nb_tables, self._nb_bits), bit_values)
+
+
+class TopFeaturesCosineIndex(object):
+    """
+    Approximate index by inverted lists on features (partitions of the topic space): each vector is listed under its
+    nb_index_features greatest features, and the candidates of a query are the vectors listed under its
+    nb_query_features greatest features. Cosine similarity of sparse positive vectors, like topic classifications, comes
+    from the main features they share, so it has a good recall for them (cf. test_nearestneighbours recall test, with
+    default parameters), and a query only scores the vectors sharing its main features.
+    """
+
+    def __init__(self, matrix, nb_index_features=32, nb_query_features=8):
+        """
+        :param matrix: numpy array or scipy.sparse matrix of dimension (n vectors, p features)
+        :param nb_index_features: number of greatest features of a vector under which it is listed
+        :param nb_query_features: number of greatest features of a query whose lists are candidates
+        """
+        self._normalized_matrix = normalize_rows(matrix)
+        self._nb_query_features = nb_query_features
+        vector_indexes, features = _top_features(self._normalized_matrix, nb_index_features)
+        self._feature_lists = {feature: vector_indexes[bucket] for feature, bucket in _build_buckets(features).items()}
+
+    def candidates(self, query_matrix):
+        """
+        :param query_matrix: numpy array or scipy.sparse matrix of dimension (m queries, p features)
+        :return: list of size m, each element is a numpy array of the indexes of the candidate vectors for this query
+        """
+        query_indexes, features = _top_features(query_matrix, self._nb_query_features)
+        candidates = [[] for _ in range(query_matrix.shape[0])]
+        for query_index, feature in zip(query_indexes, features):
+            if feature in self._feature_lists:
+                candidates[query_index].append(self._feature_lists[feature])
+        return [np.unique(np.concatenate(lists)) if lists else np.zeros(0, dtype=np.intp) for lists in candidates]
+
+    def query(self, vector, nb_neighbours):
+        """
+        :param vector: dense vector of size p features
+        :param nb_neighbours: max number of vectors returned, less vectors are returned if there are not enough candidates
+        :return: tuple (indexes, similarities) of numpy arrays of the most similar vectors, by decreasing similarity
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        candidates = self.candidates(vector[np.newaxis, :])[0]
+        similarities = _similarities(self._normalized_matrix[candidates], vector)
+        return _top_k(candidates, similarities, nb_neighbours)
+
+
+def _top_features(matrix, nb_features):
+    """
+    :return: tuple (vector indexes, feature indexes) of numpy arrays, the non zero features among the nb_features
+    greatest (absolute value) of each vector
+    """
+    if issparse(matrix):
+        matrix = csr_matrix(matrix)
+        vector_indexes, features = [], []
+        for index in range(matrix.shape[0]):
+            row_data = matrix.data[matrix.indptr[index]:matrix.indptr[index + 1]]
+            top = np.argsort(-np.abs(row_data), kind='mergesort')[:nb_features]
+            top = top[row_data[top] != 0]
+            vector_indexes.append(np.full(len(top), index, dtype=np.intp))
+            features.append(matrix.indices[matrix.indptr[index] + top])
+        return (np.concatenate(vector_indexes or [np.zeros(0, dtype=np.intp)]),
+                np.concatenate(features or [np.zeros(0, dtype=np.intp)]).astype(np.intp))
+    matrix = np.atleast_2d(np.asarray(matrix))
+    nb_features = min(nb_features, matrix.shape[1])
+    top = np.argpartition(-np.abs(matrix), nb_features - 1, axis=1)[:, :nb_features]
+    vector_indexes = np.repeat(np.arange(matrix.shape[0]), nb_features)
+    features = top.ravel()
+    non_zero = matrix[vector_indexes, features] != 0
+    return vector_indexes[non_zero], features[non_zero]
+
+
+def _build_buckets(codes):
+    """
+    :param codes: numpy array of int, bucket code of each vector
+    :return: dict bucket code -> numpy array of the indexes of the vectors in this bucket
+    """
+    sorted_indexes = np.argsort(codes, kind='mergesort')
+    bucket_codes, bucket_starts = np.unique(codes[sorted_indexes], return_index=True)
+    return dict(zip(bucket_codes, np.split(sorted_indexes, bucket_starts[1:])))
+
+
+def _similarities(normalized_matrix, vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return normalized_matrix.dot(vector) / (norm if norm != 0 else 1.0)
+
+
+def _top_k(indexes, similarities, nb_neighbours):
+    if nb_neighbours < len(similarities):
+        top = np.argpartition(similarities, -nb_neighbours)[-nb_neighbours:]
+    else:
+        top = np.arange(len(similarities))
+    top = top[np.argsort(-similarities[top], kind='mergesort')]
+    return indexes[top], similarities[top]
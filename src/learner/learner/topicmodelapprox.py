@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import json
+import os
 from itertools import chain, izip
 import numpy as np
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse import csr_matrix
+from common.cache import LruTtlCache
 
 
 class TopicModelConverter(object):
@@ -27,14 +32,37 @@ class TopicModelConverter(object):
     def compute_target_vector(self, origin_vector):
         """
         :param origin_vector: classification of element (doc or user profile) in origin_model,
-        list of double of size origin_model.nb_topics
+        numpy array of double of size origin_model.nb_topics
         :return: approximation of classification of this element (doc or user profile) in target_model
-        list of double of size target_model.nb_topics
+        numpy array of double of size target_model.nb_topics
         """
-        np_origin_vector = np.asarray(origin_vector)
-        np_target_vector = self._projector.project_on_target_space(np_origin_vector)
-        target_vector = np_target_vector.tolist()
-        return target_vector
+        return self._projector.project_on_target_space(origin_vector)
+
+    def compute_target_matrix(self, origin_matrix):
+        """
+        Batch version of compute_target_vector, all the vectors are converted by a single solve
+        :param origin_matrix: classifications of elements in origin_model, array-like of dimension
+        (nb elements, origin_model.nb_topics)
+        :return: approximations of classifications of the elements in target_model, numpy array of dimension
+        (nb elements, target_model.nb_topics)
+        """
+        return self._projector.project_matrix_on_target_space(origin_matrix)
+
+
+# converters are cached by model ids, which identify the topics of a model (cf. TopicModeller.get_model_id)
+_CONVERTERS_CACHE = LruTtlCache(max_size=16, ttl_seconds=24 * 3600)
+
+
+def get_topic_model_converter(origin_model, target_model):
+    """
+    :return: TopicModelConverter between the models, built once for each origin_model/target_model pair
+    """
+    key = (origin_model.topic_model_id, target_model.topic_model_id)
+    converter = _CONVERTERS_CACHE.get(key)
+    if converter is None:
+        converter = TopicModelConverter(origin_model, target_model)
+        _CONVERTERS_CACHE.put(key, converter)
+    return converter
 
 
 class _ProjectorBetweenSubspaces(object):
@@ -56,9 +84,10 @@ class _ProjectorBetweenSubspaces(object):
         proof: follow https://en.wikipedia.org/wiki/Linear_least_squares_(mathematics)#Derivation_of_the_normal_equations
                but taking y:=Aa X:=B, beta:=b
         """
-        # pre-compute left hand side (B^T * B) and right hand side ( B^T * A )
+        # pre-compute right hand side ( B^T * A ) and LU factorization of left hand side (B^T * B), same factorization
+        # as np.linalg.solve, but done once for all the projected vectors
         target_space_transposed = target_space_basis.transpose()
-        self._left_hand_side = np.dot(target_space_transposed, target_space_basis)
+        self._left_hand_side_factorization = lu_factor(np.dot(target_space_transposed, target_space_basis))
         self._right_hand_side = np.dot(target_space_transposed, origin_space_basis)
 
     def project_on_target_space(self, vector_in_origin_basis):
@@ -67,53 +96,142 @@ class _ProjectorBetweenSubspaces(object):
         :return: best projection of input vector on target_space expressed in target_space_basis
         """
         # solve linear equation ( B^T * B ) b = ( B^T * A ) a
-        return np.linalg.solve(self._left_hand_side, np.dot(self._right_hand_side, vector_in_origin_basis))
+        return lu_solve(self._left_hand_side_factorization, np.dot(self._right_hand_side, vector_in_origin_basis))
+
+    def project_matrix_on_target_space(self, matrix_in_origin_basis):
+        """
+        :param matrix_in_origin_basis: matrix whose rows are vectors expressed in origin_space_basis
+        :return: matrix whose rows are the best projections of input rows on target_space expressed in target_space_basis
+        """
+        # solve linear equation ( B^T * B ) X = ( B^T * A ) M^T, each column of M^T is a vector to project
+        matrix_in_origin_basis = np.asarray(matrix_in_origin_basis, dtype=np.float64)
+        if matrix_in_origin_basis.shape[0] == 0:
+            return np.zeros((0, self._right_hand_side.shape[0]))
+        right_hand_side = np.dot(self._right_hand_side, matrix_in_origin_basis.transpose())
+        return lu_solve(self._left_hand_side_factorization, right_hand_side).transpose()
 
 
 class TopicModelApproxClassifier(object):
 
-    def __init__(self, model):
+    @staticmethod
+    def make_from_model(model):
         """
         :param model: struct.TopicModelDescription
         """
-        words = set(topic_word.word
-                    for topic in model.topics
-                    for topic_word in topic.topic_words)  # unique words
+        words = list(set(topic_word.word
+                         for topic in model.topics
+                         for topic_word in topic.topic_words))  # unique words
+        model_basis = _build_basis_matrix(dict(izip(words, range(len(words)))), model)
+        return TopicModelApproxClassifier(words, _ProjectorOnSubspace.make_from_basis(model_basis))
+
+    @staticmethod
+    def load(dir_path):
+        """
+        :param dir_path: directory where a classifier has been saved by TopicModelApproxClassifier.save
+        :return: TopicModelApproxClassifier, its projection matrix is memory-mapped (read-only), so its pages are
+        shared by all the processes loading it
+        """
+        with open(os.path.join(dir_path, _WORDS_FILE_NAME)) as words_file:
+            words = json.load(words_file)
+        projection_matrix = np.load(os.path.join(dir_path, _PROJECTION_FILE_NAME), mmap_mode='r')
+        return TopicModelApproxClassifier(words, _ProjectorOnSubspace(projection_matrix))
 
+    def __init__(self, words, projector):
+        """
+        :param words: list of the words of the model, in the order of the global space dimensions of projector
+        :param projector: _ProjectorOnSubspace on the subspace of the model topics
+        """
         self._word_to_index = dict(izip(words, range(len(words))))
-        model_basis = _build_basis_matrix(self._word_to_index, model)
-        self._projector = _ProjectorOnSubspace(model_basis)
+        self._projector = projector
+
+    def save(self, dir_path):
+        """
+        :param dir_path: existing directory where classifier files are written
+        """
+        words = sorted(self._word_to_index, key=self._word_to_index.get)
+        with open(os.path.join(dir_path, _WORDS_FILE_NAME), 'w') as words_file:
+            json.dump(words, words_file)
+        np.save(os.path.join(dir_path, _PROJECTION_FILE_NAME), self._projector.pseudo_inverse_transposed)
+
+    @property
+    def nb_topics(self):
+        return self._projector.pseudo_inverse_transposed.shape[1]
 
     def compute_classified_vector(self, word_list):
         """
         :param word_list: list of words
-        :return: approximation of classification of the word_list, list of double of size model.nb_topics
+        :return: approximation of classification of the word_list, numpy array of double of size model.nb_topics
+        """
+        return self.compute_classified_vectors([word_list])[0]
+
+    def compute_classified_vectors(self, word_lists):
         """
-        word_np_array = np.zeros(len(self._word_to_index))
-        for word in word_list:
-            index = self._word_to_index.get(word)
-            if index is not None:
-                word_np_array[index] = 1.0
+        Batch version of compute_classified_vector
+        :param word_lists: list of list of words
+        :return: numpy array of dimension (len(word_lists), model.nb_topics), row i is the classification of word_lists[i]
+        """
+        # sparse matrix of dimension (len(word_lists), nb words of model), 1.0 if word of model is in word list
+        rows = []
+        columns = []
+        for index_word_list, word_list in enumerate(word_lists):
+            word_indexes = set(self._word_to_index.get(word) for word in word_list)
+            word_indexes.discard(None)
+            rows.extend([index_word_list] * len(word_indexes))
+            columns.extend(word_indexes)
+        words_matrix = csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(word_lists), len(self._word_to_index)))
+        return self._projector.project_matrix_on_subspace(words_matrix)
+
+
+_WORDS_FILE_NAME = 'words.json'
+_PROJECTION_FILE_NAME = 'projection.npy'
 
-        classified_np_vector = self._projector.project_on_subspace(word_np_array)
-        classified_vector = classified_np_vector.tolist()
-        return classified_vector
+
+# classifiers are cached by model id, which identifies the topics of a model (cf. TopicModeller.get_model_id)
+_CLASSIFIERS_CACHE = LruTtlCache(max_size=4, ttl_seconds=24 * 3600)
+
+
+def get_approx_classifier(model):
+    """
+    :return: TopicModelApproxClassifier of the model, built once for each model id
+    """
+    classifier = _CLASSIFIERS_CACHE.get(model.topic_model_id)
+    if classifier is None:
+        classifier = TopicModelApproxClassifier.make_from_model(model)
+        _CLASSIFIERS_CACHE.put(model.topic_model_id, classifier)
+    return classifier
 
 
 class _ProjectorOnSubspace(object):
 
-    def __init__(self, subspace_basis):
+    def __init__(self, pseudo_inverse_transposed):
+        """
+        :param pseudo_inverse_transposed: numpy matrix dim_global_space * dim_subspace, transposed of the pseudo inverse
+        of the subspace basis
+        """
+        self.pseudo_inverse_transposed = pseudo_inverse_transposed
+
+    @staticmethod
+    def make_from_basis(subspace_basis):
         """
         :param subspace_basis: numpy matrix dim_global_space * dim_subspace
         """
-        self._left_hand_side = subspace_basis
+        # the least squares solution of subspace_basis * x = vector is pseudo_inverse * vector: the pseudo inverse,
+        # of dimension dim_subspace * dim_global_space, is computed once by a single SVD instead of one by projection
+        return _ProjectorOnSubspace(np.linalg.pinv(subspace_basis).transpose())
 
     def project_on_subspace(self, vector):
         """
         :param vector: numpy vector of size dim_global_space
         :return: numpy vector or size dim_subspace, projection of vector on subspace
         """
-        return np.linalg.lstsq(self._left_hand_side, vector)[0]  # first elt of result tuple is projected vector
+        return np.dot(vector, self.pseudo_inverse_transposed)
+
+    def project_matrix_on_subspace(self, matrix):
+        """
+        :param matrix: numpy array or scipy.sparse matrix of dimension (nb vectors, dim_global_space)
+        :return: numpy array of dimension (nb vectors, dim_subspace), row i is the projection of row i of matrix
+        """
+        return np.asarray(matrix.dot(self.pseudo_inverse_transposed))
 
 
 def _build_basis_matrix(word_to_index, model):
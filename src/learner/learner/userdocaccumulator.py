@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import heapq
-from scipy.spatial import distance
+from itertools import izip
+from scipy.sparse import csr_matrix, issparse
 import numpy as np
+from .nearestneighbours import normalize_rows
 
 
 class UserDoc(object):
@@ -30,37 +32,82 @@ class UserData(object):
 
 class UserDocumentsAccumulator(object):
 
-    def __init__(self, user_data_list, user_docs_max_size):
+    def __init__(self, user_data_list, user_docs_max_size, user_index_factory=None):
         """
         :param user_data_list: list of learner.UserData, UserData.feature_vector must have the same size of feature_vector
         of documents that will be added
         :param user_docs_max_size: max number of documents to add in userDocs for each user (int)
+        :param user_index_factory: None to grade each doc for all the users, or a function building an index of
+        learner.nearestneighbours from the user matrix, to grade each doc only for the candidate users of the index
         """
-        self._user_docs_heaps = []
         user_feature_vectors = []
+        user_docs_list = []
         for data in user_data_list:
-            grade_doc_list = ((doc.grade, doc.doc_id) for doc in data.user_docs)
-            user_docs_heap = _FixedSizeHeap(key_value_list=grade_doc_list, max_size=user_docs_max_size)
-            self._user_docs_heaps.append(user_docs_heap)
             user_feature_vectors.append(data.feature_vector)
-        self._user_feature_vector_matrix = np.matrix(user_feature_vectors)
+            user_docs_list.append(heapq.nlargest(user_docs_max_size, data.user_docs, key=lambda user_doc: user_doc.grade))
+        # user vectors are normalized once so cosine similarities of docs are only a matrix product
+        self._normalized_user_matrix = _normalize_rows(user_feature_vectors)
+        self._user_index = None
+        if user_index_factory is not None and user_feature_vectors:
+            self._user_index = user_index_factory(self._normalized_user_matrix)
+        # top docs of each user: row i contains the grades and docs of user i, empty slots have a -inf grade
+        self._top_grades = np.full((len(user_docs_list), user_docs_max_size), -np.inf)
+        self._top_docs = np.empty((len(user_docs_list), user_docs_max_size), dtype=object)
+        for index_user, user_docs in enumerate(user_docs_list):
+            for index_doc, user_doc in enumerate(user_docs):
+                self._top_grades[index_user, index_doc] = user_doc.grade
+                self._top_docs[index_user, index_doc] = user_doc.doc_id
 
     def add_doc(self, doc, feature_vector):
         """
-        NB: The computational cost for each doc is:
+        :param doc:
+        :param feature_vector: dense vector (array-like), or sparse vector with 'indexes', 'values' and 'length' attributes
+        (like frontendstructs.SparseFeatureVector). A sparse vector is used as is, without densifying it.
+        """
+        if hasattr(feature_vector, 'indexes'):
+            feature_matrix = csr_matrix((feature_vector.values, feature_vector.indexes, [0, len(feature_vector.indexes)]),
+                                        shape=(1, feature_vector.length))
+        else:
+            feature_matrix = np.atleast_2d(np.asarray(feature_vector, dtype=np.float64))
+        self.add_docs([doc], feature_matrix)
+
+    def add_docs(self, docs, feature_matrix):
+        """
+        NB: The computational cost for a chunk of docs is:
         O(
-           nb_users --> iterate on all user heaps
+           nb_users*nb_docs*nb_features --> one matrix multiplication for all the grades (only nb_candidate_users
+                                            instead of nb_users with a user index)
            +
-           nb_users*log(user_docs_max_size)*Proba(doc relevant for user)) --> add in heaps
+           nb_users*nb_docs --> compare grades with the worst top doc of each user
            +
-           nb_user*nb_features --> matrix multiplication
+           nb_updated_users*(user_docs_max_size + nb_docs) --> top-k selection only for users with a better doc
         )
-        :param doc:
-        :param feature_vector:
+        :param docs: list of docs, same size as the number of rows of feature_matrix
+        :param feature_matrix: numpy array or scipy.sparse matrix of dimension (nb docs, nb features), row i is the
+        feature vector of docs[i]
         """
-        grade_vec = _similarity_by_row(self._user_feature_vector_matrix, feature_vector)
-        for grade, user_docs_heap in zip(grade_vec, self._user_docs_heaps):
-            user_docs_heap.push(grade, doc)
+        if not docs or self._top_docs.shape[0] == 0:
+            return
+        if self._user_index is None:
+            grades = _similarity_matrix(self._normalized_user_matrix, feature_matrix)
+        else:
+            grades = self._candidate_similarity_matrix(feature_matrix)
+        doc_array = np.empty(len(docs), dtype=object)
+        doc_array[:] = docs
+        _merge_top_grades(self._top_grades, self._top_docs, grades, doc_array)
+
+    def _candidate_similarity_matrix(self, feature_matrix):
+        """
+        :return: same as _similarity_matrix, but only computed for candidate users of each doc, -inf for other users
+        """
+        normalized_docs = normalize_rows(feature_matrix)
+        if issparse(normalized_docs):
+            normalized_docs = normalized_docs.toarray()  # a chunk of docs is small, only users are numerous
+        grades = np.full((self._normalized_user_matrix.shape[0], normalized_docs.shape[0]), -np.inf, dtype=np.float32)
+        for index_doc, candidate_users in enumerate(self._user_index.candidates(normalized_docs)):
+            grades[candidate_users, index_doc] = np.dot(self._normalized_user_matrix[candidate_users],
+                                                        normalized_docs[index_doc])
+        return grades
 
     def build_user_docs(self):
         """
@@ -68,46 +115,61 @@ class UserDocumentsAccumulator(object):
         Each element is the list of the top rated learner.UserDoc, of length <= user_docs_max_size.
         Those lists take in account all the documents added by the add_doc method
         """
-        return [[UserDoc(doc, grade) for (grade, _, doc) in heap.list] for heap in self._user_docs_heaps]
+        return [[UserDoc(doc, grade) for (grade, doc) in izip(grades, docs) if grade != -np.inf]
+                for (grades, docs) in izip(self._top_grades, self._top_docs)]
 
 
-def _similarity_by_row(matrix, vector):
+def _normalize_rows(vectors):
     """
-    compute the cosine similarity (normalized dot product) for each row of 'matrix' against 'vector'
-    :param matrix: array of array or numpy matrix of dimension (n elements, p features)
-    :param vector: vector of dimension p features
-    :return: vector of size n
+    :param vectors: list of vectors of same size p
+    :return: C-contiguous float32 numpy array of dimension (n vectors, p), each row is the vector with a L2 norm of 1,
+    or the zero vector if the input vector is zero
     """
-    vec_as_1_p_matrix = [vector]
-    similarity_as_matrix = 1 - distance.cdist(matrix, vec_as_1_p_matrix, metric='cosine')
-    return similarity_as_matrix.ravel()  # ravel transform matrix in a vector so indexing return float
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    return normalize_rows(np.array(vectors, dtype=np.float64))
 
 
-class _FixedSizeHeap(object):
+def _similarity_matrix(normalized_matrix, feature_matrix):
     """
-    Min Heap data structure with a fixed size. It means at each instant, you keep the "max_size" biggest elements
-    based on the comparison of the keys.
+    compute the cosine similarity (normalized dot product) for each row of 'normalized_matrix' against each row of
+    'feature_matrix'. Similarity with a zero vector is 0.
+    :param normalized_matrix: float32 numpy array of dimension (n elements, p features), rows normalized by _normalize_rows
+    :param feature_matrix: numpy array or scipy.sparse matrix of dimension (m elements, p features)
+    :return: float32 numpy array of dimension (n, m)
     """
-
-    def __init__(self, key_value_list, max_size):
-        self._counter = 0
-        self._max_size = max_size
-        self.list = []
-        for (key, value) in key_value_list:
-            self.push(key, value)
-
-    def push(self, key, value):
-        """
-        If len(heap.list)<max_size, push key-value in the container
-        If len(heap.list)=max_size:
-            -if key<min(list): don't change anything
-            -else replace the minimum present element by input
-        :param key: comparable value used to compare elements
-        :param value: value associated to the key, can be anything
-        """
-        self._counter += 1
-        if len(self.list) < self._max_size:
-            heapq.heappush(self.list, (key, self._counter, value))
-        else:
-            # emulate heappush then heappop but O(1) if key<min(list)
-            heapq.heappushpop(self.list, (key, self._counter, value))
+    # operands are kept in float32, a mixed product would silently copy normalized_matrix in float64 at each call
+    if issparse(feature_matrix):
+        feature_matrix = feature_matrix.astype(np.float32)
+        dot_products = feature_matrix.dot(normalized_matrix.T).T  # sparse.dot(dense) only reads columns of non-zero entries
+        feature_norms = np.sqrt(np.asarray(feature_matrix.multiply(feature_matrix).sum(axis=1)).ravel())
+    else:
+        feature_matrix = np.asarray(feature_matrix, dtype=np.float32)
+        dot_products = np.dot(normalized_matrix, feature_matrix.T)
+        feature_norms = np.linalg.norm(feature_matrix, axis=1)
+    feature_norms[feature_norms == 0] = 1.0  # dot products with a zero vector are already 0
+    return dot_products / feature_norms
+
+
+def _merge_top_grades(top_grades, top_docs, grades, docs):
+    """
+    Update in place top_grades and top_docs so that each row keeps the k biggest grades among its previous grades
+    and the new ones, with k the number of columns of top_grades.
+    :param top_grades: numpy array of dimension (n users, k), grades of the top docs of each user, -inf for empty slots
+    :param top_docs: numpy object array of dimension (n users, k), docs matching top_grades
+    :param grades: numpy array of dimension (n users, m docs), grades of the new docs for each user
+    :param docs: numpy object array of size m, new docs
+    """
+    nb_top = top_grades.shape[1]
+    if nb_top == 0:
+        return
+    # most of the time a new doc is not better than the worst top doc of a user, so only these users need a top-k
+    users_to_update = np.flatnonzero(grades.max(axis=1) > top_grades.min(axis=1))
+    if users_to_update.size == 0:
+        return
+    candidate_grades = np.hstack((top_grades[users_to_update], grades[users_to_update]))
+    candidate_docs = np.hstack((top_docs[users_to_update], np.tile(docs, (len(users_to_update), 1))))
+    top_indexes = np.argpartition(candidate_grades, -nb_top, axis=1)[:, -nb_top:]
+    rows = np.arange(len(users_to_update))[:, np.newaxis]
+    top_grades[users_to_update] = candidate_grades[rows, top_indexes]
+    top_docs[users_to_update] = candidate_docs[rows, top_indexes]
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from math import e
 import numpy as np
+from scipy.sparse import csr_matrix
 from userdocmatch.frontendstructs import UserActionTypeOnDoc, UserProfileModelData
+from .decay import ExponentialDecay
 
 
 class ActionOnDoc(object):
@@ -13,15 +14,51 @@ class ActionOnDoc(object):
     def __init__(self, datetime, doc_feature_vector, action_type):
         """
         :param datetime: date of the action
-        :param doc_feature_vector:  feature vector of the doc associated to this action
+        :param doc_feature_vector:  feature vector of the doc associated to this action, array-like of float
         :param action_type: type of action on the document
         :return:
         """
         self.datetime = datetime
-        self.doc_feature_vector = doc_feature_vector
+        self.doc_feature_vector = np.asarray(doc_feature_vector, dtype=np.float64)
         self.action_type = action_type
 
 
+class ActionsOnDocs(object):
+    """
+    Actions of many users as needed by UserProfiler.compute_user_profiles, element i of each attribute is about action i
+    """
+
+    def __init__(self, user_indexes, datetimes, doc_feature_matrix, action_types):
+        """
+        :param user_indexes: array-like of int, index of the user of each action in the users of the batch
+        :param datetimes: list of datetime, date of each action
+        :param doc_feature_matrix: array-like of dimension (nb actions, nb features), feature vectors of the docs
+        :param action_types: list of UserActionTypeOnDoc, type of each action
+        """
+        self.user_indexes = np.asarray(user_indexes, dtype=np.intp)
+        self.datetimes = datetimes
+        self.doc_feature_matrix = np.asarray(doc_feature_matrix, dtype=np.float64)
+        self.action_types = action_types
+
+    @staticmethod
+    def make_from_actions(actions_by_user, nb_features):
+        """
+        :param actions_by_user: list of iterables of ActionOnDoc, actions of each user of the batch
+        :param nb_features: size of the doc feature vectors
+        """
+        user_indexes = []
+        actions = []
+        for user_index, user_actions in enumerate(actions_by_user):
+            for action in user_actions:
+                user_indexes.append(user_index)
+                actions.append(action)
+        doc_feature_matrix = np.zeros((len(actions), nb_features))
+        for index_action, action in enumerate(actions):
+            doc_feature_matrix[index_action] = action.doc_feature_vector
+        return ActionsOnDocs(user_indexes, [action.datetime for action in actions], doc_feature_matrix,
+                             [action.action_type for action in actions])
+
+
 class UserProfile(object):
     """
     User profile computed by profiler
@@ -31,7 +68,7 @@ class UserProfile(object):
         """
         :param model_data: UserProfileModelData, intermediate variables needed by rocchio algorithm
         to compute feedback vector at each learning step in profiler
-        :param feedback_vector: [float], computed feedback vector of the user
+        :param feedback_vector: numpy array of float, computed feedback vector of the user
         """
         self.model_data = model_data
         self.feedback_vector = feedback_vector
@@ -42,10 +79,13 @@ class UserProfiler(object):
     Class executing the algorithm to compute the User profile from the actions of this user
     """
 
-    def __init__(self):
+    def __init__(self, decay=None):
+        """
+        :param decay: time decay kernel of learner.decay, default is ExponentialDecay with an annual rate of 1.0
+        """
         self._positive_feedback_coeff = 0.8
         self._negative_feedback_coeff = 1.0 - self._positive_feedback_coeff
-        self._decay_annual_rate = 1.0
+        self._decay = decay if decay is not None else ExponentialDecay(annual_rate=1.0)
         self._action_type_to_positive_coeff = {
             UserActionTypeOnDoc.up_vote: 5.0,
             UserActionTypeOnDoc.click_link: 1.0,
@@ -64,113 +104,111 @@ class UserProfiler(object):
         Compute user profile (feature vector plus intermediate values to iterate as the user execute new actions)
         This execute the Rocchio algorithm based on the Wikipedia article, tweaked for:
             -time decay: a document loose relevance relatively as time passes
-                         it uses e**(-rt) because only this form allows streaming algorithm
+                         it uses a decay kernel (e**(-rt) by default) whose factors are multiplicative over
+                         consecutive periods because only this form allows streaming algorithm
                          (no recomputing of all actions since the beginning)
             -coefficients among positive actions set or negative actions set: to give more relevance to up vote that click...
         The result vector of the tweaked Rocchio algorithm is then angularly averaged with the explicit feedback vector.
         :param previous_model_data: previously UserProfileModelData by the profiler
         :param previous_datetime: datetime when previous_user_profile_model_data has been computed by the profiler
-        :param actions_on_docs: list of action since previous computation of UserProfile
+        :param actions_on_docs: iterable of ActionOnDoc since previous computation of UserProfile
         :param new_datetime: now
         :return: updated userprofiler.UserProfile for new actions
         """
+        nb_features = len(previous_model_data.positive_feedback_vector)
+        actions = ActionsOnDocs.make_from_actions([actions_on_docs], nb_features)
+        return self.compute_user_profiles([previous_model_data], [previous_datetime], actions, new_datetime)[0]
 
-        # we compute separately the 2 elements (positive and negative) the we add them to get final feature vector
-        pos_elt = self._compute_user_profile_elt(
-            previous_vec=previous_model_data.positive_feedback_vector,
-            previous_sum_coeff=previous_model_data.positive_feedback_sum_coeff,
-            previous_date=previous_datetime,
-            actions=actions_on_docs,
-            new_date=new_datetime,
-            action_to_coeff=self._action_type_to_positive_coeff
-        )
-        neg_elt = self._compute_user_profile_elt(
-            previous_vec=previous_model_data.negative_feedback_vector,
-            previous_sum_coeff=previous_model_data.negative_feedback_sum_coeff,
-            previous_date=previous_datetime,
-            actions=actions_on_docs,
-            new_date=new_datetime,
-            action_to_coeff=self._action_type_to_negative_coeff
-        )
-        global_vec = self._compute_global_feedback_vector(np.asarray(previous_model_data.explicit_feedback_vector),
-                                                          neg_elt, pos_elt)
-
-        updated_model_data = UserProfileModelData(previous_model_data.explicit_feedback_vector,
-                                                  pos_elt.sum_vec.tolist(), neg_elt.sum_vec.tolist(),
-                                                  pos_elt.sum_coeff, neg_elt.sum_coeff)
-
-        return UserProfile(updated_model_data, global_vec.tolist())
-
-    def _compute_global_feedback_vector(self, explicit_feedback_vec, neg_elt, pos_elt):
-        weighted_normalized_pos_vec = self._positive_feedback_coeff * self._compute_normalized_vector(pos_elt)
-        weighted_normalized_neg_vec = self._negative_feedback_coeff * self._compute_normalized_vector(neg_elt)
-        diff_pos_neg_vec = weighted_normalized_pos_vec - weighted_normalized_neg_vec
-
-        diff_pos_neg_vec_norm = np.linalg.norm(diff_pos_neg_vec)
-        if diff_pos_neg_vec_norm == 0:
-            diff_pos_neg_vec_norm = 1
-        explicit_feedback_norm = np.linalg.norm(explicit_feedback_vec)
-        if explicit_feedback_norm == 0:
-            explicit_feedback_norm = 1
-
-        global_vec = (diff_pos_neg_vec / diff_pos_neg_vec_norm + explicit_feedback_vec / explicit_feedback_norm) / 2
-
-        return global_vec
+    def compute_user_profiles(self, previous_model_data_list, previous_datetimes, actions_on_docs, new_datetime):
+        """
+        Batch version of compute_user_profile for users whose vectors have the same size.
+        The new actions of all the users are added to their positive and negative elements by a single product of
+        the sparse matrix of discounted action coefficients, of dimension (2 * nb users, nb actions), with the matrix
+        of doc feature vectors.
+        :param previous_model_data_list: list of UserProfileModelData previously computed by the profiler
+        :param previous_datetimes: list of datetime when each previous model data has been computed by the profiler
+        :param actions_on_docs: ActionsOnDocs, actions of the users since previous computation of their UserProfile
+        :param new_datetime: now
+        :return: list of updated userprofiler.UserProfile matching previous_model_data_list
+        """
+        nb_users = len(previous_model_data_list)
+        if nb_users == 0:
+            return []
+        explicit_feedback_matrix = np.array(
+            [model_data.explicit_feedback_vector for model_data in previous_model_data_list], dtype=np.float64)
+        previous_vecs, previous_sum_coeffs = _stack_elements(previous_model_data_list)
+
+        previous_discount_factors = np.tile(
+            self._decay.discount_factors(previous_datetimes, new_datetime), 2)
+        actions_coeff_matrix = self._actions_coeff_matrix(actions_on_docs, nb_users, new_datetime)
+        sum_vecs = previous_discount_factors[:, np.newaxis] * previous_vecs + \
+            actions_coeff_matrix.dot(actions_on_docs.doc_feature_matrix)
+        sum_coeffs = previous_discount_factors * previous_sum_coeffs + \
+            np.asarray(actions_coeff_matrix.sum(axis=1)).ravel()
+
+        global_vecs = self._global_feedback_vectors(explicit_feedback_matrix, sum_vecs, sum_coeffs)
+        return _to_user_profiles(explicit_feedback_matrix, sum_vecs, sum_coeffs, global_vecs)
+
+    def _actions_coeff_matrix(self, actions_on_docs, nb_users, new_date):
+        """
+        :return: scipy.sparse matrix of dimension (2 * nb_users, nb actions), row i (resp. nb_users + i) contains the
+        discounted positive (resp. negative) coefficients of the actions of user i
+        """
+        nb_actions = len(actions_on_docs.user_indexes)
+        discount_factors = self._decay.discount_factors(actions_on_docs.datetimes, new_date)
+        positive_coeffs = discount_factors * np.array(
+            [self._action_type_to_positive_coeff[action_type] for action_type in actions_on_docs.action_types])
+        negative_coeffs = discount_factors * np.array(
+            [self._action_type_to_negative_coeff[action_type] for action_type in actions_on_docs.action_types])
+        rows = np.concatenate((actions_on_docs.user_indexes, nb_users + actions_on_docs.user_indexes))
+        columns = np.tile(np.arange(nb_actions), 2)
+        return csr_matrix((np.concatenate((positive_coeffs, negative_coeffs)), (rows, columns)),
+                          shape=(2 * nb_users, nb_actions))
+
+    def _global_feedback_vectors(self, explicit_feedback_matrix, sum_vecs, sum_coeffs):
+        """
+        :param explicit_feedback_matrix: numpy array of dimension (nb users, nb features)
+        :param sum_vecs: numpy array of dimension (2 * nb users, nb features), positive then negative element vectors
+        :param sum_coeffs: numpy array of size 2 * nb users, positive then negative element sum of coefficients
+        :return: numpy array of dimension (nb users, nb features), global feedback vector of each user
+        """
+        nb_users = explicit_feedback_matrix.shape[0]
+        normalized_vecs = self._compute_normalized_vectors(sum_vecs, sum_coeffs)
+        diff_pos_neg_vecs = self._positive_feedback_coeff * normalized_vecs[:nb_users] - \
+            self._negative_feedback_coeff * normalized_vecs[nb_users:]
+        return (_normalize_rows(diff_pos_neg_vecs) + _normalize_rows(explicit_feedback_matrix)) / 2
 
     @staticmethod
-    def _compute_normalized_vector(profile_elt):
+    def _compute_normalized_vectors(sum_vecs, sum_coeffs):
         # An absence of any action on one side is characterized by a sum_coeff to zero.
         # when there is no action on one side (ie: no negative actions), the best we can do is to take only
         # the other side in account. The two vectors (positive, negative) are added, so neutral element is the zero vector
-        if profile_elt.sum_coeff == 0:
-            return np.zeros(len(profile_elt.sum_vec))
-        else:
-            return profile_elt.sum_vec / profile_elt.sum_coeff
-
-    def _compute_user_profile_elt(self, previous_vec, previous_sum_coeff, previous_date, actions, new_date, action_to_coeff):
-        """ compute user profile variables for one element (positive or negative).
-        3 steps algorithms:
-        -discount previous profile
-        -compute profile for new actions
-        -mix the two to gives updated profile element
-        """
-        size_vec = len(previous_vec)
-
-        discounted_previous_elt = self._discount_profile_elt(previous_date, previous_sum_coeff, previous_vec, new_date)
-        new_actions_elt = self._new_actions_profile_elt(action_to_coeff, actions, new_date, size_vec)
-        updated_sum_coeff = discounted_previous_elt.sum_coeff + new_actions_elt.sum_coeff
-        updated_vec = discounted_previous_elt.sum_vec + new_actions_elt.sum_vec
-        return _ElementProfile(updated_vec, updated_sum_coeff)
-
-    def _new_actions_profile_elt(self, action_to_coeff, actions, new_date, size_vec):
-        new_vec = np.zeros(size_vec)
-        new_sum_coeff = 0.0
-        for action in actions:
-            doc_discount_factor = _compute_discount_factor(self._decay_annual_rate, action.datetime, new_date)
-            doc_coeff = doc_discount_factor * action_to_coeff[action.action_type]
-            doc_vector = np.asarray(action.doc_feature_vector)
-            doc_weighted_vector = doc_coeff * doc_vector
-            new_sum_coeff += doc_coeff
-            new_vec += doc_weighted_vector
-        new_actions_elt = _ElementProfile(new_vec, new_sum_coeff)
-        return new_actions_elt
-
-    def _discount_profile_elt(self, previous_date, previous_sum_coeff, previous_vec, new_date):
-        previous_vec = np.asarray(previous_vec)
-        disc_factor = _compute_discount_factor(self._decay_annual_rate, previous_date, new_date)
-        discounted_previous_sum_coeff = disc_factor * previous_sum_coeff
-        discounted_previous_vec = disc_factor * previous_vec
-        return _ElementProfile(discounted_previous_vec, discounted_previous_sum_coeff)
-
-
-def _compute_discount_factor(annual_rate, start_date, end_date):
-    time_incr = end_date - start_date
-    time_incr_in_years = time_incr.days / 365.25
-    return e**(-annual_rate * time_incr_in_years)
-
-
-class _ElementProfile(object):
-
-    def __init__(self, sum_vector, sum_coeff):
-        self.sum_vec = sum_vector
-        self.sum_coeff = sum_coeff
+        normalized_vecs = np.zeros_like(sum_vecs)
+        has_actions = sum_coeffs != 0
+        normalized_vecs[has_actions] = sum_vecs[has_actions] / sum_coeffs[has_actions, np.newaxis]
+        return normalized_vecs
+
+
+def _stack_elements(model_data_list):
+    """
+    :return: tuple (sum vectors, sum coefficients) of positive elements of all the users, then negative elements
+    """
+    sum_vecs = np.array([model_data.positive_feedback_vector for model_data in model_data_list] +
+                        [model_data.negative_feedback_vector for model_data in model_data_list], dtype=np.float64)
+    sum_coeffs = np.array([model_data.positive_feedback_sum_coeff for model_data in model_data_list] +
+                          [model_data.negative_feedback_sum_coeff for model_data in model_data_list], dtype=np.float64)
+    return sum_vecs, sum_coeffs
+
+
+def _to_user_profiles(explicit_feedback_matrix, sum_vecs, sum_coeffs, global_vecs):
+    nb_users = explicit_feedback_matrix.shape[0]
+    return [UserProfile(UserProfileModelData(explicit_feedback_matrix[index], sum_vecs[index], sum_vecs[nb_users + index],
+                                             float(sum_coeffs[index]), float(sum_coeffs[nb_users + index])),
+                        global_vecs[index])
+            for index in range(nb_users)]
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1
+    return matrix / norms[:, np.newaxis]
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import math
+import unittest
+import numpy as np
+from learner.decay import ExponentialDecay, StepwiseHalfLifeDecay
+
+
+class ExponentialDecayTests(unittest.TestCase):
+
+    @staticmethod
+    def test_discount_factors():
+        decay = ExponentialDecay(annual_rate=math.log(2), nb_cached_days=100)
+        end_date = datetime(2021, 1, 1, 12)
+        # 50 days is in cached table, one year and future date are computed
+        start_dates = [end_date, end_date - timedelta(days=50, hours=23), end_date - timedelta(days=365, hours=12),
+                       end_date + timedelta(days=2)]
+        expected = [1.0, 2 ** (-50 / 365.25), 2 ** (-365 / 365.25), 2 ** (2 / 365.25)]
+        np.testing.assert_array_almost_equal(expected, decay.discount_factors(start_dates, end_date))
+
+    def test_discount_factors_empty_dates(self):
+        self.assertEqual(0, len(ExponentialDecay().discount_factors([], datetime(2021, 1, 1))))
+
+
+class StepwiseHalfLifeDecayTests(unittest.TestCase):
+
+    @staticmethod
+    def test_factor_is_halved_at_each_period_start():
+        decay = StepwiseHalfLifeDecay(half_life_days=10, nb_cached_steps=2)
+        period_start = datetime.fromordinal(datetime(2021, 1, 1).toordinal() // 10 * 10)
+        start_dates = [period_start, period_start + timedelta(days=9), period_start - timedelta(days=1),
+                       period_start - timedelta(days=30)]
+        end_date = period_start + timedelta(days=9, hours=23)
+        np.testing.assert_array_almost_equal([1.0, 1.0, 0.5, 0.125], decay.discount_factors(start_dates, end_date))
+
+    def test_factors_are_multiplicative_over_consecutive_periods(self):
+        decay = StepwiseHalfLifeDecay(half_life_days=7)
+        date1 = datetime(2021, 1, 1)
+        date2 = datetime(2021, 1, 5)
+        date3 = datetime(2021, 3, 2)
+        factor_1_2 = decay.discount_factors([date1], date2)[0]
+        factor_2_3 = decay.discount_factors([date2], date3)[0]
+        factor_1_3 = decay.discount_factors([date1], date3)[0]
+        self.assertAlmostEqual(factor_1_3, factor_1_2 * factor_2_3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy as np
+from scipy.sparse import csr_matrix
+from learner.nearestneighbours import BruteForceCosineIndex, RandomProjectionCosineIndex, TopFeaturesCosineIndex, \
+    normalize_rows
+
+
+def _build_clustered_vectors(random_state, nb_clusters, nb_vectors_by_cluster, nb_features):
+    # like topic classifications, vectors are positive with a few significant topics, shared by vectors of a cluster
+    vectors = []
+    for _ in range(nb_clusters):
+        cluster_topics = random_state.choice(nb_features, 4, replace=False)
+        cluster_weights = random_state.dirichlet(np.ones(4))
+        for _ in range(nb_vectors_by_cluster):
+            vector = np.zeros(nb_features)
+            vector[cluster_topics] = cluster_weights + 0.1 * random_state.rand(4)
+            vector[random_state.choice(nb_features, 2)] += 0.05 * random_state.rand(2)
+            vectors.append(vector)
+    return np.array(vectors)
+
+
+def _build_topic_vectors(random_state, nb_vectors, nb_topics, min_nb_topics, max_nb_topics):
+    # like LDA classifications: a few random topics by vector with Dirichlet weights, small weights are dropped
+    vectors = np.zeros((nb_vectors, nb_topics))
+    for vector in vectors:
+        topics = random_state.choice(nb_topics, random_state.randint(min_nb_topics, max_nb_topics + 1), replace=False)
+        vector[topics] = random_state.dirichlet(np.full(len(topics), 0.5))
+    vectors[vectors < 0.01] = 0.0
+    return vectors
+
+
+class NormalizeRowsTests(unittest.TestCase):
+
+    def test_normalize_rows_dense_and_sparse(self):
+        matrix = np.array([[3.0, 4.0], [0.0, 0.0], [0.0, 2.0]])
+        expected = [[0.6, 0.8], [0.0, 0.0], [0.0, 1.0]]
+        normalized_dense = normalize_rows(matrix)
+        self.assertEqual(np.float32, normalized_dense.dtype)
+        self.assertTrue(normalized_dense.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_almost_equal(expected, normalized_dense)
+        normalized_sparse = normalize_rows(csr_matrix(matrix))
+        self.assertEqual(np.float32, normalized_sparse.dtype)
+        np.testing.assert_array_almost_equal(expected, normalized_sparse.toarray())
+
+
+class BruteForceCosineIndexTests(unittest.TestCase):
+
+    def test_query_return_most_similar_vectors_by_decreasing_similarity(self):
+        matrix = np.array([[1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [2.0, 0.1]])
+        for index in [BruteForceCosineIndex(matrix), BruteForceCosineIndex(csr_matrix(matrix))]:
+            indexes, similarities = index.query([1.0, 0.0], 3)
+            self.assertEqual([0, 3, 1], indexes.tolist())
+            np.testing.assert_array_almost_equal([1.0, 2.0 / np.sqrt(4.01), 1.0 / np.sqrt(2.0)], similarities)
+            indexes, _ = index.query([0.0, 1.0], 10)  # all vectors when nb_neighbours is above the number of vectors
+            self.assertEqual([2, 1, 3, 0], indexes.tolist())
+
+    def test_candidates_are_all_vectors(self):
+        index = BruteForceCosineIndex(np.ones((3, 2)))
+        candidates = index.candidates(np.ones((2, 2)))
+        self.assertEqual(2, len(candidates))
+        for query_candidates in candidates:
+            self.assertEqual([0, 1, 2], query_candidates.tolist())
+
+    def test_empty_index(self):
+        indexes, similarities = BruteForceCosineIndex(csr_matrix((0, 3))).query(np.ones(3), 2)
+        self.assertEqual(0, len(indexes))
+        self.assertEqual(0, len(similarities))
+
+
+class RandomProjectionCosineIndexTests(unittest.TestCase):
+
+    def test_query_has_good_recall_with_few_candidates(self):
+        random_state = np.random.RandomState(0)
+        matrix = _build_clustered_vectors(random_state, nb_clusters=20, nb_vectors_by_cluster=50, nb_features=64)
+        exact_index = BruteForceCosineIndex(matrix)
+        approx_index = RandomProjectionCosineIndex(matrix, nb_tables=8, nb_bits=8, seed=1)
+        queries = matrix[random_state.choice(len(matrix), 20)] + 0.02 * random_state.rand(20, 64)
+
+        nb_found = 0
+        for query in queries:
+            exact_indexes, _ = exact_index.query(query, 10)
+            approx_indexes, approx_similarities = approx_index.query(query, 10)
+            self.assertTrue(np.all(np.diff(approx_similarities) <= 0))
+            nb_found += len(set(exact_indexes) & set(approx_indexes))
+            self.assertLess(len(approx_index.candidates(query[np.newaxis, :])[0]), len(matrix) / 4)
+        self.assertGreater(nb_found / float(10 * len(queries)), 0.9)
+
+    def test_vector_of_index_is_its_own_nearest_neighbour(self):
+        matrix = _build_clustered_vectors(np.random.RandomState(0), nb_clusters=5, nb_vectors_by_cluster=10, nb_features=16)
+        for index in [RandomProjectionCosineIndex(matrix), RandomProjectionCosineIndex(csr_matrix(matrix))]:
+            for index_vector in [0, 17, 49]:
+                indexes, similarities = index.query(matrix[index_vector], 1)
+                self.assertEqual([index_vector], indexes.tolist())
+                self.assertAlmostEqual(1.0, similarities[0], places=5)
+
+    def test_same_seed_gives_same_candidates(self):
+        matrix = _build_clustered_vectors(np.random.RandomState(0), nb_clusters=5, nb_vectors_by_cluster=10, nb_features=16)
+        queries = matrix[:5]
+        candidates1 = RandomProjectionCosineIndex(matrix, seed=3).candidates(queries)
+        candidates2 = RandomProjectionCosineIndex(matrix, seed=3).candidates(queries)
+        for query_candidates1, query_candidates2 in zip(candidates1, candidates2):
+            self.assertEqual(query_candidates1.tolist(), query_candidates2.tolist())
+
+
+
+class TopFeaturesCosineIndexTests(unittest.TestCase):
+
+    def test_users_top_docs_recall_with_default_parameters(self):
+        # as in UserDocumentsAccumulator: users are indexed, docs (sparser than user profiles) are the queries
+        random_state = np.random.RandomState(0)
+        user_matrix = _build_topic_vectors(random_state, 2000, 512, min_nb_topics=5, max_nb_topics=30)
+        doc_matrix = csr_matrix(_build_topic_vectors(random_state, 500, 512, min_nb_topics=2, max_nb_topics=10))
+        similarities = normalize_rows(user_matrix).dot(normalize_rows(doc_matrix).T.toarray())
+        users_top_docs = np.argsort(-similarities, axis=1, kind='mergesort')[:, :30]
+
+        is_candidate = np.zeros(similarities.shape, dtype=bool)
+        doc_candidates = TopFeaturesCosineIndex(user_matrix).candidates(doc_matrix)
+        for index_doc, candidate_users in enumerate(doc_candidates):
+            is_candidate[candidate_users, index_doc] = True
+        recall = is_candidate[np.arange(len(user_matrix))[:, np.newaxis], users_top_docs].mean()
+        self.assertGreaterEqual(recall, 0.9)
+        self.assertLess(is_candidate.mean(), 0.2)  # each doc is graded for a small part of the users
+
+    def test_candidates_share_main_features_with_query(self):
+        matrix = np.array([[0.9, 0.1, 0.0], [0.0, 0.2, 0.8], [0.6, 0.0, 0.4]])
+        index = TopFeaturesCosineIndex(matrix, nb_index_features=1, nb_query_features=1)
+        candidates = index.candidates(csr_matrix([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.1, 0.9]]))
+        self.assertEqual([[0, 2], [], [1]], [query_candidates.tolist() for query_candidates in candidates])
+
+    def test_vector_of_index_is_its_own_nearest_neighbour(self):
+        matrix = _build_clustered_vectors(np.random.RandomState(0), nb_clusters=5, nb_vectors_by_cluster=10, nb_features=16)
+        for index in [TopFeaturesCosineIndex(matrix), TopFeaturesCosineIndex(csr_matrix(matrix))]:
+            for index_vector in [0, 17, 49]:
+                indexes, similarities = index.query(matrix[index_vector], 1)
+                self.assertEqual([index_vector], indexes.tolist())
+                self.assertAlmostEqual(1.0, similarities[0], places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,15 @@
 import unittest
+import tempfile
 import numpy as np
 from userdocmatch.frontendstructs import TopicModelDescription
-from learner.topicmodelapprox import TopicModelConverter, TopicModelApproxClassifier
+from learner.topicmodelapprox import TopicModelConverter, TopicModelApproxClassifier, get_topic_model_converter, \
+    get_approx_classifier
 
 
 class TopicModelConverterTests(unittest.TestCase):
 
-    def test_compute_target_vector_with_same_model_return_same_vector(self):
+    @staticmethod
+    def test_compute_target_vector_with_same_model_return_same_vector():
         origin_model = TopicModelDescription.make_from_scratch('orig_id', [
             [('orig_t1_w1', 0.8), ('orig_t1_w2', 0.1)],
             [('orig_t2_w1', 1.0)]
@@ -17,9 +20,10 @@ class TopicModelConverterTests(unittest.TestCase):
         ])
         converter = TopicModelConverter(origin_model, target_model)
         target_vector = converter.compute_target_vector([0.25, 0.75])
-        self.assertEquals([0.75, 0.25], target_vector)
+        np.testing.assert_array_equal([0.75, 0.25], target_vector)
 
-    def test_compute_target_vector_with_target_encompass_origin_return_same_vector(self):
+    @staticmethod
+    def test_compute_target_vector_with_target_encompass_origin_return_same_vector():
         origin_model = TopicModelDescription.make_from_scratch('orig_id', [
             [('orig_t1_w1', 0.8), ('orig_t1_w2', 0.1)],
             [('orig_t2_w1', 1.0)]
@@ -31,9 +35,10 @@ class TopicModelConverterTests(unittest.TestCase):
         ])
         converter = TopicModelConverter(origin_model, target_model)
         target_vector = converter.compute_target_vector([0.25, 0.75])
-        self.assertEquals([0.75, 0.25, 0], target_vector)
+        np.testing.assert_array_equal([0.75, 0.25, 0], target_vector)
 
-    def test_compute_target_vector_with_useless_dim_in_origin_return_same_vector(self):
+    @staticmethod
+    def test_compute_target_vector_with_useless_dim_in_origin_return_same_vector():
         origin_model = TopicModelDescription.make_from_scratch('orig_id', [
             [('orig_t1_w1', 0.9), ('orig_t1_w2', 0.1)],
             [('orig_t2_w1', 1.0)],
@@ -45,9 +50,10 @@ class TopicModelConverterTests(unittest.TestCase):
         ])
         converter = TopicModelConverter(origin_model, target_model)
         target_vector = converter.compute_target_vector([0.25, 0.75, 0])
-        self.assertEquals([0.75, 0.25], target_vector)
+        np.testing.assert_array_equal([0.75, 0.25], target_vector)
 
-    def test_compute_target_vector_with_two_topics_merged_return_merged_weights(self):
+    @staticmethod
+    def test_compute_target_vector_with_two_topics_merged_return_merged_weights():
         origin_model = TopicModelDescription.make_from_scratch('orig_id', [
             [('orig_t1_w1', 0.9), ('orig_t1_w2', 0.1)],
             [('orig_t2_w1', 1.0)]
@@ -58,7 +64,7 @@ class TopicModelConverterTests(unittest.TestCase):
         ])
         converter = TopicModelConverter(origin_model, target_model)
         target_vector = converter.compute_target_vector([0.5, 0.5])
-        self.assertEquals([0.95, 0.05], target_vector)
+        np.testing.assert_array_equal([0.95, 0.05], target_vector)
 
     @staticmethod
     def test_compute_target_vector_with_topic_split_return_split_weights():
@@ -74,7 +80,8 @@ class TopicModelConverterTests(unittest.TestCase):
         target_vector = converter.compute_target_vector([1.0, 0.0])
         np.testing.assert_almost_equal([0.55, 0.5], target_vector, 3)
 
-    def test_compute_target_vector_with_no_shared_word_from_used_topic_return_zero(self):
+    @staticmethod
+    def test_compute_target_vector_with_no_shared_word_from_used_topic_return_zero():
         origin_model = TopicModelDescription.make_from_scratch('orig_id', [
             [('orig_t1_w1', 0.5), ('orig_t2_w1', 0.5)],
             [('orig_t1_w2', 1.0)]
@@ -85,9 +92,10 @@ class TopicModelConverterTests(unittest.TestCase):
         ])
         converter = TopicModelConverter(origin_model, target_model)
         target_vector = converter.compute_target_vector([1.0, 0.0])
-        self.assertEquals([0, 0], target_vector)
+        np.testing.assert_array_equal([0, 0], target_vector)
 
-    def test_compute_target_vector_with_no_shared_word_between_models_return_zero(self):
+    @staticmethod
+    def test_compute_target_vector_with_no_shared_word_between_models_return_zero():
         origin_model = TopicModelDescription.make_from_scratch('orig_id', [
             [('orig_t1_w1', 0.5), ('orig_t2_w1', 0.5)],
             [('orig_t1_w2', 1.0)]
@@ -98,19 +106,53 @@ class TopicModelConverterTests(unittest.TestCase):
         ])
         converter = TopicModelConverter(origin_model, target_model)
         target_vector = converter.compute_target_vector([0.5, 0.5])
-        self.assertEquals([0, 0], target_vector)
+        np.testing.assert_array_equal([0, 0], target_vector)
+
+    @staticmethod
+    def test_compute_target_matrix_return_target_vector_of_each_row():
+        origin_model = TopicModelDescription.make_from_scratch('orig_id', [
+            [('orig_t1_w1', 0.9), ('orig_t1_w2', 0.1)],
+            [('orig_t2_w1', 1.0)],
+            [('orig_t3_w1', 0.6), ('orig_t1_w2', 0.4)]
+        ])
+        target_model = TopicModelDescription.make_from_scratch('target_id', [
+            [('orig_t1_w1', 0.5), ('orig_t2_w1', 0.5)],
+            [('orig_t1_w2', 1.0)],
+            [('orig_t3_w1', 0.7), ('target_t3_w2', 0.3)]
+        ])
+        converter = TopicModelConverter(origin_model, target_model)
+        origin_matrix = [[0.5, 0.5, 0.0], [0.1, 0.2, 0.7], [0.0, 0.0, 1.0], [1.0, 0.0, 0.0]]
+        target_matrix = converter.compute_target_matrix(origin_matrix)
+        np.testing.assert_almost_equal([converter.compute_target_vector(vec) for vec in origin_matrix], target_matrix, 12)
+        np.testing.assert_almost_equal([0.95, 0.05, 0.0], target_matrix[0], 12)
+
+    @staticmethod
+    def test_compute_target_matrix_with_no_row_return_empty_matrix():
+        origin_model = TopicModelDescription.make_from_scratch('orig_id', [[('w1', 1.0)]])
+        target_model = TopicModelDescription.make_from_scratch('target_id', [[('w1', 1.0)], [('w2', 1.0)]])
+        target_matrix = TopicModelConverter(origin_model, target_model).compute_target_matrix(np.zeros((0, 1)))
+        np.testing.assert_array_equal(np.zeros((0, 2)), target_matrix)
+
+    def test_get_topic_model_converter_return_same_converter_for_same_models(self):
+        origin_model = TopicModelDescription.make_from_scratch('get_converter_orig_id', [[('w1', 1.0)]])
+        target_model = TopicModelDescription.make_from_scratch('get_converter_target_id', [[('w1', 0.5)], [('w2', 1.0)]])
+        converter = get_topic_model_converter(origin_model, target_model)
+        self.assertIs(converter, get_topic_model_converter(origin_model, target_model))
+        self.assertIsNot(converter, get_topic_model_converter(target_model, origin_model))
+        np.testing.assert_array_equal([[2.0, 0.0]], converter.compute_target_matrix([[1.0]]))
 
 
 class TopicModelApproxClassifierTest(unittest.TestCase):
 
-    def test_compute_classified_vector_no_shared_word_return_zero(self):
+    @staticmethod
+    def test_compute_classified_vector_no_shared_word_return_zero():
         model = TopicModelDescription.make_from_scratch('id', [
             [('t1_w1', 0.5), ('t1_w2', 0.5)],
             [('t2_w1', 1.0)]
         ])
-        classifier = TopicModelApproxClassifier(model)
+        classifier = TopicModelApproxClassifier.make_from_model(model)
         classified = classifier.compute_classified_vector(['w3'])
-        self.assertEquals([0, 0], classified)
+        np.testing.assert_array_equal([0, 0], classified)
 
     @staticmethod
     def test_compute_classified_vector_shared_word_on_one_topic():
@@ -118,7 +160,7 @@ class TopicModelApproxClassifierTest(unittest.TestCase):
             [('t1_w1', 0.5), ('t1_w2', 0.5)],
             [('t2_w1', 1.0)]
         ])
-        classifier = TopicModelApproxClassifier(model)
+        classifier = TopicModelApproxClassifier.make_from_model(model)
         classified = classifier.compute_classified_vector(['t1_w1', 'w3'])
         np.testing.assert_almost_equal([1.0, 0], classified, 10)
 
@@ -128,7 +170,7 @@ class TopicModelApproxClassifierTest(unittest.TestCase):
             [('t1_w1', 0.5), ('t1_w2', 0.5)],
             [('t1_w1', 1.0)]
         ])
-        classifier = TopicModelApproxClassifier(model)
+        classifier = TopicModelApproxClassifier.make_from_model(model)
         classified = classifier.compute_classified_vector(['t1_w1'])
         np.testing.assert_almost_equal([0.0, 1.0], classified, 10)
 
@@ -138,9 +180,45 @@ class TopicModelApproxClassifierTest(unittest.TestCase):
             [('t1_w1', 0.5), ('t1_w2', 0.5)],
             [('t2_w1', 1.0)]
         ])
-        classifier = TopicModelApproxClassifier(model)
+        classifier = TopicModelApproxClassifier.make_from_model(model)
         classified = classifier.compute_classified_vector(['t1_w1', 't2_w1'])
         np.testing.assert_almost_equal([1.0, 1.0], classified, 10)
 
+    @staticmethod
+    def test_compute_classified_vectors_return_classified_vector_of_each_word_list():
+        model = TopicModelDescription.make_from_scratch('id', [
+            [('t1_w1', 0.5), ('t1_w2', 0.5)],
+            [('t2_w1', 1.0)],
+            [('t1_w1', 0.3), ('t3_w1', 0.7)]
+        ])
+        classifier = TopicModelApproxClassifier.make_from_model(model)
+        word_lists = [['t1_w1', 't2_w1'], [], ['w3'], ['t3_w1', 't1_w2', 't3_w1'], ['t1_w1']]
+        classified = classifier.compute_classified_vectors(word_lists)
+        np.testing.assert_almost_equal(
+            [classifier.compute_classified_vector(word_list) for word_list in word_lists], classified, 10)
+        np.testing.assert_array_equal([0, 0, 0], classified[1])
+
+    @staticmethod
+    def test_load_return_classifier_saved():
+        model = TopicModelDescription.make_from_scratch('id', [
+            [('t1_w1', 0.5), ('t1_w2', 0.5)],
+            [(u't2_w1_\xe9', 1.0)]
+        ])
+        classifier = TopicModelApproxClassifier.make_from_model(model)
+        dir_path = tempfile.mkdtemp()
+        classifier.save(dir_path)
+        loaded_classifier = TopicModelApproxClassifier.load(dir_path)
+        word_lists = [['t1_w1'], [u't2_w1_\xe9', 't1_w2'], ['w3']]
+        np.testing.assert_array_equal(
+            classifier.compute_classified_vectors(word_lists), loaded_classifier.compute_classified_vectors(word_lists))
+        np.testing.assert_array_equal(classifier.compute_classified_vector(['t1_w2']),
+                                      loaded_classifier.compute_classified_vector(['t1_w2']))
+
+    def test_get_approx_classifier_return_same_classifier_for_same_model(self):
+        model = TopicModelDescription.make_from_scratch('get_classifier_id', [[('t1_w1', 1.0)], [('t2_w1', 1.0)]])
+        classifier = get_approx_classifier(model)
+        self.assertIs(classifier, get_approx_classifier(model))
+        np.testing.assert_almost_equal([[0.0, 1.0]], classifier.compute_classified_vectors([['t2_w1']]), 10)
+
 if __name__ == '__main__':
     unittest.main()
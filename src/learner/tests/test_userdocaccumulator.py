@@ -3,7 +3,12 @@
 
 from math import sqrt
 import unittest
-from learner.userdocaccumulator import UserDocumentsAccumulator, UserData, UserDoc, _similarity_by_row, _FixedSizeHeap
+import numpy as np
+from scipy.sparse import csr_matrix
+from learner.userdocaccumulator import UserDocumentsAccumulator, UserData, UserDoc, _similarity_matrix, _merge_top_grades, \
+    _normalize_rows
+from learner.nearestneighbours import BruteForceCosineIndex, RandomProjectionCosineIndex
+from userdocmatch.frontendstructs import SparseFeatureVector
 
 
 def norm(vec):
@@ -16,45 +21,60 @@ class LearnerTests(unittest.TestCase):
     def test_compute_user_doc_matching_with_grade_above_should_flag_doc_as_relevant(self):
         user1 = [0.49, 1.0, 0.0]
         user2 = [0.5, 1.0, 0.1]
-        users = [user1, user2]
         doc = [1.0, 0.5, 0.1]
-        matching = _similarity_by_row(matrix=users, vector=doc)
-        self.assertIsInstance(matching[0], float)
-        self.assertIsInstance(matching[1], float)
-        self.assertEqual(0.99 / (norm(user1) * norm(doc)), matching[0])
-        self.assertEqual(1.01 / (norm(user2) * norm(doc)), matching[1])
+        matching = _similarity_matrix(_normalize_rows([user1, user2]), np.array([doc]))
+        self.assertEqual((2, 1), matching.shape)
+        # user matrix is stored as float32
+        self.assertAlmostEqual(0.99 / (norm(user1) * norm(doc)), matching[0, 0], places=6)
+        self.assertAlmostEqual(1.01 / (norm(user2) * norm(doc)), matching[1, 0], places=6)
+
+    def test_normalize_rows(self):
+        normalized = _normalize_rows([[3.0, 4.0], [0.0, 0.0]])
+        self.assertEqual(np.float32, normalized.dtype)
+        self.assertTrue(normalized.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_almost_equal([[0.6, 0.8], [0.0, 0.0]], normalized)
+        self.assertEqual((0, 0), _normalize_rows([]).shape)
+
+    def test_similarity_matrix_sparse_equals_dense(self):
+        users = _normalize_rows([[0.49, 1.0, 0.0, 0.3], [0.5, 1.0, 0.1, 0.0]])
+        docs = np.array([[1.0, 0.0, 0.1, 0.0], [0.0, 0.0, 0.0, 0.0], [0.0, 2.0, 0.0, 1.0]])
+        sparse_matching = _similarity_matrix(users, csr_matrix(docs))
+        dense_matching = _similarity_matrix(users, docs)
+        self.assertEqual((2, 3), sparse_matching.shape)
+        np.testing.assert_array_almost_equal(dense_matching, sparse_matching, 6)
+        np.testing.assert_array_equal([0.0, 0.0], dense_matching[:, 1])  # similarity with zero vector is 0
+
+
+class MergeTopGradesTests(unittest.TestCase):
+
+    def test_merge_top_grades(self):
+        top_grades = np.array([[0.5, 0.2, 0.9, -np.inf]])
+        top_docs = np.array([["A", "minInit", "B", None]], dtype=object)
+
+        def assert_top(expected_grade_doc_set):
+            result = set((grade, doc) for grade, doc in zip(top_grades[0], top_docs[0]) if grade != -np.inf)
+            self.assertEqual(expected_grade_doc_set, result)
 
-
-class FixedSizeHeapTests(unittest.TestCase):
-
-    def test_push(self):
-
-        def assert_equal(expected_key_value_tuple, heap_list_elt):
-            self.assertEqual(expected_key_value_tuple, (heap_list_elt[0], heap_list_elt[-1]))
-
-        def assert_in(expected_key_value_tuple, heap_list):
-            self.assertTrue(expected_key_value_tuple in ((elt[0], elt[-1])for elt in heap_list))
-
-        # create generator to make sure heap does not rely on structure of input (double iteration, side-effect in input...)
-        input_list = (pair for pair in [(0.5, "A"), (0.2, "minInit"), (0.9, "B")])
-        heap = _FixedSizeHeap(input_list, 4)
         # below max size, all elements should be presents
-        self.assertEqual(3, len(heap.list))
-        assert_equal((0.2, "minInit"), heap.list[0])
-        heap.push(0.8, "C")
-        self.assertEqual(4, len(heap.list))
-        assert_equal((0.2, "minInit"), heap.list[0])
-        # we add a better value than 0.2, this should move "minInit" out of heap
-        heap.push(0.21, "D")
-        self.assertEqual(4, len(heap.list))
-        assert_equal((0.21, "D"), heap.list[0])
-        heap.push(0.20, "notAdded")
-        # check final state, in an heap, first is always min but it's not sorted
-        self.assertEqual(4, len(heap.list))
-        assert_equal((0.21, "D"), heap.list[0])
-        assert_in((0.5, "A"), heap.list)
-        assert_in((0.9, "B"), heap.list)
-        assert_in((0.8, "C"), heap.list)
+        _merge_top_grades(top_grades, top_docs, np.array([[0.8]]), np.array(["C"], dtype=object))
+        assert_top({(0.5, "A"), (0.2, "minInit"), (0.9, "B"), (0.8, "C")})
+        # we add a better value than 0.2, this should move "minInit" out of top
+        _merge_top_grades(top_grades, top_docs, np.array([[0.21]]), np.array(["D"], dtype=object))
+        assert_top({(0.5, "A"), (0.21, "D"), (0.9, "B"), (0.8, "C")})
+        # we add a smaller value than 0.21, nothing should change
+        _merge_top_grades(top_grades, top_docs, np.array([[0.1]]), np.array(["E"], dtype=object))
+        assert_top({(0.5, "A"), (0.21, "D"), (0.9, "B"), (0.8, "C")})
+        # several docs at once, only the best ones are kept
+        _merge_top_grades(top_grades, top_docs, np.array([[0.3, 0.95, 0.6]]), np.array(["F", "G", "H"], dtype=object))
+        assert_top({(0.6, "H"), (0.95, "G"), (0.9, "B"), (0.8, "C")})
+
+    def test_merge_top_grades_by_user(self):
+        top_grades = np.array([[0.5, -np.inf], [0.5, 0.7]])
+        top_docs = np.array([["A", None], ["B", "C"]], dtype=object)
+        grades = np.array([[0.1, 0.2], [0.1, 0.6]])
+        _merge_top_grades(top_grades, top_docs, grades, np.array(["D", "E"], dtype=object))
+        self.assertEqual({"A", "E"}, set(top_docs[0]))
+        self.assertEqual({"C", "E"}, set(top_docs[1]))
 
 
 class UserDocumentsAccumulatorTest(unittest.TestCase):
@@ -88,6 +108,37 @@ class UserDocumentsAccumulatorTest(unittest.TestCase):
         assert_user_docs(["doc1", "doc5"], result3_users_docs[0])  # doc5 relevant only for user1, and excludes doc4
         assert_user_docs(["doc3", "doc4"], result3_users_docs[1])  # user2 remains the same
 
+        accumulator.add_doc("doc6", SparseFeatureVector([0, 1], [10.0, -1.0], 2, 'feature_set_id'))
+        result4_users_docs = accumulator.build_user_docs()
+        assert_user_docs(["doc1", "doc5"], result4_users_docs[0])  # doc6 not relevant for user1
+        assert_user_docs(["doc3", "doc6"], result4_users_docs[1])  # doc6 more relevant than doc4 for user2
+
+        # batch of docs: doc7 relevant for user1 only, doc8 for user2 only, doc9 for nobody
+        accumulator.add_docs(["doc7", "doc8", "doc9"], np.array([[-1.0, 2.0], [2.0, -1.0], [1.0, 1.0]]))
+        result5_users_docs = accumulator.build_user_docs()
+        assert_user_docs(["doc1", "doc7"], result5_users_docs[0])
+        assert_user_docs(["doc3", "doc8"], result5_users_docs[1])
+
+    def test_add_docs_with_user_index_grades_only_candidate_users(self):
+        random_state = np.random.RandomState(0)
+        user_vectors = random_state.rand(200, 16) ** 8  # a few significant features by user
+        doc_matrix = random_state.rand(50, 16) ** 8
+
+        def build_user_docs(user_index_factory):
+            user_data_list = [UserData(vector, []) for vector in user_vectors]
+            accumulator = UserDocumentsAccumulator(user_data_list, 3, user_index_factory)
+            accumulator.add_docs(range(20), doc_matrix[:20])
+            accumulator.add_docs(range(20, 50), csr_matrix(doc_matrix[20:]))
+            return [set(user_doc.doc_id for user_doc in user_docs) for user_docs in accumulator.build_user_docs()]
+
+        exact_user_docs = build_user_docs(None)
+        self.assertEqual(exact_user_docs, build_user_docs(BruteForceCosineIndex))
+        approx_user_docs = build_user_docs(lambda matrix: RandomProjectionCosineIndex(matrix, nb_tables=4, nb_bits=4))
+        nb_common_docs = sum(len(exact & approx) for exact, approx in zip(exact_user_docs, approx_user_docs))
+        self.assertGreater(nb_common_docs, 0.5 * 3 * len(user_vectors))
+        for approx in approx_user_docs:
+            self.assertLessEqual(len(approx), 3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,15 +5,15 @@ from datetime import datetime
 import unittest
 import math
 import numpy as np
-from learner.userprofiler import UserProfiler, ActionOnDoc, _ElementProfile
+from learner.userprofiler import UserProfiler, ActionOnDoc, ActionsOnDocs
+from learner.decay import ExponentialDecay, StepwiseHalfLifeDecay
 from userdocmatch.frontendstructs import UserActionTypeOnDoc, UserProfileModelData
 
 
 class UserProfilerTests(unittest.TestCase):
 
     def test_compute_user_profile_initial(self):
-        profiler = UserProfiler()
-        profiler._decay_annual_rate = math.log(2)  # so that coeff is divided by 2 in one year
+        profiler = UserProfiler(decay=ExponentialDecay(annual_rate=math.log(2)))  # coeff is divided by 2 in one year
         previous_date = datetime(2020, 1, 1)
         doc_date1 = datetime(2021, 1, 1)
         intermediate_date = datetime(2021, 4, 1)
@@ -32,7 +32,8 @@ class UserProfilerTests(unittest.TestCase):
         new_profile = profiler.compute_user_profile(init_model_data, previous_date, actions, new_date)
 
         # Explicit feedback vector should not change
-        self.assertEquals(new_profile.model_data.explicit_feedback_vector, init_model_data.explicit_feedback_vector)
+        np.testing.assert_array_equal(init_model_data.explicit_feedback_vector,
+                                      new_profile.model_data.explicit_feedback_vector)
 
         # --------1) test that profile computed from scratch gives the expected feature_vector angle
         # expected vector =
@@ -61,46 +62,110 @@ class UserProfilerTests(unittest.TestCase):
 
         self.assert_profile_equals(new_profile, final_profile)
 
+    def test_compute_user_profile_streaming_with_stepwise_decay(self):
+        profiler = UserProfiler(decay=StepwiseHalfLifeDecay(half_life_days=30))
+        model_data = UserProfileModelData([1.0, 0.0], [0.0, 0.0], [0.0, 0.0], 0.0, 0.0)
+        actions = [ActionOnDoc(datetime(2021, 1, 1), [1.0, 1.0], UserActionTypeOnDoc.up_vote),
+                   ActionOnDoc(datetime(2021, 3, 5), [0.0, 1.0], UserActionTypeOnDoc.down_vote)]
+        new_profile = profiler.compute_user_profile(model_data, datetime(2020, 12, 1), actions, datetime(2021, 6, 1))
+        # updates more frequent than the half life must give the same profile
+        profile = model_data
+        previous_date = datetime(2020, 12, 1)
+        for day in range(1, 200, 7):
+            date = datetime.fromordinal(datetime(2020, 12, 1).toordinal() + day)
+            if date > datetime(2021, 6, 1):
+                date = datetime(2021, 6, 1)
+            step_actions = [action for action in actions if previous_date < action.datetime <= date]
+            step_profile = profiler.compute_user_profile(profile, previous_date, step_actions, date)
+            profile = step_profile.model_data
+            previous_date = date
+        self.assert_profile_equals(new_profile, step_profile)
+
     def test_compute_global_feedback_vector_with_no_positive_feedback_only_use_negative(self):
         # If there is no positive feedback. The best we can do is using only negative feedback.
         # What really matters is the direction of the vector. Here in 2 dimensions, this is just the slope between
         # first and second axis
         profiler = UserProfiler()
-        pos_elt = _ElementProfile(np.asarray([3.0, 3.0]), 0)
-        neg_elt = _ElementProfile(np.asarray([5.0, 1.0]), 1)
-        vector = profiler._compute_global_feedback_vector(np.asarray([0.0, 0.0]), neg_elt, pos_elt)
-        self.assertEqual(5.0, vector[0] / vector[1])  # 'slope' of negative vector should be kept
+        sum_vecs = np.asarray([[3.0, 3.0], [5.0, 1.0]])  # positive element, then negative element
+        sum_coeffs = np.asarray([0.0, 1.0])
+        vector = profiler._global_feedback_vectors(np.asarray([[0.0, 0.0]]), sum_vecs, sum_coeffs)[0]
+        self.assertAlmostEqual(5.0, vector[0] / vector[1])  # 'slope' of negative vector should be kept
 
     def test_compute_global_feedback_vector_with_no_negative_feedback_only_use_positive(self):
         # same logic as test_compute_global_feedback_vector_with_no_positive_feedback_only_use_negative
         profiler = UserProfiler()
-        neg_elt = _ElementProfile(np.asarray([3.0, 3.0]), 0)
-        pos_elt = _ElementProfile(np.asarray([5.0, 1.0]), 1)
-        vector = profiler._compute_global_feedback_vector(np.asarray([0.0, 0.0]), neg_elt, pos_elt)
-        self.assertEqual(5.0, vector[0] / vector[1])
+        sum_vecs = np.asarray([[5.0, 1.0], [3.0, 3.0]])
+        sum_coeffs = np.asarray([1.0, 0.0])
+        vector = profiler._global_feedback_vectors(np.asarray([[0.0, 0.0]]), sum_vecs, sum_coeffs)[0]
+        self.assertAlmostEqual(5.0, vector[0] / vector[1])
 
     def test_compute_global_feedback_vector_with_only_explicit_vector(self):
         profiler = UserProfiler()
-        neg_elt = _ElementProfile(np.asarray([0.0, 0.0]), 0)
-        pos_elt = _ElementProfile(np.asarray([0.0, 0.0]), 0)
-        vector = profiler._compute_global_feedback_vector(np.asarray([1.0, 1.5]), neg_elt, pos_elt)
+        sum_vecs = np.zeros((2, 2))
+        sum_coeffs = np.zeros(2)
+        vector = profiler._global_feedback_vectors(np.asarray([[1.0, 1.5]]), sum_vecs, sum_coeffs)[0]
         # Here again, what matters is the direction of the vector which should be the same as the the direction of explicit
         # feedback vector
         self.assertEqual(1.0 / 1.5, vector[0] / vector[1])
 
+    def test_compute_user_profile_iterate_actions_once(self):
+        profiler = UserProfiler()
+        previous_date = datetime(2020, 1, 1)
+        actions = [
+            ActionOnDoc(datetime(2021, 1, 1), [1.0, 0.0], UserActionTypeOnDoc.up_vote),
+            ActionOnDoc(datetime(2021, 1, 1), [0.0, 1.0], UserActionTypeOnDoc.down_vote),
+        ]
+        model_data = UserProfileModelData([1.0, 1.0], [0.0, 0.0], [0.0, 0.0], 0.0, 0.0)
+        from_list = profiler.compute_user_profile(model_data, previous_date, actions, datetime(2022, 1, 1))
+        # a generator can be iterated only once, but its actions must be used for positive and negative elements
+        from_generator = profiler.compute_user_profile(
+            model_data, previous_date, (action for action in actions), datetime(2022, 1, 1))
+        self.assert_profile_equals(from_list, from_generator)
+        self.assertGreater(from_generator.model_data.negative_feedback_sum_coeff, 0)
+
+    def test_compute_user_profiles_same_as_compute_user_profile_for_each_user(self):
+        profiler = UserProfiler()
+        new_date = datetime(2023, 1, 1)
+        previous_model_data_list = [
+            UserProfileModelData([1.0, 0.0], [0.0, 0.0], [0.0, 0.0], 0.0, 0.0),
+            UserProfileModelData([0.5, 2.0], [1.0, 2.0], [3.0, 1.0], 1.5, 0.5),
+            UserProfileModelData([0.0, 1.0], [1.0, 1.0], [0.0, 0.0], 2.0, 0.0)
+        ]
+        previous_datetimes = [datetime(2020, 1, 1), datetime(2021, 6, 1), datetime(2022, 1, 1)]
+        actions_by_user = [
+            [ActionOnDoc(datetime(2021, 1, 1), [1.0, 1.0], UserActionTypeOnDoc.up_vote),
+             ActionOnDoc(datetime(2022, 1, 1), [0.0, 1.0], UserActionTypeOnDoc.view_link)],
+            [],
+            [ActionOnDoc(datetime(2022, 6, 1), [2.0, 1.0], UserActionTypeOnDoc.down_vote),
+             ActionOnDoc(datetime(2022, 7, 1), [1.0, 0.0], UserActionTypeOnDoc.click_link)]
+        ]
+
+        profiles = profiler.compute_user_profiles(
+            previous_model_data_list, previous_datetimes, ActionsOnDocs.make_from_actions(actions_by_user, 2), new_date)
+
+        self.assertEquals(3, len(profiles))
+        for profile, model_data, previous_datetime, actions in zip(
+                profiles, previous_model_data_list, previous_datetimes, actions_by_user):
+            expected_profile = profiler.compute_user_profile(model_data, previous_datetime, actions, new_date)
+            self.assert_profile_equals(expected_profile, profile)
+
+    def test_compute_user_profiles_no_user(self):
+        actions = ActionsOnDocs.make_from_actions([], 2)
+        self.assertEquals([], UserProfiler().compute_user_profiles([], [], actions, datetime(2023, 1, 1)))
+
     def assert_profile_equals(self, expected, result):
         self.assert_model_data_equals(expected.model_data, result.model_data)
-        self.assert_list_almost_equals(expected.feedback_vector, result.feedback_vector)
+        self.assert_array_almost_equals(expected.feedback_vector, result.feedback_vector)
 
     def assert_model_data_equals(self, expected, result):
         self.assertAlmostEquals(expected.positive_feedback_sum_coeff, result.positive_feedback_sum_coeff)
         self.assertAlmostEquals(expected.negative_feedback_sum_coeff, result.negative_feedback_sum_coeff)
-        self.assert_list_almost_equals(expected.explicit_feedback_vector, result.explicit_feedback_vector)
-        self.assert_list_almost_equals(expected.positive_feedback_vector, result.positive_feedback_vector)
-        self.assert_list_almost_equals(expected.negative_feedback_vector, result.negative_feedback_vector)
+        self.assert_array_almost_equals(expected.explicit_feedback_vector, result.explicit_feedback_vector)
+        self.assert_array_almost_equals(expected.positive_feedback_vector, result.positive_feedback_vector)
+        self.assert_array_almost_equals(expected.negative_feedback_vector, result.negative_feedback_vector)
 
-    def assert_list_almost_equals(self, expected, result, places=7):
-        self.assertEquals(type(result), type([]))  # check result is a standard python list
+    def assert_array_almost_equals(self, expected, result, places=7):
+        self.assertIsInstance(result, np.ndarray)  # check result is passed as numpy array without conversion
         self.assertEquals(len(expected), len(result))
         for exp, res in zip(expected, result):
             self.assertAlmostEquals(exp, res, places)
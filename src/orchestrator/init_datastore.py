@@ -10,7 +10,7 @@ def _init_datastore():
     root_dir = os.path.join(directory, "../..")
     model_dir = os.path.join(root_dir, "docker_images/gator_deps/trained_topic_model")
 
-    topic_modeller = TopicModeller()
+    topic_modeller = TopicModeller(fast_tokenizer=TopicModeller.uses_fast_tokenizer(model_dir))
     topic_modeller.load(model_dir)
 
     model_description = TopicModelDescription.make_from_scratch(topic_modeller.get_model_id(), topic_modeller.get_topics())
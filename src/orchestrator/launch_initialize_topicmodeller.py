@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
 from common.JsonDocLoader import JsonDocLoader
 from topicmodeller.topicmodeller import TopicModeller
 from orchestrator.initialize_topicmodeller import initialize_topicmodeller
@@ -23,7 +24,10 @@ class RepeatableHtmlDocuments(object):
 
 def run_init_tm(documents_folder, tm_data_folder, num_topics):
     documents_content = RepeatableHtmlDocuments(documents_folder)
-    initialize_topicmodeller(TopicModeller(), documents_content, tm_data_folder, num_topics)
+    # LDA is trained on all cores, from a corpus tokenized once with the fast tokenizer
+    topic_modeller = TopicModeller(lda_workers=None, corpus_cache_folder=os.path.join(tm_data_folder, 'corpus_cache'),
+                                   fast_tokenizer=True)
+    initialize_topicmodeller(topic_modeller, documents_content, tm_data_folder, num_topics)
 
 
 run_init_tm('/home/mohamed/Development/Data/gator/Scraping_11-01-2016', '/home/mohamed/Development/Data/gator/TM_LAST', 512)
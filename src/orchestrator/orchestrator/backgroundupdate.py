@@ -5,17 +5,22 @@ import logging
 from vcr import use_cassette
 from common.datehelper import utcnow
 from common.environment import IS_TEST_ENV
+from scraper.scraper import Scraper
 from topicmodeller.topicmodeller import TopicModeller
 from userdocmatch.dal import Dal
 from .userprofileupdater import update_profiles_in_database
 from .updatemodel import ModelUpdater
 from .scrap_and_learn import scrap_learn
+from .onlineupdate import OnlineModelUpdater, get_current_model_directory
 
 LOGGER = logging.getLogger(__name__)
 
 
 def update_model_profiles_userdocs():
 
+    # created first, as it forks the processes extracting documents: the process must not have other threads yet
+    scraper = Scraper(disconnected=IS_TEST_ENV)
+
     nb_args = len(sys.argv) - 1  # first argument is script name
     if nb_args < 1:
         print "command usage: python launch_backgroundupdate.py model_directory [vcr_cassette_file users_prefix nb_docs]"
@@ -48,20 +53,27 @@ def update_model_profiles_userdocs():
         topic_model_directory, test_mode, vcr_cassette_file, nb_docs_before_users_reload, start_cache_date)
 
     model_updater = ModelUpdater()
-    topic_modeller = TopicModeller()
-    topic_modeller.load(topic_model_directory)
+    topic_modeller = _load_topic_modeller(get_current_model_directory(topic_model_directory))
 
     seen_url_hashes_set = set(Dal().doc.get_recent_doc_url_hashes(start_cache_date))
+    # model is updated online with scraped docs, except in test mode: model directory is a test resource
+    online_updater = None if test_mode else OnlineModelUpdater(topic_modeller, topic_model_directory)
 
+    # first profiles update is complete, to take in account actions saved before dirty users were flagged
+    incremental_profiles_update = False
     with use_cassette(vcr_cassette_file, record_mode='none', ignore_localhost=True) if vcr_cassette_file else NoContext():
         while True:
             try:
                 LOGGER.info("start new scrap_learn loop")
-                dal = Dal()
-                users = _get_users(dal, keep_user_func)
+                users = _get_users(Dal(), keep_user_func)
                 model_updater.update_model_in_db(topic_modeller, users)
-                update_profiles_in_database(users)
-                scrap_learn(topic_modeller, users, nb_docs_before_users_reload, seen_url_hashes_set)
+                update_profiles_in_database(users, incremental=incremental_profiles_update)
+                incremental_profiles_update = True
+                scrap_learn(scraper, topic_modeller, users, nb_docs_before_users_reload, seen_url_hashes_set,
+                            online_updater=online_updater)
+                # model is updated between scrap loops, it's published by update_model_in_db of next loop
+                if online_updater is not None:
+                    online_updater.update_model()
             except:  # pylint: disable=bare-except
                 LOGGER.exception(u'Exception in update_model_profiles_userdocs main loop, restarting')
                 sleep(30)
@@ -81,6 +93,13 @@ class NoContext(object):
         return False  # pragma: no cover
 
 
+def _load_topic_modeller(model_directory):
+    # documents are tokenized with the tokenizer mode the model has been trained with
+    topic_modeller = TopicModeller(fast_tokenizer=TopicModeller.uses_fast_tokenizer(model_directory))
+    topic_modeller.load(model_directory)
+    return topic_modeller
+
+
 def _get_users(dal, keep_user_func):
     all_users = dal.user.get_all_users()
     users = [user for user in all_users if keep_user_func(user)]  # to filter in tests
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# online updates of a model are saved in this sub folder of its directory, with a file naming the current version
+_VERSIONS_FOLDER = 'online_updates'
+_CURRENT_VERSION_FILE = 'current'
+
+
+def get_current_model_directory(model_directory):
+    """
+    :param model_directory: directory of a trained model, where its online updates are also saved
+    :return: directory of the last online update of the model, model_directory if it has never been updated
+    """
+    versions_directory = os.path.join(model_directory, _VERSIONS_FOLDER)
+    current_version_file_path = os.path.join(versions_directory, _CURRENT_VERSION_FILE)
+    if not os.path.isfile(current_version_file_path):
+        return model_directory
+    with open(current_version_file_path) as current_version_file:
+        return os.path.join(versions_directory, current_version_file.read())
+
+
+class OnlineModelUpdater(object):
+    """
+    Collect the documents classified by the scrap loop, and update the topic model with them by mini-batches, so the
+    model follows the drift of the scraped documents without a full training.
+    The model must not change during a scrap loop (docs would be classified by different models with the same feature
+    set), so documents are only collected by the scrap loop, and the model is updated between two scrap loops. The
+    updated model is then published as a new model by ModelUpdater.update_model_in_db at the start of the next loop.
+    Each update is saved as a new version, the trained model itself is never overwritten.
+    """
+
+    def __init__(self, topic_modeller, model_directory, nb_docs_by_update=5000):
+        """
+        :param topic_modeller: TopicModeller classifying the scraped documents
+        :param model_directory: directory of the trained model, updated models are saved in versions under it, so the
+        last one is reloaded after a restart (cf. get_current_model_directory)
+        :param nb_docs_by_update: size of the mini-batches. Each update publishes a new model, which migrates all
+        profiles and docs, so it should be big enough to not update the model at each scrap loop
+        """
+        self._topic_modeller = topic_modeller
+        self._model_directory = model_directory
+        self._nb_docs_by_update = nb_docs_by_update
+        # bag-of-words of each doc as a tuple of numpy arrays (token ids, token counts), much smaller than python tuples
+        self._bows = []
+
+    def add_bags_of_words(self, bows):
+        """
+        :param bows: list of documents in bag-of-words format classified by the topic model
+        """
+        for bow in bows:
+            token_ids, token_counts = zip(*bow) if bow else ((), ())
+            self._bows.append((np.array(token_ids, dtype=np.int32), np.array(token_counts, dtype=np.float32)))
+
+    def update_model(self):
+        """
+        Update the model with the collected documents if there are at least nb_docs_by_update of them
+        :return: True if the model has been updated
+        """
+        if len(self._bows) < self._nb_docs_by_update:
+            return False
+        LOGGER.info(u'online update of topic model, nb docs[%s]', len(self._bows))
+        previous_model_id = self._topic_modeller.get_model_id()
+        self._topic_modeller.update([zip(token_ids.tolist(), token_counts.tolist())
+                                     for token_ids, token_counts in self._bows])
+        self._bows = []
+        model_id = self._topic_modeller.get_model_id()  # each update has a new model id, used as version
+        self._save_version(model_id)
+        LOGGER.info(u'topic model updated and saved, model id[%s] previous model id[%s]', model_id, previous_model_id)
+        return True
+
+    def _save_version(self, version):
+        """
+        The model is saved in a temporary directory renamed as the version, then the version is made current by renaming
+        the current version file, so a restart never loads a partial model. The previous version is then removed.
+        """
+        versions_directory = os.path.join(self._model_directory, _VERSIONS_FOLDER)
+        if not os.path.isdir(versions_directory):
+            os.makedirs(versions_directory)
+        previous_directory = get_current_model_directory(self._model_directory)
+        version_directory = os.path.join(versions_directory, version)
+        tmp_dir = tempfile.mkdtemp(dir=versions_directory)
+        try:
+            self._topic_modeller.save(tmp_dir)
+            shutil.rmtree(version_directory, ignore_errors=True)  # saved by a previous run, but never made current
+            os.rename(tmp_dir, version_directory)
+        except:  # pylint: disable=bare-except
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        tmp_version_file_path = os.path.join(versions_directory, _CURRENT_VERSION_FILE + '.tmp')
+        with open(tmp_version_file_path, 'w') as tmp_version_file:
+            tmp_version_file.write(version)
+        os.rename(tmp_version_file_path, os.path.join(versions_directory, _CURRENT_VERSION_FILE))
+        if previous_directory != self._model_directory:
+            shutil.rmtree(previous_directory, ignore_errors=True)
@@ -2,37 +2,44 @@
 
 import logging
 import datetime
+import numpy as np
 import common.crypto as crypto
 from common.technical import get_process_memory
 from common.datehelper import utcnow
-from common.environment import IS_TEST_ENV
-from scraper.scraper import Scraper
 from userdocmatch.frontendstructs import Document, UserDocument, FeatureVector
 from userdocmatch.dal import Dal
 import learner.userdocaccumulator as userdocaccu
+from .updatemodel import get_migration_converter, filter_users_with_profile
 
 LOGGER = logging.getLogger(__name__)
 
 
-def scrap_learn(topic_model, users, nb_docs, seen_url_hashes_set):
+def scrap_learn(
+        scraper, topic_model, users, nb_docs, seen_url_hashes_set, online_updater=None, user_index_factory=None):
+    """
+    :param scraper: scraper.Scraper, created once at the start of the process (it forks its extraction processes)
+    :param user_index_factory: None to grade each doc for all users (exact, the default), or a function building an
+    approximate index of learner.nearestneighbours from the user matrix, to grade each doc only for the candidate users
+    of the index. TopFeaturesCosineIndex is the one validated on topic vectors (cf. its recall test)
+    :param online_updater: onlineupdate.OnlineModelUpdater collecting the classified docs, None to not collect them
+    """
 
     class NoActionSaver(object):
 
         def save(self, doc):
             pass
 
-    scraper = Scraper(disconnected=IS_TEST_ENV)
     doc_saver = NoActionSaver()
     user_docs_max_size = 30
     docs_chunk_size = 1000
 
     _scrap_and_learn(scraper, doc_saver, topic_model, docs_chunk_size, user_docs_max_size, seen_url_hashes_set,
-                     users, nb_docs)
+                     users, nb_docs, online_updater, user_index_factory)
 
 
 def _scrap_and_learn(  # pylint: disable=too-many-arguments
         scraper, scraper_doc_saver, topic_modeller, docs_chunk_size, user_docs_max_size, seen_url_hashes_set,
-        users, nb_docs):
+        users, nb_docs, online_updater=None, user_index_factory=None):
     """
     internal scrap_learn so we can inject mocks
     """
@@ -47,31 +54,58 @@ def _scrap_and_learn(  # pylint: disable=too-many-arguments
                 docs_chunk_size, user_docs_max_size, len(seen_url_hashes_set), len(users), nb_docs,
                 get_process_memory())
 
-    doc_builder = DocBuilder(topic_modeller)
+    doc_builder = DocBuilder(topic_modeller, online_updater)
     scraper_filtered = ScraperFiltered(scraper, nb_docs, seen_url_hashes_set)
     doc_saver = UserDocSaverByChunk(docs_chunk_size, UserDocChunkSaver(), scraper_doc_saver)
-    user_docs_accumulator = _build_user_docs_accumulator(users, user_docs_max_size)
+    users, user_docs_accumulator = _build_user_docs_accumulator(users, user_docs_max_size, user_index_factory)
 
     _execute_learn_loop(doc_builder, doc_saver, scraper_filtered, user_docs_accumulator, users)
 
 
 def _execute_learn_loop(doc_builder, doc_saver, scraper_filtered, user_docs_accumulator, users):
     LOGGER.info(u'Start scrap_learn loop')
-    for scraper_document, url_hash in scraper_filtered.scrap():
+    for scraped_chunk in _chunks(scraper_filtered.scrap(), doc_builder.classify_chunk_size):
 
-        (build_ok, doc) = doc_builder.build_doc(scraper_document, url_hash)
-        if not build_ok:
-            LOGGER.info(u'doc creation failed, url[%s]', scraper_document.url)
-            continue
-        LOGGER.debug(u'doc created, url[%s]', scraper_document.url)
-        user_docs_accumulator.add_doc(doc, doc.feature_vector.vector)
-        doc_saver.save_doc(doc, user_docs_accumulator, users)
+        docs = []
+        for (scraper_document, _), (build_ok, doc) in zip(scraped_chunk, doc_builder.build_docs(scraped_chunk)):
+            if not build_ok:
+                LOGGER.info(u'doc creation failed, url[%s]', scraper_document.url)
+                continue
+            LOGGER.debug(u'doc created, url[%s]', scraper_document.url)
+            docs.append(doc)
+        _add_and_save_docs(docs, doc_saver, user_docs_accumulator, users)
 
     # exit function if scraper generator exited without error
     doc_saver.save_cached_docs(user_docs_accumulator, users)
     LOGGER.info(u'scraper exited, end scrap_learn loop')
 
 
+def _add_and_save_docs(docs, doc_saver, user_docs_accumulator, users):
+    # user docs are saved with the doc chunks, so docs are added to the accumulator only up to the next doc chunk saving:
+    # saved user docs must never reference a doc not saved yet
+    while docs:
+        nb_docs_to_add = doc_saver.nb_docs_before_save()
+        docs_to_add, docs = docs[:nb_docs_to_add], docs[nb_docs_to_add:]
+        feature_matrix = np.array([doc.feature_vector.vector for doc in docs_to_add])
+        user_docs_accumulator.add_docs(docs_to_add, feature_matrix)
+        for doc in docs_to_add:
+            doc_saver.save_doc(doc, user_docs_accumulator, users)
+
+
+def _chunks(iterable, chunk_size):
+    """
+    :return: generator of lists of at most chunk_size consecutive elements of iterable
+    """
+    chunk = []
+    for elt in iterable:
+        chunk.append(elt)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class ScraperFiltered(object):
 
     def __init__(self, scraper, nb_docs, seen_url_hashes_set):
@@ -105,6 +139,12 @@ class UserDocSaverByChunk(object):
         self._docs_chunk_size = docs_chunk_size
         self._doc_chunk = []
 
+    def nb_docs_before_save(self):
+        """
+        :return: number of docs that can be passed to save_doc before the doc chunk is saved
+        """
+        return self._docs_chunk_size - len(self._doc_chunk)
+
     def save_doc(self, doc, user_docs_accumulator, users):
         LOGGER.debug(u'save doc in UserDocSaverByChunk, url[%s]', doc.url)
         self._doc_immediate_saver.save(doc)
@@ -146,22 +186,63 @@ class UserDocChunkSaver(object):
 
 
 class DocBuilder(object):
+    # nb of docs classified by a single LDA inference, it trades latency between scraping and saving for throughput
+    classify_chunk_size = 50
 
-    def __init__(self, topic_modeller):
+    def __init__(self, topic_modeller, online_updater=None):
+        """
+        :param online_updater: onlineupdate.OnlineModelUpdater collecting the bags-of-words of the classified docs
+        """
         self._topic_modeller = topic_modeller
+        self._online_updater = online_updater
         self._ref_feature_set_id = Dal().feature_set.get_ref_feature_set_id()
 
-    def build_doc(self, scraper_document, url_hash):
-        (classify_ok, topic_feature_vector) = self._topic_modeller.classify(scraper_document.content)
-        if not classify_ok:
-            return False, None
-        doc = Document(
+    def build_docs(self, scraped_docs):
+        """
+        :param scraped_docs: list of tuples (scraper_document, url_hash)
+        :return: list of tuples (build_ok, doc) in the same order as scraped_docs, doc is None if build_ok is False
+        """
+        contents = [scraper_document.content for scraper_document, _ in scraped_docs]
+        if self._online_updater is None:
+            (success_mask, topic_matrix) = self._topic_modeller.classify_batch(contents)
+        else:
+            # docs are converted once in bag-of-words format, for the classification and the online update
+            bows = self._topic_modeller.to_bags_of_words(contents)
+            (success_mask, topic_matrix) = self._topic_modeller.classify_bags_of_words(bows)
+            self._online_updater.add_bags_of_words([bow for bow, classify_ok in zip(bows, success_mask) if classify_ok])
+        built_docs = []
+        for (scraper_document, url_hash), classify_ok, topic_feature_vector in zip(
+                scraped_docs, success_mask, topic_matrix):
+            if classify_ok:
+                built_docs.append((True, self._build_doc(scraper_document, url_hash, topic_feature_vector)))
+            else:
+                built_docs.append((False, None))
+        return built_docs
+
+    def _build_doc(self, scraper_document, url_hash, topic_feature_vector):
+        return Document(
             scraper_document.url, url_hash, scraper_document.title, summary=scraper_document.content[:250],
             feature_vector=FeatureVector(topic_feature_vector, self._ref_feature_set_id))
-        return True, doc
 
 
-def _build_user_docs_accumulator(users, user_docs_max_size):
+def _convert_users_docs(converter, users_docs):
+    """
+    :return: users_docs, with docs converted by a single call to converter
+    """
+    docs = converter.convert_docs([user_doc.document for user_docs in users_docs for user_doc in user_docs])
+    converted_users_docs = []
+    index_doc = 0
+    for user_docs in users_docs:
+        converted_users_docs.append([UserDocument(doc, user_doc.grade)
+                                     for user_doc, doc in zip(user_docs, docs[index_doc:index_doc + len(user_docs)])])
+        index_doc += len(user_docs)
+    return converted_users_docs
+
+
+def _build_user_docs_accumulator(users, user_docs_max_size, user_index_factory):
+    """
+    :return: tuple (users with a profile, UserDocumentsAccumulator of these users)
+    """
 
     def build_learner_user_data(user_feature_vector, user_docs):
         # Exclude old docs from user docs
@@ -171,10 +252,14 @@ def _build_user_docs_accumulator(users, user_docs_max_size):
         return userdocaccu.UserData(user_feature_vector, learner_user_docs)
 
     dal = Dal()
-    users_docs = dal.user_doc.get_users_docs(users)
-    users_feature_vectors = dal.user_computed_profile.get_users_feature_vectors(users)
+    # docs are classified with the ref model, so users and docs not migrated yet to the ref model are converted
+    converter = get_migration_converter(dal)
+    users, users_feature_vectors = filter_users_with_profile(
+        users, dal.user_computed_profile.get_users_feature_vectors(users))
+    users_docs = _convert_users_docs(converter, dal.user_doc.get_users_docs(users))
+    users_feature_vectors = converter.convert_feature_vectors(users_feature_vectors)
     user_data_list = (
         build_learner_user_data(feat_vec.vector, docs) for feat_vec, docs in zip(users_feature_vectors, users_docs)
     )
-    user_docs_accumulator = userdocaccu.UserDocumentsAccumulator(user_data_list, user_docs_max_size)
-    return user_docs_accumulator
+    user_docs_accumulator = userdocaccu.UserDocumentsAccumulator(user_data_list, user_docs_max_size, user_index_factory)
+    return users, user_docs_accumulator
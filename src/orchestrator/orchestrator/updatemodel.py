@@ -1,20 +1,34 @@
 # -*- coding: utf-8 -*-
 
 import logging
+from collections import defaultdict
+from common.datehelper import utcnow
 from userdocmatch.dal import Dal
 from userdocmatch.frontendstructs import FeatureSet, UserProfileModelData, UserComputedProfile, FeatureVector, Document,\
-    TopicModelDescription
-from learner.topicmodelapprox import TopicModelConverter
-from learner.userprofiler import UserProfiler
+    TopicModelDescription, ModelMigration, UserActionOnDoc
+from learner.topicmodelapprox import get_topic_model_converter
+from learner.userprofiler import UserProfiler, ActionsOnDocs
 
 LOGGER = logging.getLogger(__name__)
 
 
 class ModelUpdater(object):
 
-    @staticmethod
-    def update_model_in_db(topic_modeller, all_users):
+    def __init__(self, nb_users_by_batch=500, max_nb_batches_by_update=20):
         """
+        :param nb_users_by_batch: number of users whose profile and docs are converted and saved together, it bounds
+        the memory used by the migration
+        :param max_nb_batches_by_update: max number of batches migrated by a call to update_model_in_db, the next
+        batches are migrated by the next calls, so a migration doesn't stall the background loop
+        """
+        self._nb_users_by_batch = nb_users_by_batch
+        self._max_nb_batches_by_update = max_nb_batches_by_update
+
+    def update_model_in_db(self, topic_modeller, all_users):
+        """
+        Set topic_modeller model as ref model, and migrate profiles and docs to its feature set. The migration is
+        done by batches of users and checkpointed in database: it is resumed by the next calls until all users are
+        migrated. Meanwhile, readers convert the profiles and docs not migrated yet (cf. get_migration_converter).
         NB: all_users must be "all" because function will modify documents in database and if others users are using those
         same docs, it will create a mismatch of vector model between those other users and updated docs
         """
@@ -22,27 +36,158 @@ class ModelUpdater(object):
 
         model_id = topic_modeller.get_model_id()
         if _is_already_ref(dal, model_id):
-            LOGGER.info("skip update_model_in_db, topic model already set as ref (id[%s])", model_id)
-            return
+            LOGGER.info("topic model already set as ref (id[%s])", model_id)
+        else:
+            target_model = TopicModelDescription.make_from_scratch(model_id, topic_modeller.get_topics())
+            _save_topic_model_and_feature_set(dal, target_model)
+            # migration is saved before the ref, so the ref is never changed without its migration
+            dal.feature_set.save_model_migration(ModelMigration(target_model.topic_model_id, None, False))
+            dal.feature_set.save_ref_feature_set_id(target_model.topic_model_id)
+            LOGGER.info("ref topic model updated in datastore id[%s]", model_id)
+
+        model_migration = _get_active_model_migration(dal)
+        if model_migration is not None:
+            self._migrate_by_batches(dal, model_migration, all_users)
+
+    def _migrate_by_batches(self, dal, model_migration, all_users):
+        converter = FeatureSetConverter(dal, model_migration.target_feature_set_id)
+        users_to_migrate = sorted((user for user in all_users
+                                   if model_migration.last_user_id is None or user.user_id > model_migration.last_user_id),
+                                  key=lambda user: user.user_id)
+        LOGGER.info("migrate to feature set[%s], nb users to migrate[%s]",
+                    model_migration.target_feature_set_id, len(users_to_migrate))
+        nb_users_to_migrate = self._nb_users_by_batch * self._max_nb_batches_by_update
+        for index in range(0, min(len(users_to_migrate), nb_users_to_migrate), self._nb_users_by_batch):
+            batch_users = users_to_migrate[index:index + self._nb_users_by_batch]
+            _migrate_users(dal, converter, batch_users)
+            model_migration.last_user_id = batch_users[-1].user_id
+            dal.feature_set.save_model_migration(model_migration)
+        if len(users_to_migrate) <= nb_users_to_migrate:
+            model_migration.is_done = True
+            dal.feature_set.save_model_migration(model_migration)
+            LOGGER.info("migration to feature set[%s] done", model_migration.target_feature_set_id)
+
+
+def _migrate_users(dal, converter, users):
+    profile_users, profiles = filter_users_with_profile(
+        users, dal.user_computed_profile.get_user_computed_profiles(users))
+    updated_user_to_profiles = [(user, new_profile) for user, profile, new_profile
+                                in zip(profile_users, profiles, converter.convert_profiles(profiles))
+                                if new_profile is not profile]
+    dal.user_computed_profile.save_user_computed_profiles(updated_user_to_profiles)
+
+    # No need to update all docs in db, only those reachable by at least one user. Docs shared with users of
+    # previous batches are already converted, so they are skipped
+    docs = list(set(user_doc.document for user_docs in dal.user_doc.get_users_docs(users) for user_doc in user_docs))
+    updated_docs = [new_doc for doc, new_doc in zip(docs, converter.convert_docs(docs)) if new_doc is not doc]
+    dal.doc.save_documents(updated_docs)
+    LOGGER.info("migrated batch of users, last user_id[%s], nb updated profiles[%s], nb updated docs[%s]",
+                users[-1].user_id, len(updated_user_to_profiles), len(updated_docs))
+
+
+def filter_users_with_profile(users, profiles):
+    """
+    Users are created with a profile, so a user without profile in database is inconsistent (e.g. its creation failed):
+    it is skipped with a warning, so it doesn't abort the processing of the other users
+    :param profiles: list matching users of struct.UserComputedProfile (or of their struct.FeatureVector), None for a
+    user without profile in database
+    :return: tuple (list of users with a profile, list of their profiles)
+    """
+    user_to_profiles = [(user, profile) for user, profile in zip(users, profiles) if profile is not None]
+    if len(user_to_profiles) < len(users):
+        LOGGER.warning(u'users without profile skipped, user_ids[%s]',
+                       u'|'.join(user.user_id for user, profile in zip(users, profiles) if profile is None))
+    return [user for user, _ in user_to_profiles], [profile for _, profile in user_to_profiles]
+
 
-        target_model = TopicModelDescription.make_from_scratch(model_id, topic_modeller.get_topics())
-        target_feature_set_id = target_model.topic_model_id
-        _save_topic_model_and_feature_set(dal, target_model)
+def get_migration_converter(dal):
+    """
+    :return: FeatureSetConverter converting profiles and docs to the feature set of the model migration in progress,
+    so readers can use profiles and docs not migrated yet. It converts nothing if no migration is in progress.
+    """
+    model_migration = _get_active_model_migration(dal)
+    return FeatureSetConverter(dal, model_migration.target_feature_set_id if model_migration is not None else None)
 
-        profiles = dal.user_computed_profile.get_user_computed_profiles(all_users)
-        feature_set_ids = list(set(profile.feature_vector.feature_set_id for profile in profiles))
-        converter_dict = _get_model_converters(dal, feature_set_ids, target_model)
 
-        user_to_profile = zip(all_users, profiles)
-        updated_user_to_profiles = _get_updated_user_to_profile(converter_dict, user_to_profile, target_feature_set_id)
-        dal.user_computed_profile.save_user_computed_profiles(updated_user_to_profiles)
+def _get_active_model_migration(dal):
+    model_migration = dal.feature_set.get_model_migration()
+    if model_migration is None or model_migration.is_done or \
+            model_migration.target_feature_set_id != dal.feature_set.get_ref_feature_set_id():
+        return None
+    return model_migration
 
-        user_docs_by_user = dal.user_doc.get_users_docs(all_users)
-        # No need to update all docs in db, only those reachable by at least one user
-        docs = set(user_doc.document for user_docs in user_docs_by_user for user_doc in user_docs)
-        updated_docs = _get_updated_docs(docs, converter_dict, target_feature_set_id)
-        dal.doc.save_documents(updated_docs)
-        LOGGER.info("save %s updated docs", len(updated_docs))
+
+class FeatureSetConverter(object):
+    """
+    Convert profiles and docs to a target feature set, the elements already in the target feature set are returned
+    unchanged. Conversions between topic models are computed by batches, cf. learner.topicmodelapprox
+    """
+
+    def __init__(self, dal, target_feature_set_id):
+        """
+        :param target_feature_set_id: None to convert nothing
+        """
+        self._dal = dal
+        self._target_feature_set_id = target_feature_set_id
+        self._target_model = None
+        self._feature_set_id_to_converter = {}
+
+    def convert_profiles(self, profiles):
+        """
+        :param profiles: list of struct.UserComputedProfile
+        :return: list of struct.UserComputedProfile matching profiles
+        """
+        return self._convert(
+            profiles, lambda profile: profile.feature_vector.feature_set_id, _get_updated_profiles)
+
+    def convert_docs(self, docs):
+        """
+        :param docs: list of struct.Document
+        :return: list of struct.Document matching docs
+        """
+        return self._convert(docs, lambda doc: doc.feature_vector.feature_set_id, _get_updated_docs)
+
+    def convert_actions(self, actions):
+        """
+        :param actions: list of struct.UserActionOnDoc
+        :return: list of struct.UserActionOnDoc matching actions
+        """
+        new_docs = self.convert_docs([action.document for action in actions])
+        return [action if new_doc is action.document else UserActionOnDoc(new_doc, action.action_type, action.datetime)
+                for action, new_doc in zip(actions, new_docs)]
+
+    def convert_feature_vectors(self, feature_vectors):
+        """
+        :param feature_vectors: list of struct.FeatureVector
+        :return: list of struct.FeatureVector matching feature_vectors. NB: for the feature vector of a profile,
+        it's an approximation of the feature vector of the converted profile (same direction only if the profile has
+        no action)
+        """
+        return self._convert(
+            feature_vectors, lambda feature_vector: feature_vector.feature_set_id, _get_updated_feature_vectors)
+
+    def _convert(self, elements, get_feature_set_id, get_updated_elements):
+        if self._target_feature_set_id is None:
+            return list(elements)
+        new_elements = list(elements)
+        feature_set_id_to_indexes = _group_by_feature_set(
+            range(len(new_elements)), lambda index: get_feature_set_id(new_elements[index]), self._target_feature_set_id)
+        for feature_set_id, indexes in feature_set_id_to_indexes.iteritems():
+            updated_elements = get_updated_elements(
+                self._get_converter(feature_set_id), [new_elements[index] for index in indexes],
+                self._target_feature_set_id)
+            for index, updated_element in zip(indexes, updated_elements):
+                new_elements[index] = updated_element
+        return new_elements
+
+    def _get_converter(self, feature_set_id):
+        converter = self._feature_set_id_to_converter.get(feature_set_id)
+        if converter is None:
+            if self._target_model is None:
+                self._target_model = _get_model(self._dal, self._target_feature_set_id)
+            converter = get_topic_model_converter(_get_model(self._dal, feature_set_id), self._target_model)
+            self._feature_set_id_to_converter[feature_set_id] = converter
+        return converter
 
 
 def _is_already_ref(dal, topic_model_id):
@@ -57,56 +202,71 @@ def _save_topic_model_and_feature_set(dal, model_description):  # pylint: disabl
     target_feature_set = FeatureSet(
         model_description.topic_model_id, target_feature_names, model_description.topic_model_id)
     dal.feature_set.save_feature_set(target_feature_set)
-    dal.feature_set.save_ref_feature_set_id(model_description.topic_model_id)
-    LOGGER.info("ref topic model updated in datastore id[%s]", model_description.topic_model_id)
-
-
-def _get_model_converters(dal, feature_set_ids, target_model):
-    feature_sets = [dal.feature_set.get_feature_set(feature_set_id) for feature_set_id in feature_set_ids]
-    models = [dal.topic_model.get(feature_set.model_id) for feature_set in feature_sets]
-    model_converters = [TopicModelConverter(model, target_model) for model in models]
-    return dict(zip(feature_set_ids, model_converters))
-
-
-def _get_updated_docs(docs, feature_set_id_to_converter, target_feature_set_id):
-    updated_docs = []
-    for doc in docs:
-        feature_set_id = doc.feature_vector.feature_set_id
-        if feature_set_id == target_feature_set_id:
-            continue
-        converter = feature_set_id_to_converter[feature_set_id]
-        target_vector = converter.compute_target_vector(doc.feature_vector.vector)
-        target_feature_vector = FeatureVector(target_vector, target_feature_set_id)
-        updated_doc = Document(
-            doc.url, doc.url_hash, doc.title, doc.summary, target_feature_vector, doc.datetime)
-        updated_docs.append(updated_doc)
-    return updated_docs
-
-
-def _get_updated_user_to_profile(feature_set_id_to_converter, user_to_profile, target_feature_set_id):
-    user_profiler = UserProfiler()
-    updated_user_to_profile = []
-    for user, profile in user_to_profile:
-        feature_set_id = profile.feature_vector.feature_set_id
-        if feature_set_id == target_feature_set_id:
-            continue
-        converter = feature_set_id_to_converter[feature_set_id]
-        model_data_target = _get_updated_model_data(converter, profile.model_data)
-
-        profiler_profile = user_profiler.compute_user_profile(model_data_target, profile.datetime, [], profile.datetime)
-        target_feature_vector = FeatureVector(profiler_profile.feedback_vector, target_feature_set_id)
-        target_profile = UserComputedProfile(
-            target_feature_vector, model_data_target, profile.datetime)
-
-        updated_user_to_profile.append((user, target_profile))
-    return updated_user_to_profile
-
-
-def _get_updated_model_data(converter, model_data_origin):
-    explicit_target = converter.compute_target_vector(model_data_origin.explicit_feedback_vector)
-    positive_target = converter.compute_target_vector(model_data_origin.positive_feedback_vector)
-    negative_target = converter.compute_target_vector(model_data_origin.negative_feedback_vector)
-    model_data_target = UserProfileModelData(
-        explicit_target, positive_target, negative_target,
-        model_data_origin.positive_feedback_sum_coeff, model_data_origin.negative_feedback_sum_coeff)
-    return model_data_target
+
+
+def _get_model(dal, feature_set_id):
+    return dal.topic_model.get(dal.feature_set.get_feature_set(feature_set_id).model_id)
+
+
+def _group_by_feature_set(elements, get_feature_set_id, target_feature_set_id):
+    """
+    :return: dict feature_set_id -> list of elements of this feature set, elements already in target feature set
+    are skipped
+    """
+    feature_set_id_to_elements = defaultdict(list)
+    for element in elements:
+        feature_set_id = get_feature_set_id(element)
+        if feature_set_id != target_feature_set_id:
+            feature_set_id_to_elements[feature_set_id].append(element)
+    return feature_set_id_to_elements
+
+
+def _get_updated_docs(converter, docs, target_feature_set_id):
+    target_matrix = converter.compute_target_matrix([doc.feature_vector.vector for doc in docs])
+    return [Document(doc.url, doc.url_hash, doc.title, doc.summary, FeatureVector(target_vector, target_feature_set_id),
+                     doc.datetime)
+            for doc, target_vector in zip(docs, target_matrix)]
+
+
+def _get_updated_feature_vectors(converter, feature_vectors, target_feature_set_id):
+    target_matrix = converter.compute_target_matrix([feature_vector.vector for feature_vector in feature_vectors])
+    return [FeatureVector(target_vector, target_feature_set_id) for target_vector in target_matrix]
+
+
+def _get_updated_profiles(converter, profiles, target_feature_set_id):
+    model_data_targets = _get_updated_model_data_list(converter, [profile.model_data for profile in profiles])
+    feedback_vectors = _compute_feedback_vectors(UserProfiler(), model_data_targets)
+    return [UserComputedProfile(FeatureVector(feedback_vector, target_feature_set_id), model_data_target,
+                                profile.datetime)
+            for profile, model_data_target, feedback_vector in zip(profiles, model_data_targets, feedback_vectors)]
+
+
+def _compute_feedback_vectors(user_profiler, model_data_list):
+    # feedback vectors are recomputed without action and without decay (same previous and new datetime)
+    nb_model_data = len(model_data_list)
+    nb_features = len(model_data_list[0].explicit_feedback_vector)
+    computation_datetime = utcnow()
+    profiler_profiles = user_profiler.compute_user_profiles(
+        model_data_list, [computation_datetime] * nb_model_data,
+        ActionsOnDocs.make_from_actions([[]] * nb_model_data, nb_features), computation_datetime)
+    return [profiler_profile.feedback_vector for profiler_profile in profiler_profiles]
+
+
+def _get_updated_model_data_list(converter, model_data_origins):
+    """
+    :return: list of UserProfileModelData converted to converter target model, the explicit, positive and negative
+    vectors of all the model data are stacked in a single matrix to be converted at once
+    """
+    nb_model_data = len(model_data_origins)
+    origin_matrix = [model_data.explicit_feedback_vector for model_data in model_data_origins] + \
+                    [model_data.positive_feedback_vector for model_data in model_data_origins] + \
+                    [model_data.negative_feedback_vector for model_data in model_data_origins]
+    target_matrix = converter.compute_target_matrix(origin_matrix)
+    explicit_targets = target_matrix[:nb_model_data]
+    positive_targets = target_matrix[nb_model_data:2 * nb_model_data]
+    negative_targets = target_matrix[2 * nb_model_data:]
+    return [UserProfileModelData(explicit_target, positive_target, negative_target,
+                                 model_data_origin.positive_feedback_sum_coeff,
+                                 model_data_origin.negative_feedback_sum_coeff)
+            for model_data_origin, explicit_target, positive_target, negative_target
+            in zip(model_data_origins, explicit_targets, positive_targets, negative_targets)]
@@ -1,51 +1,106 @@
 # -*- coding: utf-8 -*-
 
+import logging
 from common.datehelper import utcnow
-from learner.userprofiler import UserProfiler, ActionOnDoc
+from learner.userprofiler import UserProfiler, ActionOnDoc, ActionsOnDocs
 import userdocmatch.frontendstructs as struct
 from userdocmatch.dal import Dal
+from .updatemodel import get_migration_converter, filter_users_with_profile
 
+LOGGER = logging.getLogger(__name__)
 
-def update_profiles_in_database(users):
+
+def update_profiles_in_database(users, incremental=False):
     """
     This method update profile in database of all users from their new actions since last model update
+    :param incremental: if True, only profiles of dirty users (users with actions since their last profile update)
+    are updated. Profiles of other users would not change: without new action, the time decay of a profile is the same
+    for its positive and negative parts, so its feature vector is the same.
     """
-    _update_profiles_in_database(users, UserProfiler(), utcnow())
+    _update_profiles_in_database(users, UserProfiler(), utcnow(), incremental)
 
 
-def _update_profiles_in_database(users, profiler, now):
+def _update_profiles_in_database(users, profiler, now, incremental=False, nb_users_by_partition=1000):
     if len(users) == 0:
         return  # no profile to update
     dal = Dal()
-    old_profiles = dal.user_computed_profile.get_user_computed_profiles(users)
-    user_ids = [user.user_id for user in users]
-    actions_by_user = _get_new_actions(dal, user_ids, old_profiles)
-    new_profiles = _build_updated_profiles(profiler, zip(old_profiles, actions_by_user), now)
-    dal.user_computed_profile.save_user_computed_profiles(zip(users, new_profiles))
+    dirty_user_ids = set(dal.user_action.get_dirty_user_ids())
+    if incremental:
+        users = [user for user in users if user.user_id in dirty_user_ids]
+    LOGGER.info(u'update profiles, incremental[%s] nb_users[%s] nb_dirty_users[%s]',
+                incremental, len(users), len(dirty_user_ids))
+    # profiles and docs not migrated yet to the ref model are converted, vectors of a profile and of its actions
+    # must be in the same feature set
+    converter = get_migration_converter(dal)
+    # each partition is independent (profiles and actions of a range of user ids), so memory is bounded by
+    # nb_users_by_partition and partitions could be spread across workers
+    for partition_users in _partition_users(users, nb_users_by_partition):
+        _update_partition_profiles(dal, partition_users, profiler, now, converter)
+    # flags are cleared after profiles are saved, so a user is updated again if the update fails
+    dal.user_action.clear_dirty_users([user.user_id for user in users if user.user_id in dirty_user_ids], now)
+
 
+def _partition_users(users, nb_users_by_partition):
+    """
+    :return: list of lists of at most nb_users_by_partition users, sorted by user_id, so the user ids of a partition
+    are a range disjoint from the ranges of the other partitions
+    """
+    sorted_users = sorted(users, key=lambda user: user.user_id)
+    return [sorted_users[index:index + nb_users_by_partition]
+            for index in range(0, len(sorted_users), nb_users_by_partition)]
 
-def _get_new_actions(dal, user_ids, old_profiles):
-    # min requests date is unique for all users, we need to request all from this date
-    min_datetime_request = min(old_profiles, key=lambda item: item.datetime).datetime
-    return dal.user_action.get_user_actions_on_docs(user_ids, min_datetime_request)
+
+def _update_partition_profiles(dal, users, profiler, now, converter):
+    users, old_profiles = filter_users_with_profile(users, dal.user_computed_profile.get_user_computed_profiles(users))
+    if not users:
+        return
+    old_profiles = converter.convert_profiles(old_profiles)
+    # actions are retrieved until 'now', the new profiles datetime: an action saved later (during the update) is
+    # taken in account by the next update, and only by it
+    start = 0
+    for actions_by_user in dal.user_action.get_actions_by_users(
+            [user.user_id for user in users], [old_profile.datetime for old_profile in old_profiles], now):
+        # actions are yielded by partition of consecutive users, whose profiles are updated before the next one is read
+        end = start + len(actions_by_user)
+        actions_by_user = [converter.convert_actions(actions) for actions in actions_by_user]
+        new_profiles = _build_updated_profiles(profiler, zip(old_profiles[start:end], actions_by_user), now)
+        dal.user_computed_profile.save_user_computed_profiles(zip(users[start:end], new_profiles))
+        start = end
 
 
 def _build_updated_profiles(profiler, old_profile_to_actions_list, now):
-    new_profiles = []
-    for profile, actions in old_profile_to_actions_list:
-        new_profile = _compute_new_user_profile(profiler, profile, actions, now)
-        new_profiles.append(new_profile)
+    # profiles are computed by a single batch for all users of a feature set, whose vectors have the same size
+    feature_set_id_to_indexes = {}
+    for index, (profile, _) in enumerate(old_profile_to_actions_list):
+        feature_set_id_to_indexes.setdefault(profile.feature_vector.feature_set_id, []).append(index)
+    new_profiles = [None] * len(old_profile_to_actions_list)
+    for indexes in feature_set_id_to_indexes.itervalues():
+        batch_new_profiles = _compute_new_user_profiles(
+            profiler, [old_profile_to_actions_list[index] for index in indexes], now)
+        for index, new_profile in zip(indexes, batch_new_profiles):
+            new_profiles[index] = new_profile
     return new_profiles
 
 
-def _compute_new_user_profile(profiler, old_profile, user_actions, now):
-    # as dal request has been done with a global min date, we must filter further for this specific user
-    new_actions = (action for action in user_actions if action.datetime >= old_profile.datetime)
-    actions_profiler_format = (_to_action_in_profiler_format(action) for action in new_actions)
-    new_profile = profiler.compute_user_profile(old_profile.model_data, old_profile.datetime, actions_profiler_format, now)
-    feature_set_id = old_profile.feature_vector.feature_set_id
-    new_feature_vector = struct.FeatureVector(new_profile.feedback_vector, feature_set_id)
-    return struct.UserComputedProfile(new_feature_vector, new_profile.model_data)
+def _compute_new_user_profiles(profiler, old_profile_to_actions_list, now):
+    """
+    :param old_profile_to_actions_list: list of tuples (old profile, actions since the old profile datetime), all old
+    profiles have the same feature set
+    :return: list of new struct.UserComputedProfile
+    """
+    old_profiles = [old_profile for old_profile, _ in old_profile_to_actions_list]
+    new_actions_by_user = [[_to_action_in_profiler_format(action) for action in actions]
+                           for _, actions in old_profile_to_actions_list]
+    nb_features = len(old_profiles[0].model_data.positive_feedback_vector)
+    computed_profiles = profiler.compute_user_profiles(
+        [old_profile.model_data for old_profile in old_profiles], [old_profile.datetime for old_profile in old_profiles],
+        ActionsOnDocs.make_from_actions(new_actions_by_user, nb_features), now)
+    feature_set_id = old_profiles[0].feature_vector.feature_set_id
+    # profile datetime is the datetime until which its actions have been retrieved, and not the save datetime, so an
+    # action saved during the update is taken in account by the next update
+    return [struct.UserComputedProfile(struct.FeatureVector(computed_profile.feedback_vector, feature_set_id),
+                                       computed_profile.model_data, now)
+            for computed_profile in computed_profiles]
 
 
 def _to_action_in_profiler_format(action):
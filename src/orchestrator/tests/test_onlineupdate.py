@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from orchestrator.onlineupdate import OnlineModelUpdater, get_current_model_directory
+
+
+class TopicModellerMock(object):
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, bows):
+        self.updates.append(bows)
+
+    def save(self, directory):
+        with open(os.path.join(directory, 'model'), 'w') as model_file:
+            model_file.write(self.get_model_id())
+
+    def get_model_id(self):
+        return 'model_id_' + str(len(self.updates))
+
+
+class OnlineModelUpdaterTests(unittest.TestCase):
+
+    def test_model_is_updated_and_saved_only_when_enough_docs_are_collected(self):
+        topic_modeller = TopicModellerMock()
+        model_directory = tempfile.mkdtemp()
+        online_updater = OnlineModelUpdater(topic_modeller, model_directory, nb_docs_by_update=3)
+        online_updater.add_bags_of_words([[(0, 2.0), (3, 1.0)], []])
+        self.assertFalse(online_updater.update_model())
+        self.assertEquals([], topic_modeller.updates)
+        self.assertEquals(model_directory, get_current_model_directory(model_directory))
+
+        online_updater.add_bags_of_words([[(5, 1.0)]])
+        self.assertTrue(online_updater.update_model())
+        self.assertEquals([[[(0, 2.0), (3, 1.0)], [], [(5, 1.0)]]], topic_modeller.updates)
+        self._check_current_model(model_directory, 'model_id_1')
+
+        # collected docs are cleared after the update
+        self.assertFalse(online_updater.update_model())
+        self.assertEquals(1, len(topic_modeller.updates))
+
+    def test_each_update_is_saved_as_a_new_version(self):
+        topic_modeller = TopicModellerMock()
+        model_directory = tempfile.mkdtemp()
+        online_updater = OnlineModelUpdater(topic_modeller, model_directory, nb_docs_by_update=1)
+        online_updater.add_bags_of_words([[(0, 1.0)]])
+        online_updater.update_model()
+        first_version_directory = get_current_model_directory(model_directory)
+        online_updater.add_bags_of_words([[(1, 1.0)]])
+        online_updater.update_model()
+
+        self._check_current_model(model_directory, 'model_id_2')
+        # trained model is untouched, previous version is removed
+        self.assertEquals(['online_updates'], os.listdir(model_directory))
+        self.assertFalse(os.path.exists(first_version_directory))
+        self.assertEquals(['current', 'model_id_2'], sorted(os.listdir(os.path.join(model_directory, 'online_updates'))))
+
+    def _check_current_model(self, model_directory, model_id):
+        current_model_directory = get_current_model_directory(model_directory)
+        self.assertEquals(os.path.join(model_directory, 'online_updates', model_id), current_model_directory)
+        with open(os.path.join(current_model_directory, 'model')) as model_file:
+            self.assertEquals(model_id, model_file.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 
 import unittest
 import datetime
+import numpy as np
 from orchestrator.scrap_and_learn import _scrap_and_learn
 from common.datehelper import utcnow
 import scraper.scraper as scraper
@@ -44,13 +45,16 @@ class MockTopicModeller(object):
     feature_vector = [1.0]
 
     @staticmethod
-    def classify(doc_content):
-        if doc_content == u'unclassifiable':
-            return False, None
-        if doc_content == u'doc_content':
-            return True, MockTopicModeller.feature_vector
-        else:
-            raise ValueError(doc_content)
+    def classify_batch(doc_contents):
+        success_mask = np.zeros(len(doc_contents), dtype=bool)
+        topic_matrix = np.zeros((len(doc_contents), len(MockTopicModeller.feature_vector)))
+        for index, doc_content in enumerate(doc_contents):
+            if doc_content == u'doc_content':
+                success_mask[index] = True
+                topic_matrix[index] = MockTopicModeller.feature_vector
+            elif doc_content != u'unclassifiable':
+                raise ValueError(doc_content)
+        return success_mask, topic_matrix
 
 
 class ScrapAndLearnTests(unittest.TestCase):
@@ -70,6 +74,10 @@ class ScrapAndLearnTests(unittest.TestCase):
         user2 = struct.User.make_from_scratch("test_scrap_and_learn_user2", ["interests2"])
         self.dal.user.save_user(user2)
         self._save_dummy_profile_for_user(user2)
+        user_no_profile = struct.User.make_from_scratch("test_scrap_and_learn_user_no_profile", ["interests3"])
+        self.dal.user.save_user(user_no_profile)
+        user_no_profile._user_computed_profile_db_key = self.dal.user._ds_client.key(  # pylint: disable=protected-access
+            u'UserComputedProfile', u'missing-test_scrap_and_learn')  # user without profile is skipped
         # I.2) doc
         doc_old = struct.Document('', 'hash_old', 't', "s", self.dummy_feat_vec)
         doc_old.datetime = utcnow() - datetime.timedelta(days=2, seconds=1)
@@ -85,7 +93,7 @@ class ScrapAndLearnTests(unittest.TestCase):
         # II) Orchestrate
         topic_modeller = MockTopicModeller()
         mock_saver = MockSaver()
-        users = [user1, user2]
+        users = [user1, user2, user_no_profile]
         _scrap_and_learn(MockScraper(), mock_saver, topic_modeller, docs_chunk_size=3,
                          user_docs_max_size=5, seen_url_hashes_set=set(),
                          users=users, nb_docs=6)
@@ -96,13 +104,14 @@ class ScrapAndLearnTests(unittest.TestCase):
         result_user2_docs = result_users_docs[1]
         self.assertEquals(5, len(result_user1_docs))  # 5 because of user_docs_max_size=5
         self.assertEquals(4, len(result_user2_docs))
+        self.assertEquals(0, len(result_users_docs[2]))
         for user_doc in result_user1_docs:
             if user_doc.document.title == 'title1':  # doc1 should have been deleted because grade=0.0
                 self.fail()
         self.assertEquals(4, len(mock_saver.saved_docs))  # MockScraper generate 4 docs
         for doc in mock_saver.saved_docs:
             self.assertEquals(self.ref_feature_set_id, doc.feature_vector.feature_set_id)
-            self.assertEquals(MockTopicModeller.feature_vector, doc.feature_vector.vector)
+            np.testing.assert_array_equal(MockTopicModeller.feature_vector, doc.feature_vector.vector)
             self.assertEquals(MockScraper.default_content, doc.summary)
 
     def _save_dummy_profile_for_user(self, user):
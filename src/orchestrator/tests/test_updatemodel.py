@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import unittest
-from orchestrator.updatemodel import ModelUpdater
+import numpy as np
+from orchestrator.updatemodel import ModelUpdater, get_migration_converter, filter_users_with_profile
 import userdocmatch.frontendstructs as struct
 from userdocmatch.dal import Dal
 
@@ -21,6 +22,13 @@ class MockTopicModel(object):
         ]
 
 
+class ResumableMigrationTopicModel(MockTopicModel):
+
+    @staticmethod
+    def get_model_id():
+        return 'new_model_id_test_update_model_in_db_by_batches'
+
+
 class EmptyTopicModel(object):
 
     @staticmethod
@@ -94,20 +102,71 @@ class ModelUpdaterTests(unittest.TestCase):
         updated_doc = self.dal.doc.get_doc(url_hash)
         self.assertEquals(doc.datetime, updated_doc.datetime)
         self.assertEquals(new_ref_feature_set_id, updated_doc.feature_vector.feature_set_id)
-        self.assertEquals([vec_doc[0] * 2, 0.0], updated_doc.feature_vector.vector)  # because weight on 'word' divided by 2
+        # because weight on 'word' divided by 2
+        np.testing.assert_array_equal([vec_doc[0] * 2, 0.0], updated_doc.feature_vector.vector)
 
         updated_profile = self.dal.user_computed_profile.get_user_computed_profiles([user])[0]
         self.assertEquals(profile.datetime, updated_profile.datetime)
         updated_profile_feat_vec = updated_profile.feature_vector
         self.assertEquals(new_ref_feature_set_id, updated_profile_feat_vec.feature_set_id)
-        self.assertEquals([1.0, 0.0], updated_profile_feat_vec.vector)  # because no weight on 2nd topic and normalized
+        # because no weight on 2nd topic and normalized
+        np.testing.assert_array_equal([1.0, 0.0], updated_profile_feat_vec.vector)
 
         updated_model_data = updated_profile.model_data
         self.assertEquals(pos_sum, updated_model_data.positive_feedback_sum_coeff)
         self.assertEquals(neg_sum, updated_model_data.negative_feedback_sum_coeff)
-        self.assertEquals([explicit[0] * 2, 0.0], updated_model_data.explicit_feedback_vector)
-        self.assertEquals([positive[0] * 2, 0.0], updated_model_data.positive_feedback_vector)
-        self.assertEquals([negative[0] * 2, 0.0], updated_model_data.negative_feedback_vector)
+        np.testing.assert_array_equal([explicit[0] * 2, 0.0], updated_model_data.explicit_feedback_vector)
+        np.testing.assert_array_equal([positive[0] * 2, 0.0], updated_model_data.positive_feedback_vector)
+        np.testing.assert_array_equal([negative[0] * 2, 0.0], updated_model_data.negative_feedback_vector)
+
+    def test_update_model_in_db_by_batches_resume_migration(self):
+        model_id = 'previous_model_id_test_update_model_in_db_by_batches'
+        self.dal.topic_model.save(struct.TopicModelDescription.make_from_scratch(model_id, [[('word', 1.0)]]))
+        feature_set_id = 'feature_set_id_test_update_model_in_db_by_batches'
+        self.dal.feature_set.save_ref_feature_set_id(feature_set_id)
+        self.dal.feature_set.save_feature_set(struct.FeatureSet(feature_set_id, ['feat_name'], model_id))
+        users = []
+        docs = []
+        for index in range(2):
+            user = struct.User.make_from_scratch('user_{}_test_update_model_in_db_by_batches'.format(index), '')
+            self.dal.user.save_user(user)
+            self._get_saved_profile(user, [1.0], feature_set_id, [2.0], [3.0], [4.0], 1.0, 2.0)
+            doc = self._get_saved_doc(feature_set_id, 'hash_{}_test_update_model_in_db_by_batches'.format(index), [0.8])
+            self.dal.user_doc.save_user_docs(user, [struct.UserDocument(doc, 0.0)])
+            users.append(user)
+            docs.append(doc)
+
+        # 1) first call migrates only the first batch
+        topic_model = ResumableMigrationTopicModel()
+        updater = ModelUpdater(nb_users_by_batch=1, max_nb_batches_by_update=1)
+        updater.update_model_in_db(topic_model, users)
+        new_feature_set_id = topic_model.get_model_id()
+        self.assertEquals(new_feature_set_id, self.dal.feature_set.get_ref_feature_set_id())
+        model_migration = self.dal.feature_set.get_model_migration()
+        self.assertEquals(new_feature_set_id, model_migration.target_feature_set_id)
+        self.assertEquals(users[0].user_id, model_migration.last_user_id)
+        self.assertFalse(model_migration.is_done)
+        profiles = self.dal.user_computed_profile.get_user_computed_profiles(users)
+        self.assertEquals([new_feature_set_id, feature_set_id], [profile.feature_vector.feature_set_id
+                                                                 for profile in profiles])
+        self.assertEquals(feature_set_id, self.dal.doc.get_doc(docs[1].url_hash).feature_vector.feature_set_id)
+
+        # 2) readers convert profiles and docs not migrated yet
+        converter = get_migration_converter(self.dal)
+        converted_profile = converter.convert_profiles([profiles[1]])[0]
+        self.assertEquals(new_feature_set_id, converted_profile.feature_vector.feature_set_id)
+        np.testing.assert_array_equal([1.0, 0.0], converted_profile.feature_vector.vector)
+        converted_doc = converter.convert_docs([self.dal.doc.get_doc(docs[1].url_hash)])[0]
+        np.testing.assert_array_equal([1.6, 0.0], converted_doc.feature_vector.vector)
+
+        # 3) second call resumes migration from checkpoint
+        updater.update_model_in_db(topic_model, users)
+        self.assertTrue(self.dal.feature_set.get_model_migration().is_done)
+        profiles = self.dal.user_computed_profile.get_user_computed_profiles(users)
+        self.assertEquals([new_feature_set_id] * 2, [profile.feature_vector.feature_set_id for profile in profiles])
+        self.assertEquals(new_feature_set_id, self.dal.doc.get_doc(docs[1].url_hash).feature_vector.feature_set_id)
+        doc = self.dal.doc.get_doc(docs[1].url_hash)
+        self.assertIs(doc, get_migration_converter(self.dal).convert_docs([doc])[0])
 
     def _get_saved_doc(self, feature_set_id, url_hash, vec_doc):
         feat_vec_doc = struct.FeatureVector(vec_doc, feature_set_id)
@@ -126,5 +185,14 @@ class ModelUpdaterTests(unittest.TestCase):
         return profile
 
 
+class FilterUsersWithProfileTests(unittest.TestCase):
+
+    def test_filter_users_with_profile(self):
+        users = [struct.User.make_from_scratch(user_id, []) for user_id in [u'u1', u'u2', u'u3']]
+        profile_users, profiles = filter_users_with_profile(users, [u'p1', None, u'p3'])
+        self.assertEquals([u'u1', u'u3'], [user.user_id for user in profile_users])
+        self.assertEquals([u'p1', u'p3'], profiles)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from common.datehelper import utcnow
+from learner.userprofiler import UserProfiler
 import userdocmatch.frontendstructs as struct
 from userdocmatch.dal import Dal
-from orchestrator.userprofileupdater import update_profiles_in_database
+from orchestrator.userprofileupdater import update_profiles_in_database, _update_profiles_in_database, _partition_users
 
 
 class UserProfileBuilderTests(unittest.TestCase):
@@ -48,6 +50,78 @@ class UserProfileBuilderTests(unittest.TestCase):
         # user1 profile should prefer doc more thant user2
         self.assertGreater(profiles[0].feature_vector.vector[0], profiles[1].feature_vector.vector[0])
 
+    def test_update_profiles_in_database_incremental_only_update_dirty_users(self):
+        user1 = struct.User.make_from_scratch('user1-test_update_profiles_in_database_incremental', interests=['i1'])
+        user2 = struct.User.make_from_scratch('user2-test_update_profiles_in_database_incremental', interests=['i2'])
+        self.dal.user.save_user(user1)
+        self.dal.user.save_user(user2)
+        feature_set_id = self._build_feature_set()
+        doc = self._build_doc(feature_set_id)
+        self.dal.doc.save_documents([doc])
+        users = [user1, user2]
+        for user in users:
+            self.dal.user_computed_profile.save_user_computed_profile(user, self._build_profile(feature_set_id))
+        update_profiles_in_database(users)  # clear dirty flags of previous tests
+        self.dal.user_action.save_user_action_on_doc(user1.user_id, doc.url_hash, struct.UserActionTypeOnDoc.up_vote)
+        previous_profiles = self.dal.user_computed_profile.get_user_computed_profiles(users)
+
+        update_profiles_in_database(users, incremental=True)
+
+        profiles = self.dal.user_computed_profile.get_user_computed_profiles(users)
+        self.assertLess(previous_profiles[0].datetime, profiles[0].datetime)  # user1 is dirty
+        self.assertEquals(previous_profiles[1].datetime, profiles[1].datetime)
+        self.assertNotIn(user1.user_id, self.dal.user_action.get_dirty_user_ids())
+
+    def test_update_profiles_in_database_take_in_account_action_saved_during_update_once(self):
+        user = struct.User.make_from_scratch('user-test_update_profiles_action_saved_during_update', interests=['i'])
+        self.dal.user.save_user(user)
+        feature_set_id = self._build_feature_set()
+        doc = self._build_doc(feature_set_id)
+        self.dal.doc.save_documents([doc])
+        self.dal.user_computed_profile.save_user_computed_profile(user, self._build_profile(feature_set_id))
+        now = utcnow()
+        # action saved after the datetime of the update, but before its actions query
+        self.dal.user_action.save_user_action_on_doc(user.user_id, doc.url_hash, struct.UserActionTypeOnDoc.up_vote)
+
+        _update_profiles_in_database([user], UserProfiler(), now)
+
+        profile = self.dal.user_computed_profile.get_user_computed_profiles([user])[0]
+        self.assertEquals(0.0, profile.model_data.positive_feedback_sum_coeff)
+        self.assertIn(user.user_id, self.dal.user_action.get_dirty_user_ids())
+
+        update_profiles_in_database([user], incremental=True)
+
+        profile = self.dal.user_computed_profile.get_user_computed_profiles([user])[0]
+        self.assertAlmostEqual(5.0, profile.model_data.positive_feedback_sum_coeff, places=1)  # coeff of a single up vote
+        self.assertNotIn(user.user_id, self.dal.user_action.get_dirty_user_ids())
+
+    def test_update_profiles_in_database_skip_users_without_profile(self):
+        user1 = struct.User.make_from_scratch('user1-test_update_profiles_skip_users_without_profile', interests=['i1'])
+        user2 = struct.User.make_from_scratch('user2-test_update_profiles_skip_users_without_profile', interests=['i2'])
+        self.dal.user.save_user(user1)
+        self.dal.user.save_user(user2)
+        feature_set_id = self._build_feature_set()
+        doc = self._build_doc(feature_set_id)
+        self.dal.doc.save_documents([doc])
+        self.dal.user_computed_profile.save_user_computed_profile(user1, self._build_profile(feature_set_id))
+        user2._user_computed_profile_db_key = self.dal.user._ds_client.key(  # pylint: disable=protected-access
+            u'UserComputedProfile', u'missing-test_update_profiles_skip_users_without_profile')
+        for user in [user1, user2]:
+            self.dal.user_action.save_user_action_on_doc(user.user_id, doc.url_hash, struct.UserActionTypeOnDoc.up_vote)
+        previous_profile1 = self.dal.user_computed_profile.get_user_computed_profiles([user1])[0]
+
+        update_profiles_in_database([user1, user2])
+
+        profiles = self.dal.user_computed_profile.get_user_computed_profiles([user1, user2])
+        self.assertLess(previous_profile1.datetime, profiles[0].datetime)
+        self.assertIsNone(profiles[1])
+
+    def test_partition_users_by_range_of_user_ids(self):
+        users = [struct.User.make_from_scratch(user_id, []) for user_id in [u'd', u'a', u'e', u'c', u'b']]
+        partitions = _partition_users(users, 2)
+        self.assertEquals([[u'a', u'b'], [u'c', u'd'], [u'e']],
+                          [[user.user_id for user in partition] for partition in partitions])
+
     def _build_feature_set(self):
         feature_set_id = 'test_update_user_profiles_in_database'
         self.dal.feature_set.save_feature_set(
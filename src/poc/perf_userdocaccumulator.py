@@ -0,0 +1,53 @@
+
+# pylint: skip-file
+
+import numpy as np
+import numpy.random as npr
+from scipy.sparse import csr_matrix
+import time
+from learner.userdocaccumulator import UserDocumentsAccumulator, UserData
+
+# Throughput (docs/sec) of UserDocumentsAccumulator depending on the number of users
+nb_topics = 512
+nb_docs = 2000
+chunk_size = 50
+user_docs_max_size = 30
+nb_topics_by_doc = 10  # LDA classification has a few non zero topics
+
+
+def build_docs():
+    docs = np.zeros((nb_docs, nb_topics))
+    for doc in docs:
+        doc[npr.choice(nb_topics, nb_topics_by_doc, replace=False)] = npr.rand(nb_topics_by_doc)
+    return docs
+
+
+def build_accumulator(nb_users):
+    user_data_list = [UserData(npr.rand(nb_topics), []) for _ in range(nb_users)]
+    return UserDocumentsAccumulator(user_data_list, user_docs_max_size)
+
+
+npr.seed(0)
+dense_docs = build_docs()
+sparse_docs = csr_matrix(dense_docs)
+
+for nb_users in [100, 1000, 10000]:
+    accumulator = build_accumulator(nb_users)
+
+    t = time.time()
+    for index_doc in range(nb_docs):
+        accumulator.add_doc(index_doc, dense_docs[index_doc])
+    td = time.time() - t
+    print("%d users, add_doc one by one: %d docs/sec" % (nb_users, nb_docs / td))
+
+    t = time.time()
+    for index_doc in range(0, nb_docs, chunk_size):
+        accumulator.add_docs(range(index_doc, index_doc + chunk_size), dense_docs[index_doc:index_doc + chunk_size])
+    td = time.time() - t
+    print("%d users, add_docs by chunk of %d dense docs: %d docs/sec" % (nb_users, chunk_size, nb_docs / td))
+
+    t = time.time()
+    for index_doc in range(0, nb_docs, chunk_size):
+        accumulator.add_docs(range(index_doc, index_doc + chunk_size), sparse_docs[index_doc:index_doc + chunk_size])
+    td = time.time() - t
+    print("%d users, add_docs by chunk of %d sparse docs: %d docs/sec" % (nb_users, chunk_size, nb_docs / td))
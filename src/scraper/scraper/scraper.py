@@ -5,7 +5,12 @@ import os
 import socket
 import ssl
 import logging
+import threading
 import urlparse
+import Queue
+from collections import deque
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import cchardet
 import requests
 import lxml
@@ -40,40 +45,95 @@ def _is_valid_link(link_element, invalid_paths_regex, invalid_extensions):
     return True
 
 
+class ConnectionStats(object):
+
+    def __init__(self, nb_requests, nb_connections):
+        """
+        :param nb_requests: number of http requests sent
+        :param nb_connections: number of connections opened (each one costing a TCP and possibly a TLS handshake)
+        """
+        self.nb_requests = nb_requests
+        self.nb_connections = nb_connections
+        self.nb_handshakes_avoided = nb_requests - nb_connections
+
+
+class _KeepAliveHttpAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter keeping a pool of keep-alive connections by host, and counting connections opened against requests sent
+    """
+
+    def __init__(self, nb_pooled_hosts, pool_size_by_host):
+        """
+        :param nb_pooled_hosts: number of hosts whose pools are kept, least recently used pools are closed above
+        :param pool_size_by_host: max number of idle connections kept by host
+        """
+        self._stats_lock = threading.Lock()
+        self._closed_pools_nb_requests = 0
+        self._closed_pools_nb_connections = 0
+        super(_KeepAliveHttpAdapter, self).__init__(pool_connections=nb_pooled_hosts, pool_maxsize=pool_size_by_host)
+
+    def init_poolmanager(self, connections, maxsize, block=requests.adapters.DEFAULT_POOLBLOCK, **pool_kwargs):
+        super(_KeepAliveHttpAdapter, self).init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        # keep counters of the pools evicted from the least recently used container before they are closed
+        self.poolmanager.pools.dispose_func = self._dispose_pool
+
+    def _dispose_pool(self, pool):
+        with self._stats_lock:
+            self._closed_pools_nb_requests += pool.num_requests
+            self._closed_pools_nb_connections += pool.num_connections
+        pool.close()
+
+    def get_stats(self):
+        """
+        :return: ConnectionStats since the creation of the adapter
+        """
+        with self._stats_lock:
+            nb_requests = self._closed_pools_nb_requests
+            nb_connections = self._closed_pools_nb_connections
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:  # could have been evicted by another thread
+                nb_requests += pool.num_requests
+                nb_connections += pool.num_connections
+        return ConnectionStats(nb_requests, nb_connections)
+
+
 class _HtmlExtractor(object):
 
-    def __init__(self):
-        # set field instead of direct static call to be able to mock/override imported 'requests' module in some tests
-        self._requests = requests
+    _max_size = 1000000
+
+    def __init__(self, nb_pooled_hosts=100, pool_size_by_host=2, single_request=False):
+        """
+        :param nb_pooled_hosts: number of hosts whose keep-alive connections are kept
+        :param pool_size_by_host: max number of keep-alive connections by host, should be at least the number of
+        concurrent requests by host
+        :param single_request: if True, html is fetched by a single streamed GET whose body is read only if headers are
+        valid, else by a HEAD to check headers followed by a GET
+        """
+        self._http_adapter = _KeepAliveHttpAdapter(nb_pooled_hosts, pool_size_by_host)
+        session = requests.Session()  # thread safe as long as session state (headers, cookies...) is not modified
+        session.mount('http://', self._http_adapter)
+        session.mount('https://', self._http_adapter)
+        # set field instead of direct static call to be able to mock/override the 'requests' session in some tests
+        self._requests = session
+        self._single_request = single_request
 
-    def try_get_html(self, url):  # pylint: disable=too-many-return-statements
+    def get_connection_stats(self):
+        """
+        :return: ConnectionStats of the requests done by the extractor, HEAD and GET of the same url share connection
+        """
+        return self._http_adapter.get_stats()
+
+    def close(self):
+        self._http_adapter.close()
+
+    def try_get_html(self, url):
         try:
             LOGGER.debug('get html from url[%s]', url)
-            head_response = self._requests.head(url, timeout=0.5)
-            if "Content-Type" not in head_response.headers:
-                LOGGER.info('filtered: missing Content-Type header, url:%s', url)
-                return None
-            if not "text/html" in head_response.headers["Content-Type"]:
-                LOGGER.info('filtered: not html, url:%s', url)
-                return None
-            data = self._requests.get(url, timeout=2)  # make the http request
-            header_encoding = data.encoding
-            if not header_encoding:
-                LOGGER.info('filtered: no header encoding, url:%s', url)
-                return None
-            # cchardet way faster than data.apparent_encoding
-            # https://github.com/kennethreitz/requests/issues/2359
-            guessed_encoding = cchardet.detect(data.content)['encoding'].lower()
-            if guessed_encoding is None or header_encoding.lower() != guessed_encoding:
-                LOGGER.info(
-                    'filtered: guessed encoding %s different from header encoding %s, url:%s',
-                    guessed_encoding, header_encoding, url)
-                return None
-            data.content.decode(guessed_encoding)  # check we can get unicode object from raw data (could raise exception)
-            if not self._is_size_reasonable(data.text):
-                LOGGER.info('filtered: size too big, url:%s', url)
-                return None
-            return data.text
+            if self._single_request:
+                return self._get_html_by_streamed_get(url)
+            return self._get_html_by_head_then_get(url)
         except (
                 ssl.SSLError,
                 socket.timeout,
@@ -87,9 +147,84 @@ class _HtmlExtractor(object):
             LOGGER.exception('unexpected exception, url[%s]', url)
             return None
 
+    def _get_html_by_head_then_get(self, url):
+        head_response = self._requests.head(url, timeout=0.5)
+        if not self._is_html(url, head_response.headers):
+            return None
+        data = self._requests.get(url, timeout=2)  # make the http request
+        if not self._is_encoding_valid(url, data.encoding, data.content):
+            return None
+        if not self._is_size_reasonable(data.text):
+            LOGGER.info('filtered: size too big, url:%s', url)
+            return None
+        return data.text
+
+    def _get_html_by_streamed_get(self, url):
+        # with stream=True, only headers are read when get returns, body is downloaded only if needed
+        response = self._requests.get(url, timeout=2, stream=True)
+        try:
+            if not self._is_html(url, response.headers):
+                return None
+            content = self._try_read_content(response)
+            if content is None:
+                LOGGER.info('filtered: size too big, url:%s', url)
+                return None
+            if not self._is_encoding_valid(url, response.encoding, content):
+                return None
+            text = unicode(content, response.encoding, errors='replace')  # same decoding as requests Response.text
+            if not self._is_size_reasonable(text):
+                LOGGER.info('filtered: size too big, url:%s', url)
+                return None
+            return text
+        finally:
+            response.close()  # release the connection to the pool, closing it if the body has not been fully read
+
+    def _try_read_content(self, response):
+        """
+        :return: raw body of the response, None if it is bigger than _max_size bytes. As a character is encoded on at
+        least one byte, this is a bit stricter than _is_size_reasonable on non ascii pages
+        """
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit() and int(content_length) >= self._max_size:
+            return None  # abort before downloading the body
+        chunks = []
+        nb_bytes = 0
+        for chunk in response.iter_content(chunk_size=65536):
+            nb_bytes += len(chunk)
+            if nb_bytes >= self._max_size:
+                return None
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    @staticmethod
+    def _is_html(url, headers):
+        if "Content-Type" not in headers:
+            LOGGER.info('filtered: missing Content-Type header, url:%s', url)
+            return False
+        if not "text/html" in headers["Content-Type"]:
+            LOGGER.info('filtered: not html, url:%s', url)
+            return False
+        return True
+
+    @staticmethod
+    def _is_encoding_valid(url, header_encoding, content):
+        if not header_encoding:
+            LOGGER.info('filtered: no header encoding, url:%s', url)
+            return False
+        # cchardet way faster than data.apparent_encoding
+        # https://github.com/kennethreitz/requests/issues/2359
+        guessed_encoding = cchardet.detect(content)['encoding'].lower()
+        if guessed_encoding is None or header_encoding.lower() != guessed_encoding:
+            LOGGER.info(
+                'filtered: guessed encoding %s different from header encoding %s, url:%s',
+                guessed_encoding, header_encoding, url)
+            return False
+        content.decode(guessed_encoding)  # check we can get unicode object from raw data (could raise exception)
+        return True
+
     @classmethod
     def _is_size_reasonable(cls, text):
-        return len(text) < 1000000
+        return len(text) < cls._max_size
 
 
 def _get_invalid_regex():
@@ -106,25 +241,223 @@ def _get_invalid_regex():
     return invalid_paths_regex
 
 
-def _scrap(disconnected):
+class _HostThrottler(object):
+    """
+    Limit the number of concurrent requests on a same host, so that links of a reddit page pointing to the same news site
+    do not hammer it. Thread safe.
+    """
+
+    def __init__(self, max_requests_by_host):
+        self._max_requests_by_host = max_requests_by_host
+        self._condition = threading.Condition()
+        self._host_to_nb_requests = {}  # only hosts with requests in flight, so it does not grow with scraping duration
+
+    def acquire(self, host):
+        with self._condition:
+            while self._host_to_nb_requests.get(host, 0) >= self._max_requests_by_host:
+                self._condition.wait()
+            self._host_to_nb_requests[host] = self._host_to_nb_requests.get(host, 0) + 1
+
+    def release(self, host):
+        with self._condition:
+            nb_requests = self._host_to_nb_requests[host] - 1
+            if nb_requests == 0:
+                del self._host_to_nb_requests[host]
+            else:
+                self._host_to_nb_requests[host] = nb_requests
+            self._condition.notify_all()
+
+
+def _imap_bounded(pool, func, args_iterable, max_pending, ordered=True):
+    """
+    Lazy version of pool.imap: Pool.imap consumes the whole input iterable in a background thread, it would pull all the
+    links of the reddit generator up front. Here at most max_pending tasks are submitted ahead of the consumer.
+    :param pool: multiprocessing pool
+    :param func: function applied to each element
+    :param args_iterable: iterable of tuples, arguments of func, consumed lazily
+    :param max_pending: max number of tasks submitted and not yet yielded
+    :param ordered: if True results are yielded in the order of args_iterable, else as soon as they are ready
+    :return: generator of func results
+    """
+    results = _OrderedResults(pool, func) if ordered else _ReadyResults(pool, func)
+    for args in args_iterable:
+        results.submit(args)
+        if results.nb_pending == max_pending:
+            yield results.pop()
+    while results.nb_pending:
+        yield results.pop()
+
+
+class _OrderedResults(object):
+    """
+    Results of the tasks submitted to a pool, popped in the order of submission
+    """
+
+    def __init__(self, pool, func):
+        self._pool = pool
+        self._func = func
+        self._pending = deque()
+
+    @property
+    def nb_pending(self):
+        return len(self._pending)
+
+    def submit(self, args):
+        self._pending.append(self._pool.apply_async(self._func, args))
+
+    def pop(self):
+        return self._pending.popleft().get()
+
+
+class _ReadyResults(object):
+    """
+    Results of the tasks submitted to a pool, popped as soon as they are ready: apply_async callback of each task puts its
+    result in a queue. py2 callback is not called on exceptions, so tasks catch them to re-raise them when their result is
+    popped, as Pool.imap does
+    """
+
+    def __init__(self, pool, func):
+        self._pool = pool
+        self._func = func
+        self._ready = Queue.Queue()
+        self.nb_pending = 0
+
+    def submit(self, args):
+        self._pool.apply_async(_call_catching_exception, (self._func, args), callback=self._ready.put)
+        self.nb_pending += 1
+
+    def pop(self):
+        succeeded, result = self._ready.get()
+        self.nb_pending -= 1
+        if not succeeded:
+            raise result
+        return result
+
+
+def _call_catching_exception(func, args):
+    """
+    :return: tuple (True, result of func) or (False, exception raised by func)
+    """
+    try:
+        return True, func(*args)
+    except Exception as exception:  # pylint: disable=broad-except
+        return False, exception
+
+
+class _ConcurrentHtmlFetcher(object):
+    """
+    Fetch html of links with a pool of threads: most of the time of a request is spent waiting on the socket
+    """
+
+    def __init__(self, html_extractor, max_concurrent_requests, max_concurrent_requests_by_host):
+        """
+        :param html_extractor: _HtmlExtractor, must be thread safe
+        :param max_concurrent_requests: max number of requests in flight, if 1 requests are done in the calling thread
+        :param max_concurrent_requests_by_host: max number of requests in flight on the same host
+        """
+        self._html_extractor = html_extractor
+        self._max_concurrent_requests = max_concurrent_requests
+        self._host_throttler = _HostThrottler(max_concurrent_requests_by_host)
+
+    def fetch(self, link_elts):
+        """
+        :param link_elts: iterable of reddit.LinkElement, consumed lazily
+        :return: generator of tuples (link_elt, html) in the order of link_elts, html is None if extraction failed
+        """
+        if self._max_concurrent_requests == 1:
+            for link_elt in link_elts:
+                yield self._fetch_html(link_elt)
+            return
+        pool = ThreadPool(self._max_concurrent_requests)
+        try:
+            args_iterable = ((link_elt,) for link_elt in link_elts)
+            for link_elt_and_html in _imap_bounded(pool, self._fetch_html, args_iterable, self._max_concurrent_requests):
+                yield link_elt_and_html
+        finally:
+            # called when the consumer stops iterating: drop queued requests, in flight ones end with their timeout
+            pool.terminate()
+
+    def _fetch_html(self, link_elt):
+        host = urlparse.urlparse(link_elt.url).netloc
+        self._host_throttler.acquire(host)
+        try:
+            return link_elt, self._html_extractor.try_get_html(link_elt.url)
+        finally:
+            self._host_throttler.release(host)
+
+
+def _scrap(disconnected, max_concurrent_requests, max_concurrent_requests_by_host, document_extractor):
+    if disconnected:
+        # vcrpy is not thread safe (it temporarily restores real connections while replaying a request), so requests
+        # must not be concurrent with each other or with the reddit requests done in the calling thread
+        max_concurrent_requests = 1
+    # vcr cassettes have been recorded with HEAD then GET requests
+    single_request = not disconnected
     invalid_paths_regex = _get_invalid_regex()
     invalid_extensions = ['.jpg', '.gif', '.png', '.webm', '.zip']
     links_elts = reddit_link_elements_generator(disconnected)
     filtered_links = (link for link in links_elts if _is_valid_link(link, invalid_paths_regex, invalid_extensions))
-    docs = _get_doc_generator(filtered_links)
+    docs = _get_doc_generator(filtered_links, max_concurrent_requests, max_concurrent_requests_by_host, single_request,
+                              document_extractor)
     return docs
 
 
-def _get_doc_generator(link_elts):
-    html_extractor = _HtmlExtractor()
-    for link_elt in link_elts:
-        html = html_extractor.try_get_html(link_elt.url)
-        if html is None:
-            continue
-        doc = _try_get_document(link_elt.url, html)
-        if doc is None:
-            continue
-        yield doc
+def _get_doc_generator(  # pylint: disable=too-many-arguments
+        link_elts, max_concurrent_requests=1, max_concurrent_requests_by_host=1, single_request=False,
+        document_extractor=None):
+    """
+    :param document_extractor: _DocumentExtractor, None to extract documents in the calling process
+    """
+    html_extractor = _HtmlExtractor(pool_size_by_host=max_concurrent_requests_by_host, single_request=single_request)
+    html_fetcher = _ConcurrentHtmlFetcher(html_extractor, max_concurrent_requests, max_concurrent_requests_by_host)
+    if document_extractor is None:
+        document_extractor = _DocumentExtractor(nb_processes=0, ordered=True)
+    try:
+        url_htmls = ((link_elt.url, html) for link_elt, html in html_fetcher.fetch(link_elts) if html is not None)
+        for doc in document_extractor.extract(url_htmls):
+            if doc is None:
+                continue
+            yield doc
+    finally:
+        stats = html_extractor.get_connection_stats()
+        LOGGER.info(u'html extraction connections: nb_requests[%s], nb_connections[%s], nb_handshakes_avoided[%s]',
+                    stats.nb_requests, stats.nb_connections, stats.nb_handshakes_avoided)
+        html_extractor.close()
+
+
+class _DocumentExtractor(object):
+    """
+    Extract Documents from raw html. Extraction (readability, lxml) is CPU bound so it can be spread on a pool of processes
+    """
+
+    def __init__(self, nb_processes, ordered):
+        """
+        :param nb_processes: size of the pool of processes, if 0 extraction is done in the calling process. The pool is
+        forked here and reused by each extraction, so the extractor must be created before the other threads of the
+        process: a forked process only gets the forking thread, locks held by other threads would stay locked in it
+        :param ordered: if True documents are yielded in the order of input html, else as soon as they are extracted
+        """
+        self._pool = multiprocessing.Pool(nb_processes) if nb_processes > 0 else None
+        # back-pressure: fetch stage is not pulled further while two html by process are waiting to be extracted
+        self._max_pending = 2 * nb_processes
+        self._ordered = ordered
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+
+    def extract(self, url_htmls):
+        """
+        :param url_htmls: iterable of tuples (url, html), consumed lazily
+        :return: generator of Document, None for html without valid document
+        """
+        if self._pool is None:
+            for url, html in url_htmls:
+                yield _try_get_document(url, html)
+            return
+        # if the consumer stops iterating, extractions in flight end in the pool and their results are dropped
+        for doc in _imap_bounded(self._pool, _try_get_document, url_htmls, self._max_pending, self._ordered):
+            yield doc
 
 
 def _try_get_document(url, html):
@@ -139,11 +472,32 @@ def _try_get_document(url, html):
 
 class Scraper(object):
 
-    def __init__(self, disconnected=False):
+    def __init__(self, disconnected=False, max_concurrent_requests=16, max_concurrent_requests_by_host=2,
+                 nb_extraction_processes=None):
+        """
+        :param disconnected: True if requests are replayed from a vcr cassette
+        :param max_concurrent_requests: max number of html requests in flight
+        :param max_concurrent_requests_by_host: max number of html requests in flight on the same host
+        :param nb_extraction_processes: number of processes extracting documents from html, forked once by the scraper,
+        so it must be created at the start of the process, before other threads. If None, number of cores, or 0
+        (extraction in the calling process) if disconnected, as disconnected scraping is used by tests
+        """
         self.disconnected = disconnected
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_concurrent_requests_by_host = max_concurrent_requests_by_host
+        if nb_extraction_processes is None:
+            nb_extraction_processes = 0 if disconnected else multiprocessing.cpu_count()
+        self._document_extractor = _DocumentExtractor(nb_extraction_processes, ordered=False)
+
+    def close(self):
+        """
+        Terminate the processes extracting documents
+        """
+        self._document_extractor.close()
 
     def scrap(self):
         """
         :return: generator of scraperstructs.Document
         """
-        return _scrap(self.disconnected)
+        return _scrap(self.disconnected, self.max_concurrent_requests, self.max_concurrent_requests_by_host,
+                      self._document_extractor)
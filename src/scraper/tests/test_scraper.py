@@ -3,12 +3,16 @@
 
 import logging
 import re
+import threading
+import BaseHTTPServer
+import time
 import unittest
 import os
 from collections import namedtuple
 import vcr
+from readability.readability import Unparseable
 from scraper.scraper import Document, _is_valid_link, _get_invalid_regex, _get_doc_generator, _HtmlExtractor,\
-    _try_get_document
+    _try_get_document, _ConcurrentHtmlFetcher, _DocumentExtractor, Scraper
 from scraper.reddit import LinkElement
 
 
@@ -176,5 +180,186 @@ class ScraperTests(unittest.TestCase):
         url = u'url_test_try_get_document_valid_input'
         self.assertIsNone(_try_get_document(url, html_doc))
 
+    def test_html_extractor_single_request_read_body_only_if_needed(self):
+        html_doc = '<html><head><title>title</title></head><body>content</body></html>'
+
+        class StreamedResponseMock(object):
+
+            def __init__(self, headers, content):
+                self.headers = headers
+                self.encoding = 'ascii'
+                self._content = content
+                self.is_body_read = False
+                self.is_closed = False
+
+            def iter_content(self, chunk_size):
+                self.is_body_read = True
+                for index in range(0, len(self._content), chunk_size):
+                    yield self._content[index:index + chunk_size]
+
+            def close(self):
+                self.is_closed = True
+
+        url_to_response = {
+            'ok_url': StreamedResponseMock({'Content-Type': 'text/html'}, html_doc),
+            'not_html_url': StreamedResponseMock({'Content-Type': 'image/png'}, html_doc),
+            'declared_too_long_url': StreamedResponseMock(
+                {'Content-Type': 'text/html', 'Content-Length': '1000000'}, html_doc),
+            'too_long_url': StreamedResponseMock({'Content-Type': 'text/html'}, 'a' * 1000000),
+        }
+
+        class RequestsStreamMock(object):
+
+            @staticmethod
+            def get(url, timeout, stream):  # pylint: disable=unused-argument
+                self.assertTrue(stream)
+                return url_to_response[url]
+
+        html_extractor = _HtmlExtractor(single_request=True)
+        html_extractor._requests = RequestsStreamMock()  # set mock requests lib
+
+        html = html_extractor.try_get_html('ok_url')
+        self.assertEquals(unicode(html_doc), html)
+        self.assertIsInstance(html, unicode)
+        self.assertIsNone(html_extractor.try_get_html('not_html_url'))
+        self.assertFalse(url_to_response['not_html_url'].is_body_read)
+        self.assertIsNone(html_extractor.try_get_html('declared_too_long_url'))
+        self.assertFalse(url_to_response['declared_too_long_url'].is_body_read)
+        self.assertIsNone(html_extractor.try_get_html('too_long_url'))
+        self.assertTrue(all(response.is_closed for response in url_to_response.itervalues()))
+
+    def test_html_extractor_reuse_connections(self):
+
+        class HtmlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            html = '<html><head><title>title</title></head><body>content</body></html>'
+
+            def do_HEAD(self):  # pylint: disable=invalid-name
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=ascii')
+                self.send_header('Content-Length', str(len(self.html)))
+                self.end_headers()
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                self.do_HEAD()
+                self.wfile.write(self.html)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('localhost', 0), HtmlHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        try:
+            html_extractor = _HtmlExtractor()
+            url = 'http://localhost:' + str(server.server_port) + '/page'
+            self.assertIsNotNone(html_extractor.try_get_html(url))
+            self.assertIsNotNone(html_extractor.try_get_html(url + '2'))
+            stats = html_extractor.get_connection_stats()
+            html_extractor.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEquals(4, stats.nb_requests)  # HEAD and GET by url
+        self.assertEquals(1, stats.nb_connections)
+        self.assertEquals(3, stats.nb_handshakes_avoided)
+
+
+class ConcurrentHtmlFetcherTests(unittest.TestCase):
+
+    class MockHtmlExtractor(object):
+
+        def __init__(self):
+            self._lock = threading.Lock()
+            self.host_to_nb_requests = {}
+            self.max_nb_requests_by_host = 0
+
+        def try_get_html(self, url):
+            host = url.split('/')[2]
+            with self._lock:
+                nb_requests = self.host_to_nb_requests.get(host, 0) + 1
+                self.host_to_nb_requests[host] = nb_requests
+                self.max_nb_requests_by_host = max(self.max_nb_requests_by_host, nb_requests)
+            time.sleep(0.01)  # let other threads start their requests
+            with self._lock:
+                self.host_to_nb_requests[host] -= 1
+            return None if url.endswith('ko') else u'html_' + url
+
+    def test_fetch_keep_order_and_limit_requests_by_host(self):
+        urls = ['http://host' + str(i % 3) + '/page' + str(i) + ('ko' if i % 4 == 0 else '') for i in range(30)]
+        links = [LinkElement(url, None, None, None) for url in urls]
+        html_extractor = self.MockHtmlExtractor()
+        fetcher = _ConcurrentHtmlFetcher(html_extractor, max_concurrent_requests=8, max_concurrent_requests_by_host=2)
+
+        results = list(fetcher.fetch(links))
+
+        self.assertEquals(urls, [link.url for link, _ in results])
+        for link, html in results:
+            expected_html = None if link.url.endswith('ko') else u'html_' + link.url
+            self.assertEquals(expected_html, html)
+        self.assertEquals(2, html_extractor.max_nb_requests_by_host)
+
+    def test_fetch_consume_links_lazily(self):
+        nb_consumed_links = [0]
+
+        def links_generator():
+            for i in range(100):
+                nb_consumed_links[0] += 1
+                yield LinkElement('http://host' + str(i) + '/page', None, None, None)
+
+        fetcher = _ConcurrentHtmlFetcher(self.MockHtmlExtractor(), max_concurrent_requests=4,
+                                         max_concurrent_requests_by_host=1)
+        results = fetcher.fetch(links_generator())
+        next(results)
+        self.assertEquals(4, nb_consumed_links[0])  # only the requests in flight have been pulled from input
+        results.close()
+
+
+class DocumentExtractorTests(unittest.TestCase):
+
+    @staticmethod
+    def _make_url_htmls():
+        html_template = u'<html><head><title>{0}</title></head><body>content of {0}</body></html>'
+        url_htmls = [(u'url' + str(i), html_template.format(u'title' + str(i))) for i in range(20)]
+        url_htmls[5] = (u'url5', html_template.format(u''))  # no title, no document
+        return url_htmls
+
+    def test_extract_with_processes_ordered_return_same_docs_as_inline(self):
+        url_htmls = self._make_url_htmls()
+        inline_docs = list(_DocumentExtractor(nb_processes=0, ordered=True).extract(url_htmls))
+        document_extractor = _DocumentExtractor(nb_processes=2, ordered=True)
+        self.addCleanup(document_extractor.close)
+        pool_docs = list(document_extractor.extract(iter(url_htmls)))
+
+        self.assertIsNone(inline_docs[5])
+        self.assertIsNone(pool_docs[5])
+        self.assertEquals([(doc.url, doc.title, doc.content) for doc in inline_docs if doc is not None],
+                          [(doc.url, doc.title, doc.content) for doc in pool_docs if doc is not None])
+
+    def test_extract_with_processes_unordered_return_all_docs(self):
+        url_htmls = self._make_url_htmls()
+        document_extractor = _DocumentExtractor(nb_processes=2, ordered=False)
+        self.addCleanup(document_extractor.close)
+        expected_urls = set(url for url, _ in url_htmls if url != u'url5')
+
+        # pool is reused by each extraction
+        for _ in range(2):
+            pool_docs = list(document_extractor.extract(iter(url_htmls)))
+            self.assertEquals(len(url_htmls), len(pool_docs))
+            self.assertEquals(expected_urls, set(doc.url for doc in pool_docs if doc is not None))
+
+    def test_extract_with_processes_unordered_raise_extraction_exception(self):
+        document_extractor = _DocumentExtractor(nb_processes=2, ordered=False)
+        self.addCleanup(document_extractor.close)
+        self.assertRaises(Unparseable, list, document_extractor.extract(iter([(u'url', None)])))
+
+    def test_disconnected_scraper_extract_in_calling_process(self):
+        scraper = Scraper(disconnected=True)
+        self.addCleanup(scraper.close)
+        self.assertIsNone(scraper._document_extractor._pool)  # pylint: disable=protected-access
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,7 +6,7 @@ import logging
 from flask import Flask
 from common.log import init_gcloud_log
 from common.environment import IS_DEV_ENV, GCLOUD_PROJECT
-from server.handlers import handlers
+from server.handlers import handlers, USER_DOC_MATCHER
 from server.reactapp import react
 from server.api import api_blueprint
 
@@ -28,6 +28,8 @@ APP.register_blueprint(handlers)
 APP.register_blueprint(react)
 APP.register_blueprint(api_blueprint)
 APP.secret_key = 'maybe_we_should_generate_a_random_key'
+# each gunicorn worker imports this module, the first one saves the model artifacts that the others memory-map
+USER_DOC_MATCHER.warm_up()
 
 
 if __name__ == '__main__':
@@ -1,8 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import gzip
+import io
+import os
 import unittest
-from topicmodeller.doctokenizer import _filter_latin_words, _remove_stop_words, _word_tokenize, DocTokenizer
+from collections import Counter
+import nltk
+import yaml
+from scraper.scraper import _try_get_document
+from topicmodeller.doctokenizer import _fast_tokenize, _filter_latin_words, _remove_stop_words, _word_tokenize, \
+    DocTokenizer
+
+SENTENCES_SAMPLE = [
+    u"\"BattleBots\" producers are definitely looking forward and feeling confident that ABC will renew the series "
+    u"for a second season (seventh if you count the five seasons it ran on Comedy Central from 2000 to 2002).",
+    u"And they've definitely given some thought as to what they'd like to do similarly and what they'd like to change up.",
+    u"Apple's new iPhone isn't cheap: it costs $1,000 in the U.S., but I'm sure it'll sell; won't it?",
+    u"The state-of-the-art model (trained on 10,000 docs) scored 95% -- a 2nd place, said O'Brien's team.",
+    u"'I don't know,' she said, 'we cannot wait... we're gonna miss the 3:30 train!'",
+    u"Users' feedback [see below] is {mostly} positive <sic>; read more @ example.com #ai & others.",
+    u"\u201cIt\u2019s over,\u201d the coach said \u2018quietly\u2019 in the caf\xe9 \xabtoday\xbb.",
+    u"Wait... what?! The deal -- worth $3.5bn -- was signed at 9:00 by AT&T and `IBM`.",
+]
+
+
+def _load_cassettes_documents():
+    """
+    :return: list of the contents of the documents extracted by the scraper from the html pages of its test cassettes
+    """
+    cassettes_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scraper', 'tests',
+                                    'vcr_cassettes')
+    contents = []
+    for cassette_file_name in sorted(os.listdir(cassettes_folder)):
+        with open(os.path.join(cassettes_folder, cassette_file_name)) as cassette_file:
+            interactions = yaml.load(cassette_file)['interactions']
+        for interaction in interactions:
+            headers = {name.lower(): u' '.join(values) for name, values in interaction['response']['headers'].items()}
+            body = interaction['response']['body']['string']
+            if 'html' not in headers.get('content-type', u'') or not body.strip():
+                continue
+            if isinstance(body, str):  # binary body, possibly compressed
+                if 'gzip' in headers.get('content-encoding', u''):
+                    body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+                body = body.decode('utf-8', 'replace')
+            document = _try_get_document(interaction['request']['uri'], body)
+            if document is not None:
+                contents.append(document.content)
+    return contents
 
 
 class DocTokenizerTests(unittest.TestCase):
@@ -49,6 +94,33 @@ class DocTokenizerTests(unittest.TestCase):
         self.assertTrue('tokenizer' in tokenized)
         self.assertTrue(word.lower() == word for word in tokenized)  # lower cases
 
+    def test_fast_tokenize_is_consistent_with_nltk_word_tokenize(self):
+        for sentence in SENTENCES_SAMPLE:
+            nltk_tokens = _filter_latin_words([word.lower() for word in nltk.word_tokenize(sentence, preserve_line=True)])
+            self.assertEquals(nltk_tokens, _fast_tokenize(sentence, frozenset()))
+
+    def test_fast_tokenize_remove_stop_words(self):
+        tokens = _fast_tokenize(u'This is raw text, it CANNOT be cooked.', frozenset([u'this', u'is', u'it', u'not']))
+        self.assertEquals([u'raw', u'text', u'can', u'be', u'cooked'], tokens)
+
+    def test_tokenize_fast_is_consistent_with_tokenize(self):
+        document = u' '.join(SENTENCES_SAMPLE)
+        self.assertEquals(DocTokenizer().tokenize(document), DocTokenizer(fast=True).tokenize(document))
+        self.assertNotEquals(DocTokenizer().config_id, DocTokenizer(fast=True).config_id)
+
+    def test_tokenize_fast_is_consistent_with_tokenize_on_scraped_documents(self):
+        contents = _load_cassettes_documents()
+        self.assertTrue(len(contents) > 10)
+        nb_tokens = 0
+        nb_common_tokens = 0
+        for content in contents:
+            tokens = Counter(DocTokenizer().tokenize(content))
+            fast_tokens = Counter(DocTokenizer(fast=True).tokenize(content))
+            nb_tokens += max(sum(tokens.values()), sum(fast_tokens.values()))
+            nb_common_tokens += sum((tokens & fast_tokens).values())
+        # tokens only differ on sentence boundaries not split the same way (cf. _LATIN_WORDS_REGEX)
+        self.assertTrue(nb_common_tokens >= 0.99 * nb_tokens)
+
 
 if __name__ == '__main__':
     unittest.main()
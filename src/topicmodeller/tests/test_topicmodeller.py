@@ -3,14 +3,18 @@
 
 import os
 import random
+import tempfile
 import unittest
 
+import numpy as np
 from topicmodeller.topicmodeller import TopicModeller
+from topicmodeller.doctokenizer import DocTokenizer
 
 
 class TopicModellerTests(unittest.TestCase):
 
     class MockTokenizer(object):
+        config_id = u'mock_tokenizer'
 
         @classmethod
         def tokenize(cls, text):
@@ -68,6 +72,28 @@ class TopicModellerTests(unittest.TestCase):
         for after_init, after_load in zip(classification_after_init_doc1, classification_after_load_doc1):
             self.assertAlmostEqual(after_init, after_load, places=4)
 
+    def test_classify_batch_is_consistent_with_classify(self):
+        doc1 = u'I like orange, i really love orange orange is my favorite color, green sucks'
+        doc2 = u'Green is cool, green is nice, green is swag, orange not so much'
+        topic_modeller = TopicModeller()
+        topic_modeller._tokenizer = self.MockTokenizer()
+        topic_modeller._remove_optimizations = True  # pylint: disable=protected-access
+        topic_modeller.initialize([doc1, doc2], num_topics=2)
+
+        success_mask, topic_matrix = topic_modeller.classify_batch([doc1, doc2, doc1])
+        self.assertEquals([True, True, True], success_mask.tolist())
+        self.assertEquals((3, 2), topic_matrix.shape)
+        for doc, batch_vector in zip([doc1, doc2, doc1], topic_matrix):
+            (classify_ok, vector) = topic_modeller.classify(doc)
+            self.assertTrue(classify_ok)
+            # LDA inference is randomly initialized, so results are only close
+            for value, batch_value in zip(vector, batch_vector):
+                self.assertAlmostEqual(value, batch_value, places=2)
+
+        empty_mask, empty_matrix = topic_modeller.classify_batch([])
+        self.assertEquals(0, len(empty_mask))
+        self.assertEquals((0, 2), empty_matrix.shape)
+
     def test_topic_field(self):
         nb_docs = 5
         nb_words_by_doc = 150
@@ -106,7 +132,126 @@ class TopicModellerTests(unittest.TestCase):
         model_id_after_load = deserialized_topic_modeller.get_model_id()
         self.assertEquals(model_id, model_id_after_load)
 
-    def _build_topic_model(self, nb_docs, nb_topics, nb_words_by_doc, words):
+    def test_load_model_trained_with_other_tokenizer_raises(self):
+        words = ["word" + str(i) for i in range(50)]
+        topic_modeller = self._build_topic_model(3, 2, 20, words)
+        directory = tempfile.mkdtemp()
+        topic_modeller.save(directory)
+        self.assertRaises(ValueError, TopicModeller().load, directory)
+        self.assertRaises(ValueError, TopicModeller(fast_tokenizer=True).load, directory)
+
+        # model saved with the fast tokenizer is loaded by a modeller in the mode given by uses_fast_tokenizer
+        topic_modeller._tokenizer = DocTokenizer(fast=True)
+        topic_modeller.save(directory)
+        self.assertTrue(TopicModeller.uses_fast_tokenizer(directory))
+        self.assertRaises(ValueError, TopicModeller().load, directory)
+        TopicModeller(fast_tokenizer=True).load(directory)
+
+        # model saved without its tokenizer has been trained with nltk tokenizers
+        os.remove(os.path.join(directory, 'model_info.json'))
+        self.assertFalse(TopicModeller.uses_fast_tokenizer(directory))
+        self.assertRaises(ValueError, TopicModeller(fast_tokenizer=True).load, directory)
+        nltk_topic_modeller = TopicModeller()
+        nltk_topic_modeller.load(directory)
+        self.assertEquals(topic_modeller.get_model_id(), nltk_topic_modeller.get_model_id())
+
+    def test_initialize_is_reproducible_and_keep_numpy_random_state(self):
+        words = ["word" + str(i) for i in range(50)]
+        np.random.seed(0)
+        random_value_expected = np.random.rand()
+        np.random.seed(0)
+        topic_modeller = self._build_topic_model(3, 2, 20, words)
+        topic_modeller_same_seed = self._build_topic_model(3, 2, 20, words)
+        self.assertEquals(random_value_expected, np.random.rand())
+        self.assertEquals(topic_modeller.get_topics(), topic_modeller_same_seed.get_topics())
+
+    def test_initialize_with_several_lda_workers(self):
+        nb_topics = 2
+        words = ["word" + str(i) for i in range(50)]
+        topic_modeller = self._build_topic_model(5, nb_topics, 20, words, lda_workers=2)
+        self.assertEquals(nb_topics, len(topic_modeller.get_topics()))
+        (classify_ok, vector) = topic_modeller.classify(' '.join(words))
+        self.assertTrue(classify_ok)
+        self.assertEquals(nb_topics, len(vector))
+
+    def test_initialize_with_corpus_cache_tokenize_docs_once(self):
+        class CountingTokenizer(object):
+            config_id = u'counting_tokenizer'
+            nb_calls = 0
+
+            @classmethod
+            def tokenize(cls, text):
+                cls.nb_calls += 1
+                return text.split()
+
+        random.seed(0)
+        words = ["word" + str(i) for i in range(50)]
+        docs = [' '.join(random.choice(words) for _ in range(20)) for _ in range(5)]
+        corpus_cache_folder = os.path.join(tempfile.mkdtemp(), 'corpus_cache')
+
+        topic_modeller = TopicModeller(corpus_cache_folder=corpus_cache_folder)
+        topic_modeller._tokenizer = CountingTokenizer()
+        topic_modeller._remove_optimizations = True  # pylint: disable=protected-access
+        topic_modeller.initialize(docs, num_topics=2)
+        self.assertEquals(len(docs), CountingTokenizer.nb_calls)  # tokens of dictionary pass are serialized in corpus
+        self.assertFalse([name for name in os.listdir(corpus_cache_folder) if name.endswith('.tmp')])
+
+        # same dictionary and tokenizer: cached corpus is used, model is the same
+        topic_modeller_from_cache = TopicModeller(corpus_cache_folder=corpus_cache_folder)
+        topic_modeller_from_cache._tokenizer = CountingTokenizer()
+        topic_modeller_from_cache._dictionary = topic_modeller._dictionary  # pylint: disable=protected-access
+        topic_modeller_from_cache.initialize_model(docs, num_topics=2)
+        self.assertEquals(len(docs), CountingTokenizer.nb_calls)
+        self.assertEquals(topic_modeller.get_topics(), topic_modeller_from_cache.get_topics())
+
+        # tokenizer changed: corpus is tokenized again
+        CountingTokenizer.config_id = u'counting_tokenizer_v2'
+        topic_modeller_from_cache.initialize_model(docs, num_topics=2)
+        self.assertEquals(2 * len(docs), CountingTokenizer.nb_calls)
+
+        # model is the same as without cache
+        topic_modeller_without_cache = TopicModeller()
+        topic_modeller_without_cache._tokenizer = CountingTokenizer()
+        topic_modeller_without_cache._remove_optimizations = True  # pylint: disable=protected-access
+        topic_modeller_without_cache.initialize(docs, num_topics=2)
+        self.assertEquals(topic_modeller.get_topics(), topic_modeller_without_cache.get_topics())
+
+    def test_classify_bags_of_words_and_update(self):
+        nb_topics = 2
+        words = ["word" + str(i) for i in range(50)]
+        topic_modeller = self._build_topic_model(5, nb_topics, 20, words)
+        docs = [' '.join(words[:25]), ' '.join(words[25:])]
+        bows = topic_modeller.to_bags_of_words(docs)
+        success_mask, topic_matrix = topic_modeller.classify_bags_of_words(bows)
+        batch_success_mask, batch_topic_matrix = topic_modeller.classify_batch(docs)
+        self.assertEquals(batch_success_mask.tolist(), success_mask.tolist())
+        self.assertEquals((2, nb_topics), topic_matrix.shape)
+        self.assertTrue(np.allclose(batch_topic_matrix, topic_matrix, atol=1e-2))
+
+        lambda_before_update = topic_modeller._lda.state.get_lambda().copy()  # pylint: disable=protected-access
+        model_id_before_update = topic_modeller.get_model_id()
+        np.random.seed(0)
+        random_value_expected = np.random.rand()
+        np.random.seed(0)
+        topic_modeller.update(bows)
+        self.assertEquals(random_value_expected, np.random.rand())
+        self.assertFalse(np.allclose(lambda_before_update,
+                                     topic_modeller._lda.state.get_lambda()))  # pylint: disable=protected-access
+        self.assertEquals(nb_topics, len(topic_modeller.get_topics()))
+
+        # each update is a new model, even if the main words of its topics are unchanged
+        model_id_after_update = topic_modeller.get_model_id()
+        self.assertNotEquals(model_id_before_update, model_id_after_update)
+        directory = tempfile.mkdtemp()
+        topic_modeller.save(directory)
+        deserialized_topic_modeller = TopicModeller()
+        deserialized_topic_modeller._tokenizer = self.MockTokenizer()
+        deserialized_topic_modeller.load(directory)
+        self.assertEquals(model_id_after_update, deserialized_topic_modeller.get_model_id())
+        topic_modeller.update(bows)
+        self.assertNotEquals(model_id_after_update, topic_modeller.get_model_id())
+
+    def _build_topic_model(self, nb_docs, nb_topics, nb_words_by_doc, words, lda_workers=1):
         docs = []
         random.seed(0)
         for _ in range(nb_docs):
@@ -114,7 +259,7 @@ class TopicModellerTests(unittest.TestCase):
             for _ in range(nb_words_by_doc):
                 doc += " " + random.choice(words)
             docs.append(doc)
-        topic_modeller = TopicModeller()
+        topic_modeller = TopicModeller(lda_workers=lda_workers)
         topic_modeller._tokenizer = self.MockTokenizer()
         topic_modeller._remove_optimizations = True  # pylint: disable=protected-access
         topic_modeller.initialize(docs, num_topics=nb_topics)
@@ -8,6 +8,42 @@ from common.log import shrink
 
 LOGGER = logging.getLogger(__name__)
 
+# loaded at first use, and not at import, as nltk corpus may be downloaded after import
+_ENGLISH_STOP_WORDS = None
+
+# Fast path: latin words are directly scanned in raw text, with the boundaries of nltk treebank tokens, so the tokens are
+# the same as nltk_word_tokenize followed by latin words filter (cf. test_doctokenizer), except for abbreviations ending
+# a sentence for nltk sentence tokenizer (e.g. 'Mr.' is dropped by nltk path and kept as 'mr' by fast path)
+# typographic quotes always split tokens, other chars split tokens depending on the next char (e.g. ',' and ':' split
+# only if not followed by a digit, '.' only at the end of a sentence), other non blank chars (like ' - . / _ digits,
+# non latin letters) are parts of a token
+_QUOTES = u'\xab“‘„\xbb”’'
+_TOKEN_START = r'''(?:
+    (?<![^\s,;:@#$%&?!()\[\]{}<>"`''' + _QUOTES + r'''])|(?<=--)|(?<=\.\.\.)|(?<='')
+    |(?<=')(?=[a-zA-Z]\b)(?![mMtTsSdD]\b)  # quote before a single letter word, e.g. 'I
+)'''
+_TOKEN_END = r'''(?:
+    \s|$|[;@#$%&?!()\[\]{}<>"`''' + _QUOTES + r''']|''|[,:](?!\d)|--|\.\.\.
+    |\.[\]\)}>"\'''' + _QUOTES + r''']*(?:\s|$)
+)'''
+_LATIN_WORDS_REGEX = re.compile(
+    _TOKEN_START + r'''(?:
+        [a-zA-Z]+?(?=(?:n't|N'T)''' + _TOKEN_END + r''')  # 'don't' is tokenized as 'do' and 'n't'
+        |
+        [a-zA-Z]+(?=(?:'[sSmMdD]|'ll|'LL|'re|'RE|'ve|'VE|')?''' + _TOKEN_END + r''')
+    )''',
+    re.UNICODE | re.VERBOSE)
+# words split by nltk treebank tokenizer, by lowercase word
+_SPLIT_WORDS = {u'cannot': (u'can', u'not'), u'gimme': (u'gim', u'me'), u'gonna': (u'gon', u'na'),
+                u'gotta': (u'got', u'ta'), u'lemme': (u'lem', u'me'), u'wanna': (u'wan', u'na')}
+
+
+def _get_english_stop_words():
+    global _ENGLISH_STOP_WORDS  # pylint: disable=global-statement
+    if _ENGLISH_STOP_WORDS is None:
+        _ENGLISH_STOP_WORDS = frozenset(stopwords.words('english'))
+    return _ENGLISH_STOP_WORDS
+
 
 def _word_tokenize(content):
     word_tokenized = []
@@ -21,7 +57,7 @@ def _clean(words):
 
 
 def _remove_stop_words(words):
-    english_words = set(stopwords.words('english'))  # don't inline call in for loop: (long complex call)
+    english_words = _get_english_stop_words()
     return [word for word in words if word not in english_words]
 
 
@@ -29,13 +65,41 @@ def _filter_latin_words(words):
     return [word for word in words if re.search(r'^[a-zA-Z]*$', word) is not None]
 
 
+def _fast_tokenize(raw_text, stop_words):
+    """
+    Single pass on the latin words of raw_text: each word is lowercased and filtered in the same loop
+    :param stop_words: set of lowercase words to remove
+    """
+    tokens = []
+    for word in _LATIN_WORDS_REGEX.findall(raw_text):
+        word = word.lower()
+        if word in _SPLIT_WORDS:
+            tokens.extend(split_word for split_word in _SPLIT_WORDS[word] if split_word not in stop_words)
+        elif word not in stop_words:
+            tokens.append(word)
+    return tokens
+
+
 class DocTokenizer(object):
 
-    @classmethod
-    def tokenize(cls, raw_text):
-        word_tokenized_document = _word_tokenize(raw_text)
-        lowercase_document = [word.lower() for word in word_tokenized_document]
-        tokens = _clean(lowercase_document)
+    def __init__(self, fast=False):
+        """
+        :param fast: True to scan latin words with a single precompiled regex instead of nltk sentence and word
+        tokenizers, several times faster, with almost the same tokens (cf. _LATIN_WORDS_REGEX)
+        """
+        self._fast = fast
+        # identifies the tokens returned by tokenize, must be changed when they change (to invalidate tokenized corpus
+        # caches)
+        self.config_id = u'latin_words_regex|lowercase|english_stop_words' if fast else \
+            u'nltk_word_tokenize|lowercase|english_stop_words|latin_words'
+
+    def tokenize(self, raw_text):
+        if self._fast:
+            tokens = _fast_tokenize(raw_text, _get_english_stop_words())
+        else:
+            word_tokenized_document = _word_tokenize(raw_text)
+            lowercase_document = [word.lower() for word in word_tokenized_document]
+            tokens = _clean(lowercase_document)
         if LOGGER.isEnabledFor(logging.DEBUG):
             LOGGER.debug(u'html tokenized. tokens[%s], text[%s]',
                          u'|'.join(tokens[:50]), shrink(raw_text))
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 import os
+from contextlib import contextmanager
 import numpy as np
 from gensim import corpora, models
 import common.crypto as crypto
@@ -26,21 +28,36 @@ class _MultiIterator(object):
             yield self.mapper(elt)
 
 
-class TopicModeller(object):
+class TopicModeller(object):  # pylint: disable=too-many-instance-attributes
     # a too big number create a too big entity when saved as model description
     # 30 should be enough to keep relevant info as weight is already very low at 30' word
     _nb_words_by_topic = 30
 
     # constructor allowing injection of custom tokenizer
-    def __init__(self):
+    def __init__(self, lda_workers=1, seed=2406834896, corpus_cache_folder=None, fast_tokenizer=False):
+        """
+        :param lda_workers: number of processes training the LDA model: 1 to train it in the current process, None to use
+        all cores but one (the one reading the corpus)
+        :param seed: seed of the random initialization of the LDA training, to get reproducible models. NB: with several
+        workers, chunks of documents are dispatched depending on processes scheduling, so results can differ slightly
+        :param corpus_cache_folder: folder where the training corpus is serialized in bag-of-words format, so documents
+        are tokenized once for all LDA passes, and not at all by next trainings with the same dictionary. None to
+        tokenize documents at each pass. NB: a cache is identified by the dictionary and the tokenizer, not by the
+        documents, so a folder must be used for a single corpus
+        :param fast_tokenizer: True to tokenize documents with the fast mode of DocTokenizer (single regex scan instead of
+        nltk tokenizers). A model must be used with the tokenizer mode it has been trained with (checked by load_model,
+        cf. uses_fast_tokenizer)
+        """
         self._dictionary = None
         self._dictionary_words = None
         self._lda = None
         self._topics = None
-        self._tokenizer = DocTokenizer()
+        self._tokenizer = DocTokenizer(fast=fast_tokenizer)
+        self._nb_updates = 0  # number of online updates of the trained model, part of its model id
         self._remove_optimizations = False  # can be set to 'True' for testing purpose
-        np.random.seed(2406834896)  # to get reproductible results
-        # nb: ideally gensim should allow to inject RandomState to not make side effects on other libs using numpy RNG
+        self._lda_workers = lda_workers
+        self._seed = seed
+        self._corpus_cache_folder = corpus_cache_folder
 
     def initialize(self, documents, num_topics):
         """
@@ -49,8 +66,23 @@ class TopicModeller(object):
         :param documents: corpus used by the model to build the model, as a generator of string
         :param num_topics: number of topics to generate
         """
-        self.initialize_dictionary(documents)
-        self.initialize_model(documents, num_topics)
+        if self._corpus_cache_folder is None:
+            self.initialize_dictionary(documents)
+            self.initialize_model(documents, num_topics)
+            return
+        # documents are tokenized once: tokens of the dictionary pass are saved in a temporary file, read again to
+        # serialize the corpus if it's not in cache yet
+        if not os.path.isdir(self._corpus_cache_folder):
+            os.makedirs(self._corpus_cache_folder)
+        tokens_file_path = os.path.join(self._corpus_cache_folder, 'tokens.tmp')
+        try:
+            with open(tokens_file_path, 'w') as tokens_file:
+                self._initialize_dictionary(_MultiIterator(
+                    documents, lambda document: _tokenize_and_save(self._tokenizer, document, tokens_file)))
+            self._cache_dictionary_words()
+            self._create_lda_model(documents, num_topics, _read_saved_tokens(tokens_file_path))
+        finally:
+            os.remove(tokens_file_path)
 
     def initialize_model(self, documents, num_topics):
         self._create_lda_model(documents, num_topics)
@@ -66,21 +98,16 @@ class TopicModeller(object):
         :param html_document: html document as a string
         :return: a two elements tuple:
             -First element is True if classification succeed, else false.
-            -Second element is a float vector of the size of TopicModeller.topics. Each value measure the significance of
-             the associated topic for this document
+            -Second element is a float numpy array of the size of TopicModeller.topics. Each value measure the
+             significance of the associated topic for this document
         """
-        tokenized_doc = self._tokenizer.tokenize(html_document)
-        filtered_doc = self._filter_document(tokenized_doc)
-        doc_format_for_lda_model = self._dictionary.doc2bow(filtered_doc)
-        if LOGGER.isEnabledFor(logging.DEBUG):
-            LOGGER.debug(u'doc converted as bag-of-words token_id:token_count[%s]',
-                         u'|'.join(str(tok_id) + ':' + str(count) for tok_id, count in doc_format_for_lda_model[:200]))
+        doc_format_for_lda_model = self._to_bag_of_words(html_document)
         # self.lda LdaModel []-operator return list of (topic_id, topic_probability) 2-tuples
         topic_id_to_probability = self._lda[doc_format_for_lda_model]
         if not any(topic_id_to_probability):
             LOGGER.info(u'classification failed. doc[%s]', shrink(html_document))
             return False, None
-        vector = [0] * self._lda.num_topics
+        vector = np.zeros(self._lda.num_topics)
         for topic_id, topic_probability in topic_id_to_probability:
             vector[topic_id] = topic_probability
         if LOGGER.isEnabledFor(logging.DEBUG):
@@ -89,6 +116,64 @@ class TopicModeller(object):
                          u'|'.join(str(topic) + ':' + str(proba) for topic, proba in topic_id_to_probability))
         return True, vector
 
+    def classify_batch(self, html_documents):
+        """
+        Do the topic classification of a chunk of documents with a single LDA inference on the whole chunk.
+        Results are the same as calling classify on each document, minus the noise of the LDA variational inference.
+        :param html_documents: list of html documents as strings
+        :return: a two elements tuple:
+            -First element is a boolean array of size len(html_documents), True where the classification succeed.
+            -Second element is a float matrix of shape (len(html_documents), nb topics). Row i is the topic vector of
+             document i, it is zero when classification of document i failed.
+        """
+        return self.classify_bags_of_words(self.to_bags_of_words(html_documents))
+
+    def to_bags_of_words(self, html_documents):
+        """
+        :param html_documents: list of html documents as strings
+        :return: list of documents in bag-of-words format (list of tuples (token_id, token_count)), to be classified
+        by classify_bags_of_words and used for online update of the model
+        """
+        return [self._to_bag_of_words(html_document) for html_document in html_documents]
+
+    def classify_bags_of_words(self, bows):
+        """
+        classify_batch of documents already converted by to_bags_of_words
+        """
+        if not bows:
+            return np.zeros(0, dtype=bool), np.zeros((0, self._lda.num_topics))
+        # gamma are the unnormalized parameters of the topic distribution, one row by document
+        gamma, _ = self._lda.inference(bows)
+        topic_matrix = gamma / gamma.sum(axis=1)[:, np.newaxis]
+        # same threshold as LdaModel.get_document_topics (used by classify) to get sparse vectors
+        minimum_probability = max(self._lda.minimum_probability, 1e-8)
+        topic_matrix[topic_matrix < minimum_probability] = 0.0
+        success_mask = topic_matrix.any(axis=1)
+        LOGGER.debug(u'chunk classified, nb docs[%s], nb failures[%s]', len(bows), len(bows) - success_mask.sum())
+        return success_mask, topic_matrix
+
+    def update(self, bows):
+        """
+        Online update of the LDA model with new documents (e.g. recently scraped), so topics follow the drift of the
+        corpus without a full training. The dictionary is not updated, so new words are ignored.
+        NB: vectors classified before and after the update are not comparable, the updated model must be published as a
+        new model (cf. orchestrator.updatemodel.ModelUpdater), so each update changes the model id.
+        :param bows: iterable of documents in bag-of-words format (cf. to_bags_of_words), used as a single mini-batch
+        if there are less documents than the chunksize of the model
+        """
+        with _numpy_random_seed(self._seed):
+            self._lda.update(bows)
+        self._nb_updates += 1
+
+    def _to_bag_of_words(self, html_document):
+        tokenized_doc = self._tokenizer.tokenize(html_document)
+        filtered_doc = self._filter_document(tokenized_doc)
+        doc_format_for_lda_model = self._dictionary.doc2bow(filtered_doc)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(u'doc converted as bag-of-words token_id:token_count[%s]',
+                         u'|'.join(str(tok_id) + ':' + str(count) for tok_id, count in doc_format_for_lda_model[:200]))
+        return doc_format_for_lda_model
+
     def load(self, model_data_folder):
         """
         Deserialize a previously saved model
@@ -100,6 +185,7 @@ class TopicModeller(object):
     def load_model(self, model_data_folder):
         lda_file_path = self._lda_file_path(model_data_folder)
         if os.path.isfile(lda_file_path):
+            self._load_model_info(model_data_folder)
             self._lda = models.LdaModel.load(lda_file_path)
         else:
             raise IOError(u'Lda model file does not exists : ' + lda_file_path)  # pragma: no cover
@@ -122,6 +208,8 @@ class TopicModeller(object):
 
     def save_model(self, model_data_folder):
         self._lda.save(self._lda_file_path(model_data_folder))
+        with open(self._model_info_file_path(model_data_folder), 'w') as model_info_file:
+            json.dump({'tokenizer_config_id': self._tokenizer.config_id, 'nb_updates': self._nb_updates}, model_info_file)
         self._lda.print_topics(num_topics=-1, num_words=50)  # print topics in logs
 
     def save_dictionary(self, model_data_folder):
@@ -135,6 +223,40 @@ class TopicModeller(object):
     def _lda_file_path(cls, model_data_folder):
         return os.path.join(model_data_folder, 'lda.mod')
 
+    @classmethod
+    def _model_info_file_path(cls, model_data_folder):
+        return os.path.join(model_data_folder, 'model_info.json')
+
+    @classmethod
+    def uses_fast_tokenizer(cls, model_data_folder):
+        """
+        :param model_data_folder: folder where a model has been saved
+        :return: True if the model has been trained with the fast mode of DocTokenizer, i.e. the fast_tokenizer value
+        of the TopicModeller loading it
+        """
+        return cls._read_model_info(model_data_folder)['tokenizer_config_id'] == DocTokenizer(fast=True).config_id
+
+    @classmethod
+    def _read_model_info(cls, model_data_folder):
+        model_info_file_path = cls._model_info_file_path(model_data_folder)
+        if os.path.isfile(model_info_file_path):
+            with open(model_info_file_path) as model_info_file:
+                return json.load(model_info_file)
+        # models saved before their info have been trained with nltk tokenizers, and never updated
+        return {'tokenizer_config_id': DocTokenizer().config_id, 'nb_updates': 0}
+
+    def _load_model_info(self, model_data_folder):
+        """
+        Load the number of online updates of the model, and raise if the model has been trained with another
+        tokenizer: the topics of the documents would be computed on other tokens than the ones the model has learnt
+        """
+        model_info = self._read_model_info(model_data_folder)
+        model_tokenizer_id = model_info['tokenizer_config_id']
+        if model_tokenizer_id != self._tokenizer.config_id:
+            raise ValueError(u'Lda model trained with tokenizer ' + model_tokenizer_id + u' cannot be used with tokenizer ' +
+                             self._tokenizer.config_id)
+        self._nb_updates = model_info['nb_updates']
+
     def _initialize_dictionary(self, tokenized_documents):
         self._dictionary = corpora.Dictionary()
         corpora.Dictionary.add_documents(self._dictionary, tokenized_documents)
@@ -142,19 +264,62 @@ class TopicModeller(object):
         if not self._remove_optimizations:
             self._dictionary.filter_extremes(no_below=10, no_above=0.20, keep_n=100000)
 
-    def _create_lda_model(self, documents, num_topics):
-
-        tokenized_corpus = _MultiIterator(documents, self._tokenizer.tokenize)
+    def _get_bow_corpus(self, documents, tokenized_documents=None):
+        """
+        :param tokenized_documents: iterable of the tokens of documents if they have already been tokenized, iterated
+        at most once
+        """
+        tokenized_corpus = tokenized_documents if tokenized_documents is not None else \
+            _MultiIterator(documents, self._tokenizer.tokenize)
         # 'Bag Of Words' format for ldaModel
         bow_corpus = _MultiIterator(tokenized_corpus, self._dictionary.doc2bow)
+        if self._corpus_cache_folder is None:
+            return bow_corpus
+        corpus_file_path = os.path.join(self._corpus_cache_folder, self._corpus_cache_id() + '.mm')
+        if os.path.isfile(corpus_file_path):
+            LOGGER.info(u'load bag-of-words corpus from cache[%s]', corpus_file_path)
+        else:
+            LOGGER.info(u'serialize bag-of-words corpus in cache[%s]', corpus_file_path)
+            # serialized in temporary files renamed at the end (corpus file last), so a partial corpus is never loaded
+            tmp_corpus_file_path = corpus_file_path + '.tmp'
+            if not os.path.isdir(self._corpus_cache_folder):
+                os.makedirs(self._corpus_cache_folder)
+            corpora.MmCorpus.serialize(tmp_corpus_file_path, bow_corpus)
+            os.rename(tmp_corpus_file_path + '.index', corpus_file_path + '.index')
+            os.rename(tmp_corpus_file_path, corpus_file_path)
+        # MmCorpus streams documents from disk, and knows its length, so LdaModel doesn't iterate it to count docs
+        return corpora.MmCorpus(corpus_file_path)
 
-        self._lda = models.LdaModel(
-            bow_corpus,
-            id2word=self._dictionary,
-            num_topics=num_topics,
-            chunksize=5000,
-            update_every=10,
-            passes=3)
+    def _corpus_cache_id(self):
+        """
+        :return: string identifying the bag-of-words corpus built from the same documents, it changes with the
+        dictionary (tokens and ids) and with the tokenizer
+        """
+        tokens_with_ids = u' '.join(u'{}:{}'.format(token, token_id)
+                                    for token, token_id in sorted(self._dictionary.token2id.iteritems()))
+        return crypto.hash_str((self._tokenizer.config_id + u'|' + tokens_with_ids).encode('utf-8'))
+
+    def _create_lda_model(self, documents, num_topics, tokenized_documents=None):
+        bow_corpus = self._get_bow_corpus(documents, tokenized_documents)
+
+        with _numpy_random_seed(self._seed):
+            if self._lda_workers == 1:
+                self._lda = models.LdaModel(
+                    bow_corpus,
+                    id2word=self._dictionary,
+                    num_topics=num_topics,
+                    chunksize=5000,
+                    update_every=10,
+                    passes=3)
+            else:
+                # E-steps of the chunks are done in parallel by the workers, the model is updated by this process
+                self._lda = models.LdaMulticore(
+                    bow_corpus,
+                    id2word=self._dictionary,
+                    num_topics=num_topics,
+                    workers=self._lda_workers,
+                    chunksize=5000,
+                    passes=3)
 
     def _filter_document(self, document):
         # We want to keep only known words (those on our dictionary)
@@ -192,10 +357,43 @@ class TopicModeller(object):
         # Nb: hash is computed only with world and not weight to prevent possible rounding errors between several machines,
         # The risk that two models have the exact same words in same order being negligible
         string_topics = ''.join(word for topic in self.get_topics() for word, _ in topic)
+        # an online update can leave the main words unchanged while the weights drift, so the number of updates is part
+        # of the id of an updated model (ids of trained models are unchanged)
+        if self._nb_updates > 0:
+            string_topics += '|online_update_' + str(self._nb_updates)
         hash_topic_words = crypto.hash_str(string_topics)
         return hash_topic_words
 
 
+@contextmanager
+def _numpy_random_seed(seed):
+    """
+    gensim 0.13 does not allow to inject a RandomState, it uses numpy global RNG: it's seeded only in the context
+    then restored, to not make side effects on other libs using numpy RNG
+    """
+    rng_state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(rng_state)
+
+
+def _tokenize_and_save(tokenizer, document, tokens_file):
+    tokens = tokenizer.tokenize(document)
+    tokens_file.write(json.dumps(tokens) + '\n')
+    return tokens
+
+
+def _read_saved_tokens(tokens_file_path):
+    """
+    :return: generator of the tokens of each document saved by _tokenize_and_save
+    """
+    with open(tokens_file_path) as tokens_file:
+        for line in tokens_file:
+            yield json.loads(line)
+
+
 def _gensim_get_lambda_monkey_patch(self):
     if not hasattr(self, '_cached_get_lambda_result') or self._cached_get_lambda_result is None:  # pylint: disable=protected-access
         self._cached_get_lambda_result = self.gensim_get_lambda()  # pylint: disable=protected-access
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import tempfile
 from common.datehelper import utcnow
 from userdocmatch.dal import Dal
 from userdocmatch.api import UserDocMatcher, Document, ActionTypeOnDoc
+from userdocmatch.structinit import ProfileInitializerCache
 from userdocmatch.frontendstructs import Document as DalDoc, TopicModelDescription, FeatureSet, FeatureVector
 from userdocmatch.frontendstructs import UserDocument as DalUserDoc
 from userdocmatch.frontendstructs import UserActionTypeOnDoc as DalActionType
@@ -20,7 +22,9 @@ class UserDocMatcherTests(unittest.TestCase):
         self.ref_feature_set_id = u'UserDocMatcherTests_ref_feature_set_id'
         self.dal.feature_set.save_feature_set(FeatureSet(self.ref_feature_set_id, ['f'], model_id))
         self.dal.feature_set.save_ref_feature_set_id(self.ref_feature_set_id)
-        self.matcher = UserDocMatcher()
+        # not the cache shared by the process, it would keep the ref feature set of another test
+        self.profile_initializers = ProfileInitializerCache(artifacts_dir=tempfile.mkdtemp(), ref_check_seconds=0)
+        self.matcher = UserDocMatcher(profile_initializers=self.profile_initializers)
 
     def test_create_user(self):
         # Only this test because it's properly tested
@@ -72,6 +76,48 @@ class UserDocMatcherTests(unittest.TestCase):
         self.assertEquals(url, doc.url)
         self.assertEquals(url_hash, doc.url_hash)
 
+    def test_get_docs_cached_until_user_docs_are_saved(self):
+        class ClockMock(object):
+            now = 0.0
+
+            def __call__(self):
+                return self.now
+
+        clock = ClockMock()
+        matcher = UserDocMatcher(generation_check_seconds=10, clock=clock,
+                                 profile_initializers=self.profile_initializers)
+        user_id = u'user_id_test_get_docs_cached_until_user_docs_are_saved'
+        matcher.create_user(user_id, [])
+        user = self.dal.user.get_user(user_id)
+        dal_doc1 = DalDoc(u'url1', u'hash1_test_get_docs_cached', u't1', u's1',
+                          FeatureVector([1.0], self.ref_feature_set_id))
+        dal_doc2 = DalDoc(u'url2', u'hash2_test_get_docs_cached', u't2', u's2',
+                          FeatureVector([1.0], self.ref_feature_set_id))
+        self.dal.doc.save_documents([dal_doc1, dal_doc2])
+        self.dal.user_doc.save_user_docs(user, [DalUserDoc(dal_doc1, 0.5)])
+
+        self.assertEquals([u'url1'], [doc.url for doc in matcher.get_docs(user_id)])
+        self.dal.user_doc.save_users_docs([(user, [DalUserDoc(dal_doc2, 0.5)])])
+        # generation is not checked again before generation_check_seconds: cached docs are returned
+        clock.now = 9.0
+        self.assertEquals([u'url1'], [doc.url for doc in matcher.get_docs(user_id)])
+        clock.now = 10.0
+        self.assertEquals([u'url2'], [doc.url for doc in matcher.get_docs(user_id)])
+
+    def test_create_user_invalidate_cached_docs_of_user(self):
+        user_id = u'user_id_test_create_user_invalidate_cached_docs'
+        self.matcher.create_user(user_id, [])
+        user = self.dal.user.get_user(user_id)
+        dal_doc = DalDoc(u'url_invalidate', u'hash_test_create_user_invalidate', u't', u's',
+                         FeatureVector([1.0], self.ref_feature_set_id))
+        self.dal.doc.save_documents([dal_doc])
+        self.dal.user_doc.save_users_docs([(user, [DalUserDoc(dal_doc, 0.5)])])
+        self.assertEquals([u'url_invalidate'], [doc.url for doc in self.matcher.get_docs(user_id)])
+
+        # user registered again: its docs are reloaded, without waiting for a new generation of all user docs
+        self.matcher.create_user(user_id, [])
+        self.assertIsNone(self.matcher._docs_cache.get(user_id))  # pylint: disable=protected-access
+
     def test_add_user_action(self):
         now = utcnow()
         action = ActionTypeOnDoc.click_link
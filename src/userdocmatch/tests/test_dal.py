@@ -3,6 +3,8 @@
 
 import unittest
 import itertools
+import threading
+import numpy as np
 import userdocmatch.dal as sdal
 import userdocmatch.frontendstructs as struct
 from common.datehelper import utcnow
@@ -35,6 +37,17 @@ class DalFeatureSetTests(unittest.TestCase):
         feature_set = self.dal.feature_set.get_feature_set(u'test_save_then_get_empty_features_feature_set_id')
         self.assertEquals([], feature_set.feature_names)
 
+    def test_save_then_get_model_migration(self):
+        self.dal.feature_set.save_model_migration(struct.ModelMigration(u'test_model_migration_fs_id', None, False))
+        model_migration = self.dal.feature_set.get_model_migration()
+        self.assertEquals(u'test_model_migration_fs_id', model_migration.target_feature_set_id)
+        self.assertIsNone(model_migration.last_user_id)
+        self.assertFalse(model_migration.is_done)
+        self.dal.feature_set.save_model_migration(struct.ModelMigration(u'test_model_migration_fs_id', u'user_id', True))
+        model_migration = self.dal.feature_set.get_model_migration()
+        self.assertEquals(u'user_id', model_migration.last_user_id)
+        self.assertTrue(model_migration.is_done)
+
 
 class DalUserTests(unittest.TestCase):
 
@@ -159,6 +172,16 @@ class DalUserDocTests(unittest.TestCase):
         docs = self.dal.user_doc.get_users_docs([user])[0]
         self.assertEquals([], docs)
 
+    def test_user_docs_generation_changed_only_by_save_users_docs(self):
+        user = struct.User.make_from_scratch(u"test_user_docs_generation_user", [u"interests1"])
+        self.dal.user.save_user(user)
+        self.dal.user_doc.save_users_docs([(user, [])])
+        generation = self.dal.user_doc.get_user_docs_generation()
+        self.dal.user_doc.save_user_docs(user, [])
+        self.assertEquals(generation, self.dal.user_doc.get_user_docs_generation())
+        self.dal.user_doc.save_users_docs([(user, [])])
+        self.assertNotEquals(generation, self.dal.user_doc.get_user_docs_generation())
+
 
 class DalDocTests(unittest.TestCase):
 
@@ -208,6 +231,21 @@ class DalDocTests(unittest.TestCase):
         self._assert_doc_equals(doc1, result_docs[0])
         self._assert_doc_equals(doc2, result_docs[1])
 
+    def test_get_docs_use_docs_cache(self):
+        doc1 = make_dummy_doc(self.dal, u'test_get_docs_use_docs_cache_1')
+        doc2 = make_dummy_doc(self.dal, u'test_get_docs_use_docs_cache_2')
+        self.dal.doc.save_documents([doc1, doc2])
+        docs_cache = sdal.DalDoc._docs_cache  # pylint: disable=protected-access
+        docs_cache.invalidate(doc2.url_hash)
+        hits, misses = docs_cache.hits, docs_cache.misses
+        result_docs = self.dal.doc.get_docs([doc1.url_hash, doc2.url_hash])  # doc1 written-through, doc2 read from db
+        self.assertEquals((hits + 1, misses + 1), (docs_cache.hits, docs_cache.misses))
+        self._assert_doc_equals(doc1, result_docs[0])
+        self._assert_doc_equals(doc2, result_docs[1])
+        result_docs = sdal.Dal().doc.get_docs([doc2.url_hash])  # cache is shared by all Dal instances
+        self.assertEquals((hits + 2, misses + 1), (docs_cache.hits, docs_cache.misses))
+        self._assert_doc_equals(doc2, result_docs[0])
+
     def test_save_doc_with_datetime_keep_it(self):
         doc = make_dummy_doc(self.dal, u'test_save_doc_with_datetime_keep_it')
         doc.datetime = utcnow()
@@ -258,7 +296,7 @@ class DalDocTests(unittest.TestCase):
         self.assertEquals(expected_doc.url_hash, result_doc.url_hash)
         self.assertEquals(expected_doc.title, result_doc.title)
         self.assertEquals(expected_doc.summary, result_doc.summary)
-        self.assertEquals(expected_doc.feature_vector.vector, result_doc.feature_vector.vector)
+        np.testing.assert_array_equal(expected_doc.feature_vector.vector, result_doc.feature_vector.vector)
         self.assertEquals(expected_doc.feature_vector.feature_set_id, result_doc.feature_vector.feature_set_id)
 
 
@@ -336,13 +374,16 @@ class DalUserComputedProfileTests(unittest.TestCase):
         self._assert_model_data_equals(expected_profile.model_data, result_profile.model_data)
 
     def _assert_feature_vector_equals(self, expected_feature_vector, result_feature_vector):
-        self.assertEquals(expected_feature_vector.vector, result_feature_vector.vector)
+        np.testing.assert_array_equal(expected_feature_vector.vector, result_feature_vector.vector)
         self.assertEquals(expected_feature_vector.feature_set_id, result_feature_vector.feature_set_id)
 
     def _assert_model_data_equals(self, expected_model_data, result_model_data):
-        self.assertEquals(expected_model_data.explicit_feedback_vector, result_model_data.explicit_feedback_vector)
-        self.assertEquals(expected_model_data.positive_feedback_vector, result_model_data.positive_feedback_vector)
-        self.assertEquals(expected_model_data.negative_feedback_vector, result_model_data.negative_feedback_vector)
+        np.testing.assert_array_equal(expected_model_data.explicit_feedback_vector,
+                                      result_model_data.explicit_feedback_vector)
+        np.testing.assert_array_equal(expected_model_data.positive_feedback_vector,
+                                      result_model_data.positive_feedback_vector)
+        np.testing.assert_array_equal(expected_model_data.negative_feedback_vector,
+                                      result_model_data.negative_feedback_vector)
         self.assertEquals(expected_model_data.positive_feedback_sum_coeff, result_model_data.positive_feedback_sum_coeff)
         self.assertEquals(expected_model_data.negative_feedback_sum_coeff, result_model_data.negative_feedback_sum_coeff)
 
@@ -384,6 +425,63 @@ class DalUserActionOnDocTests(unittest.TestCase):
         self.assertTrue(min_datetime < user2_action.datetime)
         self.assertEquals(2, len(user1_actions))
 
+    def test_get_actions_by_users(self):
+        doc1 = make_dummy_doc(self.dal, u'test_get_actions_by_users1')
+        doc2 = make_dummy_doc(self.dal, u'test_get_actions_by_users2')
+        self.dal.doc.save_documents([doc1, doc2])
+        user_ids = [u'test_get_actions_by_users' + str(index) for index in range(4)]
+        self.dal.user_action.save_user_action_on_doc(
+            user_ids[1], doc1.url_hash, struct.UserActionTypeOnDoc.up_vote)  # before from_datetime of user1, filtered
+        from_datetime1 = utcnow()
+        self.dal.user_action.save_user_action_on_doc(
+            user_ids[2], doc1.url_hash, struct.UserActionTypeOnDoc.up_vote)  # before from_datetime of user2, filtered
+        self.dal.user_action.save_user_action_on_doc(user_ids[1], doc1.url_hash, struct.UserActionTypeOnDoc.down_vote)
+        from_datetime2 = utcnow()
+        self.dal.user_action.save_user_action_on_doc(user_ids[2], doc1.url_hash, struct.UserActionTypeOnDoc.down_vote)
+        self.dal.user_action.save_user_action_on_doc(user_ids[2], doc2.url_hash, struct.UserActionTypeOnDoc.click_link)
+        self.dal.user_action.save_user_action_on_doc(
+            user_ids[3], doc2.url_hash, struct.UserActionTypeOnDoc.click_link)  # not in users, filtered
+        until_datetime = utcnow()
+        self.dal.user_action.save_user_action_on_doc(
+            user_ids[1], doc2.url_hash, struct.UserActionTypeOnDoc.up_vote)  # after until_datetime, filtered
+
+        # a partition of 2 users then of 1 user, a request by user so requests of a partition are sent concurrently,
+        # and a page by action so user2 actions are read in 2 pages
+        partitions = list(self.dal.user_action.get_actions_by_users(
+            [user_ids[1], user_ids[0], user_ids[2]], [from_datetime1, from_datetime1, from_datetime2], until_datetime,
+            nb_users_by_partition=2, nb_users_by_request=1, page_size=1))
+
+        self.assertEquals([2, 1], [len(partition) for partition in partitions])
+        result = partitions[0] + partitions[1]
+        user1_actions = result[0]
+        self.assertEquals(1, len(user1_actions))
+        self.assertEquals(doc1.title, user1_actions[0].document.title)
+        self.assertEquals(struct.UserActionTypeOnDoc.down_vote, user1_actions[0].action_type)
+        self.assertEquals([], result[1])
+        user2_actions = result[2]
+        self.assertEquals(2, len(user2_actions))
+        self.assertEquals({doc1.url_hash, doc2.url_hash}, {action.document.url_hash for action in user2_actions})
+        self.assertTrue(all(from_datetime2 < action.datetime for action in user2_actions))
+
+    def test_save_user_action_on_doc_flag_dirty_user_until_cleared(self):
+        doc = make_dummy_doc(self.dal, u'test_save_user_action_on_doc_flag_dirty_user')
+        self.dal.doc.save_documents([doc])
+        user_id1 = u'test_save_user_action_on_doc_flag_dirty_user1'
+        user_id2 = u'test_save_user_action_on_doc_flag_dirty_user2'
+        self.dal.user_action.save_user_action_on_doc(user_id1, doc.url_hash, struct.UserActionTypeOnDoc.up_vote)
+        self.dal.user_action.save_user_action_on_doc(user_id2, doc.url_hash, struct.UserActionTypeOnDoc.up_vote)
+        until_datetime = utcnow()
+        self.dal.user_action.save_user_action_on_doc(user_id2, doc.url_hash, struct.UserActionTypeOnDoc.click_link)
+        dirty_user_ids = self.dal.user_action.get_dirty_user_ids()
+        self.assertIn(user_id1, dirty_user_ids)
+        self.assertIn(user_id2, dirty_user_ids)
+
+        self.dal.user_action.clear_dirty_users([user_id1, user_id2], until_datetime)
+
+        dirty_user_ids = self.dal.user_action.get_dirty_user_ids()
+        self.assertNotIn(user_id1, dirty_user_ids)
+        self.assertIn(user_id2, dirty_user_ids)  # action saved after until_datetime
+
     # for each static member of the class (remove special fields __***__), check we do a proper round-trip with database
     def test_action_type_on_doc_mapping_with_db(self):
         for enum_name, enum_value in vars(struct.UserActionTypeOnDoc).iteritems():
@@ -391,6 +489,124 @@ class DalUserActionOnDocTests(unittest.TestCase):
                 self.assertEquals(enum_value, sdal._to_user_action_type_on_doc(sdal._to_db_action_type_on_doc(enum_value)))
 
 
+class DatastoreClientMock(object):
+
+    def __init__(self, nb_entities):
+        self.saved_keys = set(range(nb_entities))
+        self.get_multi_sizes = []
+        self.put_multi_sizes = []
+
+    def get_multi(self, keys):
+        self.get_multi_sizes.append(len(keys))
+        # returned entities are not in the order of keys
+        return [_EntityMock(key) for key in reversed(keys) if key in self.saved_keys]
+
+    def put_multi(self, entities):
+        self.put_multi_sizes.append(len(entities))
+        self.saved_keys.update(entity.key for entity in entities)
+
+
+class _EntityMock(object):
+
+    def __init__(self, key):
+        self.key = key
+
+
+class _QueryMock(object):
+
+    class _Iterator(object):
+
+        def __init__(self, entities, next_page_token):
+            self._entities = entities
+            self.next_page_token = next_page_token
+
+        def __iter__(self):
+            return iter(self._entities)
+
+    def __init__(self, nb_entities):
+        self.nb_entities = nb_entities
+        self.start_cursors = []
+
+    def fetch(self, limit, start_cursor):
+        self.start_cursors.append(start_cursor)
+        start = start_cursor or 0
+        end = min(start + limit, self.nb_entities)
+        return self._Iterator(range(start, end), end if end < self.nb_entities else None)
+
+
+class FetchByPageTests(unittest.TestCase):
+
+    def test_fetch_by_page_request_each_page_with_cursor_of_previous_one(self):
+        query = _QueryMock(5)
+        pages = list(sdal._fetch_by_page(query, 2))  # pylint: disable=protected-access
+        self.assertEquals([[0, 1], [2, 3], [4]], pages)
+        self.assertEquals([None, 2, 4], query.start_cursors)
+
+    def test_fetch_by_page_no_entity(self):
+        query = _QueryMock(0)
+        self.assertEquals([], list(sdal._fetch_by_page(query, 2)))  # pylint: disable=protected-access
+        self.assertEquals([None], query.start_cursors)
+
+
+class GetPutMultiTests(unittest.TestCase):
+
+    def setUp(self):
+        self.client_factory = sdal._RequestPool.client_factory  # pylint: disable=protected-access
+
+    def tearDown(self):
+        sdal._RequestPool.client_factory = self.client_factory  # pylint: disable=protected-access
+
+    @staticmethod
+    def _use_client_in_request_pool(client):
+        sdal._RequestPool.client_factory = staticmethod(lambda: client)  # pylint: disable=protected-access
+
+    def test_get_multi_split_keys_in_chunks_and_keep_keys_order(self):
+        client = DatastoreClientMock(2500)
+        self._use_client_in_request_pool(client)
+        keys = range(2499, -1, -1)
+        entities = sdal._get_multi(client, keys)  # pylint: disable=protected-access
+        self.assertEquals([1000, 1000, 500], sorted(client.get_multi_sizes, reverse=True))
+        self.assertEquals(keys, [entity.key for entity in entities])
+
+    def test_get_multi_return_none_for_missing_entities(self):
+        client = DatastoreClientMock(3)
+        entities = sdal._get_multi(client, [2, 5, 0])  # pylint: disable=protected-access
+        self.assertEquals(2, entities[0].key)
+        self.assertIsNone(entities[1])
+        self.assertEquals(0, entities[2].key)
+
+    def test_get_multi_empty_keys(self):
+        client = DatastoreClientMock(3)
+        self.assertEquals([], sdal._get_multi(client, []))  # pylint: disable=protected-access
+        self.assertEquals([], client.get_multi_sizes)
+
+    def test_put_multi_split_entities_in_chunks(self):
+        client = DatastoreClientMock(0)
+        self._use_client_in_request_pool(client)
+        sdal._put_multi(client, [_EntityMock(key) for key in range(1001)])  # pylint: disable=protected-access
+        self.assertEquals([500, 500, 1], sorted(client.put_multi_sizes, reverse=True))
+        self.assertEquals(set(range(1001)), client.saved_keys)
+
+    def test_request_pool_threads_use_their_own_client(self):
+        created_clients = []
+
+        def client_factory():
+            created_clients.append(DatastoreClientMock(0))
+            return created_clients[-1]
+        sdal._RequestPool.client_factory = staticmethod(client_factory)  # pylint: disable=protected-access
+        caller_client = DatastoreClientMock(0)
+
+        threads_clients = sdal._RequestPool.map(  # pylint: disable=protected-access
+            caller_client, lambda client, _: (threading.current_thread().ident, client), range(50))
+
+        thread_to_clients = {}
+        for thread_id, client in threads_clients:
+            thread_to_clients.setdefault(thread_id, set()).add(client)
+        self.assertTrue(all(len(clients) == 1 for clients in thread_to_clients.itervalues()))
+        self.assertEquals(len(created_clients), len(thread_to_clients))
+        self.assertNotIn(caller_client, [client for _, client in threads_clients])
+
+
 class DalTopicModelDescriptionTests(unittest.TestCase):
 
     def setUp(self):
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
+import tempfile
+import numpy as np
+from common.crypto import hash_str
 from common.datehelper import utcnow
-from userdocmatch.structinit import UserCreator, _ProfileInitializer, _get_user_docs
+from learner.topicmodelapprox import TopicModelApproxClassifier
+from userdocmatch.structinit import UserCreator, ProfileInitializerCache, RecentDocsIndexCache, _ProfileInitializer, \
+    _build_recent_docs_index, _ARTIFACTS_FORMAT_VERSION, _TMP_ARTIFACT_PREFIX
 from userdocmatch.dal import Dal
-from userdocmatch.frontendstructs import FeatureSet, TopicModelDescription, Document, FeatureVector
+from userdocmatch.frontendstructs import FeatureSet, TopicModelDescription, Document, FeatureVector, SparseFeatureVector
 
 
 def make_doc(vector, feature_set_id, url_hash):
@@ -37,7 +43,8 @@ class UserCreatorTests(unittest.TestCase):
         self._save_dummy_feature_set(ref_feature_set_id)
         doc = make_doc([1, 1], ref_feature_set_id, 'url_test_create_user_in_db')
         self.dal.doc.save_documents([doc])
-        user_creator = UserCreator()
+        user_creator = UserCreator(ProfileInitializerCache(artifacts_dir=tempfile.mkdtemp(), ref_check_seconds=0),
+                                   RecentDocsIndexCache(ttl_seconds=0))
         user = user_creator.create_user_in_db(user_id, interests, self.dal)
 
         user_from_db = self.dal.user.get_user(user_id)
@@ -50,8 +57,8 @@ class UserCreatorTests(unittest.TestCase):
         self.assertEquals(ref_feature_set_id, profile.feature_vector.feature_set_id)
         self.assertEqual(1, len(self.dal.user_doc.get_user_docs(user)))
 
-    def test_get_user_docs(self):
-        ref_feature_set_id = 'test_get_user_docs_ref_feature_set_id'
+    def test_build_recent_docs_index(self):
+        ref_feature_set_id = 'test_build_recent_docs_index_ref_feature_set_id'
         self._save_dummy_feature_set(ref_feature_set_id)
         doc_before = make_doc([1, 0.1], ref_feature_set_id, 'u_before')
 
@@ -64,9 +71,10 @@ class UserCreatorTests(unittest.TestCase):
 
         self.dal.doc.save_documents([doc_low, doc_high, doc_bad])
         feat_user = FeatureVector([1, 0], ref_feature_set_id)
-        user_docs = _get_user_docs(self.dal, feat_user, date_min, 1)
-        self.assertEqual(1, len(user_docs))
-        self.assertEqual('url_high', user_docs[0].document.url_hash)
+        docs, doc_index = _build_recent_docs_index(self.dal, date_min, 1000, feat_user)
+        self.assertEqual({'url_low', 'url_high'}, set(doc.url_hash for doc in docs))
+        doc_indexes, _ = doc_index.query(feat_user.vector, 1)
+        self.assertEqual(['url_high'], [docs[doc_index].url_hash for doc_index in doc_indexes])
 
 
 class ProfileInitializerTests(unittest.TestCase):
@@ -78,7 +86,7 @@ class ProfileInitializerTests(unittest.TestCase):
             [('t2_w1', 1.0)]
         ]
         model_description = TopicModelDescription.make_from_scratch('model_id', topics)
-        initializer = _ProfileInitializer(ref_feature_set_id, model_description)
+        initializer = _ProfileInitializer(ref_feature_set_id, TopicModelApproxClassifier.make_from_model(model_description))
         interests = ['t1_w2, t2_w1.', ' useless_word']
         profile = initializer.get_new_profile(interests)
         model_data = profile.model_data
@@ -86,13 +94,176 @@ class ProfileInitializerTests(unittest.TestCase):
         explicit_vec = model_data.explicit_feedback_vector
         self.assertEquals(0, model_data.positive_feedback_sum_coeff)
         self.assertEquals(0, model_data.negative_feedback_sum_coeff)
-        self.assertEquals([0, 0], model_data.positive_feedback_vector)
-        self.assertEquals([0, 0], model_data.negative_feedback_vector)
+        np.testing.assert_array_equal([0, 0], model_data.positive_feedback_vector)
+        np.testing.assert_array_equal([0, 0], model_data.negative_feedback_vector)
         self.assertEquals(2, len(explicit_vec))
         self.assertTrue(explicit_vec[1] > explicit_vec[0] > 0)
         self.assertEquals(explicit_vec[1] / explicit_vec[0], feature_vec.vector[1] / feature_vec.vector[0])
         self.assertEquals(feature_vec.feature_set_id, ref_feature_set_id)
 
+    def test_get_new_profiles_return_profile_of_each_interests(self):
+        ref_feature_set_id = 'test_get_new_profiles_ref_feature_set_id'
+        topics = [
+            [('t1_w1', 0.8), ('t1_w2', 0.2)],
+            [('t2_w1', 1.0)]
+        ]
+        model_description = TopicModelDescription.make_from_scratch('test_get_new_profiles_model_id', topics)
+        initializer = _ProfileInitializer(ref_feature_set_id, TopicModelApproxClassifier.make_from_model(model_description))
+        interests_list = [['t1_w2, t2_w1.', ' useless_word'], ['t2_w1'], []]
+        profiles = initializer.get_new_profiles(interests_list)
+        self.assertEquals(3, len(profiles))
+        for interests, profile in zip(interests_list, profiles):
+            np.testing.assert_almost_equal(initializer.get_new_profile(interests).feature_vector.vector,
+                                           profile.feature_vector.vector, 10)
+            self.assertEquals(ref_feature_set_id, profile.feature_vector.feature_set_id)
+        np.testing.assert_almost_equal([0, 1], profiles[1].feature_vector.vector, 10)
+        np.testing.assert_array_equal([0, 0], profiles[2].feature_vector.vector)
+
+
+class ClockMock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class DalMock(object):
+
+    class FeatureSetMock(object):
+
+        def __init__(self):
+            self.ref_feature_set_id = None
+            self.nb_ref_reads = 0
+
+        def get_ref_feature_set_id(self):
+            self.nb_ref_reads += 1
+            return self.ref_feature_set_id
+
+        @staticmethod
+        def get_feature_set(feature_set_id):
+            return FeatureSet(feature_set_id, ['f1', 'f2'], 'model_of_' + feature_set_id)
+
+    class TopicModelMock(object):
+
+        def __init__(self):
+            self.nb_reads = 0
+
+        def get(self, model_id):
+            self.nb_reads += 1
+            return TopicModelDescription.make_from_scratch(model_id, [[('w1', 1.0)], [('w2', 1.0)]])
+
+    def __init__(self):
+        self.feature_set = DalMock.FeatureSetMock()
+        self.topic_model = DalMock.TopicModelMock()
+
+
+class ProfileInitializerCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dal = DalMock()
+        self.clock = ClockMock()
+        self.artifacts_dir = tempfile.mkdtemp()
+
+    def test_get_check_ref_feature_set_id_every_ref_check_seconds(self):
+        cache = ProfileInitializerCache(self.artifacts_dir, ref_check_seconds=10, clock=self.clock)
+        self.dal.feature_set.ref_feature_set_id = 'fs_1'
+        initializer_1 = cache.get(self.dal)
+        self.assertIs(initializer_1, cache.get(self.dal))
+        self.dal.feature_set.ref_feature_set_id = 'fs_2'
+        self.clock.now = 9.0
+        self.assertIs(initializer_1, cache.get(self.dal))
+        self.assertEquals(1, self.dal.feature_set.nb_ref_reads)
+        self.clock.now = 10.0
+        initializer_2 = cache.get(self.dal)
+        self.assertIsNot(initializer_1, initializer_2)
+        self.clock.now = 20.0
+        self.assertIs(initializer_2, cache.get(self.dal))  # ref unchanged, initializer is not reloaded
+        self.assertEquals(3, self.dal.feature_set.nb_ref_reads)
+        self.assertEquals(2, self.dal.topic_model.nb_reads)
+
+    def test_get_load_classifier_saved_by_other_cache(self):
+        self.dal.feature_set.ref_feature_set_id = 'fs_1'
+        profile = ProfileInitializerCache(self.artifacts_dir).get(self.dal).get_new_profile([])
+        other_dal = DalMock()
+        other_dal.feature_set.ref_feature_set_id = 'fs_1'
+        other_initializer = ProfileInitializerCache(self.artifacts_dir).get(other_dal)
+        self.assertEquals(0, other_dal.topic_model.nb_reads)
+        other_profile = other_initializer.get_new_profile([])
+        self.assertEquals('fs_1', other_profile.feature_vector.feature_set_id)
+        np.testing.assert_array_equal(profile.feature_vector.vector, other_profile.feature_vector.vector)
+
+    def test_warm_up_load_ref_initializer_and_get_does_not_check_ref(self):
+        cache = ProfileInitializerCache(self.artifacts_dir, ref_check_seconds=3600, clock=self.clock)
+        self.dal.feature_set.ref_feature_set_id = 'fs_1'
+        cache.warm_up(lambda: self.dal)
+        self.assertEquals(1, self.dal.topic_model.nb_reads)
+        self.clock.now = 3600.0  # ref is only checked by the background refresh
+        cache.get(self.dal)
+        self.assertEquals(1, self.dal.feature_set.nb_ref_reads)
+
+    def test_refresh_remove_artifacts_of_previous_ref_but_not_temporary_ones(self):
+        cache = ProfileInitializerCache(self.artifacts_dir)
+        self.dal.feature_set.ref_feature_set_id = 'fs_1'
+        cache.refresh(self.dal)
+        versioned_artifacts_dir = os.path.join(self.artifacts_dir, 'v' + str(_ARTIFACTS_FORMAT_VERSION))
+        tmp_dir = tempfile.mkdtemp(prefix=_TMP_ARTIFACT_PREFIX, dir=versioned_artifacts_dir)  # written by a process
+        self.dal.feature_set.ref_feature_set_id = 'fs_2'
+        cache.refresh(self.dal)
+        self.assertEquals({hash_str('fs_2'), os.path.basename(tmp_dir)}, set(os.listdir(versioned_artifacts_dir)))
+        other_dal = DalMock()
+        other_dal.feature_set.ref_feature_set_id = 'fs_1'
+        ProfileInitializerCache(self.artifacts_dir).get(other_dal)  # artifact removed, classifier is rebuilt
+        self.assertEquals(1, other_dal.topic_model.nb_reads)
+
+
+class RecentDocsIndexCacheTests(unittest.TestCase):
+
+    class DocMock(object):
+
+        def __init__(self):
+            self.recent_docs = []
+            self.nb_reads = 0
+
+        def get_recent_docs(self, from_datetime, max_nb_docs=None):  # pylint: disable=unused-argument
+            self.nb_reads += 1
+            return self.recent_docs
+
+    class DalMock(object):
+
+        def __init__(self):
+            self.doc = RecentDocsIndexCacheTests.DocMock()
+
+    @staticmethod
+    def _make_doc(indexes, values, feature_set_id, url_hash):
+        return Document('u', url_hash, '', '', SparseFeatureVector(indexes, values, 2, feature_set_id))
+
+    @staticmethod
+    def _get_user_doc_hashes(cache, dal, feature_set_id, nb_user_docs):
+        user_docs = cache.get_user_docs(dal, FeatureVector([1.0, 0.0], feature_set_id), nb_user_docs)
+        return [user_doc.document.url_hash for user_doc in user_docs]
+
+    def test_get_user_docs_read_recent_docs_every_ttl_seconds(self):
+        clock = ClockMock()
+        cache = RecentDocsIndexCache(ttl_seconds=10, clock=clock)
+        dal = self.DalMock()
+        dal.doc.recent_docs = [self._make_doc([0], [1.0], 'fs_1', 'url_1'), self._make_doc([1], [1.0], 'fs_1', 'url_2'),
+                               self._make_doc([0], [1.0], 'fs_2', 'url_3')]
+        self.assertEquals(['url_1'], self._get_user_doc_hashes(cache, dal, 'fs_1', 1))
+
+        dal.doc.recent_docs.append(self._make_doc([0, 1], [1.0, 0.1], 'fs_1', 'url_4'))
+        clock.now = 9.0
+        self.assertEquals(['url_1', 'url_2'], self._get_user_doc_hashes(cache, dal, 'fs_1', 3))
+        self.assertEquals(1, dal.doc.nb_reads)
+        clock.now = 10.0
+        self.assertEquals(['url_1', 'url_4', 'url_2'], self._get_user_doc_hashes(cache, dal, 'fs_1', 3))
+        self.assertEquals(2, dal.doc.nb_reads)
+
+        # index is rebuilt for users of another feature set
+        self.assertEquals(['url_3'], self._get_user_doc_hashes(cache, dal, 'fs_2', 3))
+        self.assertEquals(3, dal.doc.nb_reads)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,5 @@
+import time
+from common.cache import LruTtlCache
 from .dal import Dal
 from .structinit import UserCreator
 from .frontendstructs import UserActionTypeOnDoc
@@ -5,8 +7,22 @@ from .frontendstructs import UserActionTypeOnDoc
 
 class UserDocMatcher(object):
 
-    def __init__(self):
-        self._user_creator = UserCreator()
+    def __init__(self, docs_cache_max_size=10000, docs_cache_ttl_seconds=600, generation_check_seconds=10,
+                 clock=time.time, profile_initializers=None):
+        """
+        :param docs_cache_max_size: max number of users whose docs are cached
+        :param docs_cache_ttl_seconds: max duration docs of a user are cached
+        :param generation_check_seconds: min duration between two checks in database that user docs have been updated.
+        It's the max delay for a client to see its new docs after an update (if not already expired by TTL).
+        :param clock: function returning the current time in seconds, injected for tests
+        :param profile_initializers: structinit.ProfileInitializerCache, default is the cache shared by the process
+        """
+        self._user_creator = UserCreator(profile_initializers)
+        self._docs_cache = LruTtlCache(docs_cache_max_size, docs_cache_ttl_seconds, clock)
+        self._generation_check_seconds = generation_check_seconds
+        self._clock = clock
+        self._next_generation_check_time = None
+        self._user_docs_generation = None
 
     def create_user(self, user_id, interests):
         """
@@ -14,14 +30,37 @@ class UserDocMatcher(object):
         :param interests: list of unicode.
         """
         self._user_creator.create_user_in_db(user_id, interests, Dal())
+        # docs of a single user do not change the user docs generation, so they are invalidated in the local cache only
+        self._docs_cache.invalidate(user_id)
 
-    @staticmethod
-    def get_docs(user_id):
-        dal = Dal()
-        user = dal.user.get_user(user_id)
-        dal_user_docs = dal.user_doc.get_user_docs(user)
-        docs = [_to_api_doc(user_doc.document) for user_doc in dal_user_docs]
-        return docs
+    def warm_up(self):
+        """
+        Load the models used to create users and refresh them in background, to be called at server start
+        """
+        self._user_creator.warm_up(Dal)
+
+    def get_docs(self, user_id):
+        self._clear_docs_cache_if_outdated()
+        docs = self._docs_cache.get(user_id)
+        if docs is None:
+            dal = Dal()
+            user = dal.user.get_user(user_id)
+            dal_user_docs = dal.user_doc.get_user_docs(user)
+            docs = [_to_api_doc(user_doc.document) for user_doc in dal_user_docs]
+            self._docs_cache.put(user_id, docs)
+        return list(docs)
+
+    def _clear_docs_cache_if_outdated(self):
+        # user docs of all users are rewritten together by the background update, so a single generation value
+        # is enough to know if cached docs are outdated (docs of a new user are invalidated by create_user)
+        now = self._clock()
+        if self._next_generation_check_time is not None and now < self._next_generation_check_time:
+            return
+        self._next_generation_check_time = now + self._generation_check_seconds
+        generation = Dal().user_doc.get_user_docs_generation()
+        if generation != self._user_docs_generation:
+            self._docs_cache.clear()
+            self._user_docs_generation = generation
 
     # Nb: this function should be removed and mapping
     # hash/url kept by the client
@@ -5,10 +5,16 @@ abstract database scheme and datastore API to communicate with the rest of the p
 through objects uncoupled from gcloud datastore API
 """
 import datetime
+import functools
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 import httplib2
+import numpy as np
 import google.cloud.datastore as datastore  # pylint: disable=import-error
 from google.auth.credentials import Credentials
+from common.cache import LruTtlCache
+from common.datehelper import utcnow
 from common.environment import GCLOUD_PROJECT, IS_TEST_ENV
 from . import frontendstructs as struct
 
@@ -41,11 +47,20 @@ def _to_db_action_type_on_doc(user_action_on_doc_enum):
     raise ValueError(str(user_action_on_doc_enum) + ' has not string matching for database')  # pragma: no cover
 
 
+def _to_vector(db_vector):
+    return np.asarray(db_vector, dtype=np.float64)
+
+
+def _to_db_vector(vector):
+    # datastore only handles python builtin types, so numpy arrays are converted at this boundary only
+    return np.asarray(vector, dtype=np.float64).tolist()
+
+
 def _to_user_profile_model_data(db_user_profile_model_data):
     return struct.UserProfileModelData(
-        db_user_profile_model_data.get('explicit_feedback_vector', []),
-        db_user_profile_model_data.get('positive_feedback_vector', []),
-        db_user_profile_model_data.get('negative_feedback_vector', []),
+        _to_vector(db_user_profile_model_data.get('explicit_feedback_vector', [])),
+        _to_vector(db_user_profile_model_data.get('positive_feedback_vector', [])),
+        _to_vector(db_user_profile_model_data.get('negative_feedback_vector', [])),
         db_user_profile_model_data['positive_feedback_sum_coeff'],
         db_user_profile_model_data['negative_feedback_sum_coeff']
     )
@@ -73,10 +88,7 @@ def _to_feature_vector(db_feature_vector):
     indexes = db_feature_vector.get('vector_indexes', [])
     values = db_feature_vector.get('vector_values', [])
     length = db_feature_vector['vector_length']
-    vector = [0] * length
-    for index, value in zip(indexes, values):
-        vector[index] = value
-    return struct.FeatureVector(vector=vector, feature_set_id=feature_set_id)
+    return struct.SparseFeatureVector(indexes, values, length, feature_set_id)
 
 
 def _to_user_computed_profile(db_user_computed_profile):
@@ -111,6 +123,10 @@ def _datastore_test_client():
     return datastore.Client(project=GCLOUD_PROJECT, credentials=credentials, http=http)
 
 
+def _new_datastore_client():
+    return _datastore_test_client() if IS_TEST_ENV else datastore.Client(GCLOUD_PROJECT)
+
+
 def _make_entity(datastore_client, entity_type, not_indexed):
     key = datastore_client.key(entity_type)
     return datastore.entity.Entity(key, exclude_from_indexes=not_indexed)
@@ -121,16 +137,91 @@ def _make_named_entity(datastore_client, entity_type, key_name, not_indexed):
     return datastore.entity.Entity(key, exclude_from_indexes=not_indexed)
 
 
+# max number of keys by get_multi request and of entities by put_multi request accepted by datastore
+_MAX_GET_MULTI_SIZE = 1000
+_MAX_PUT_MULTI_SIZE = 500
+
+
+class _RequestPool(object):
+    """
+    Thread pool shared by the process to send concurrently the chunks of a datastore request, created at first use.
+    A datastore client is not thread safe (its http connection is not), so each thread of the pool sends its requests
+    with its own client, created by client_factory at its first request.
+    """
+    nb_threads = 8
+    client_factory = staticmethod(_new_datastore_client)
+    _pool = None
+    _lock = threading.Lock()
+    _thread_data = threading.local()
+
+    @classmethod
+    def map(cls, datastore_client, request, chunks):
+        """
+        :param datastore_client: client of the calling thread, used if there is a single chunk
+        :param request: function(datastore_client, chunk) sending the request of a chunk
+        :return: list of request(client, chunk) for each chunk, in the order of chunks
+        """
+        if len(chunks) <= 1:  # no need to switch thread
+            return [request(datastore_client, chunk) for chunk in chunks]
+        with cls._lock:
+            if cls._pool is None:
+                cls._pool = ThreadPool(cls.nb_threads)
+        return cls._pool.map(functools.partial(cls._request_with_thread_client, request), chunks)
+
+    @classmethod
+    def _request_with_thread_client(cls, request, chunk):
+        thread_data = cls._thread_data
+        if getattr(thread_data, 'client_factory', None) is not cls.client_factory:
+            # client is created at the first request of the thread, or again if the factory has been replaced (by tests)
+            thread_data.client_factory = cls.client_factory
+            thread_data.datastore_client = cls.client_factory()
+        return request(thread_data.datastore_client, chunk)
+
+
+def _split(elements, chunk_size):
+    return [elements[index:index + chunk_size] for index in range(0, len(elements), chunk_size)]
+
+
+def _fetch_by_page(query, page_size):
+    """
+    :param query: gcloud.datastore.query.Query
+    :return: generator of lists of at most page_size entities, each page is requested with the cursor of the previous one
+    """
+    cursor = None
+    while True:
+        iterator = query.fetch(limit=page_size, start_cursor=cursor)
+        page = list(iterator)
+        if page:
+            yield page
+        cursor = iterator.next_page_token
+        if len(page) < page_size or cursor is None:
+            return
+
+
 def _get_multi(datastore_client, keys):
     """
-    Wrapper around get_multi datastore function that ensure matching of indexes between keys and retrieved entities.
+    Wrapper around get_multi datastore function that:
+    -splits keys in chunks of the max size accepted by datastore, requested concurrently
+    -ensures matching of indexes between keys and retrieved entities.
     It seems to works natively at least with test gcloud server but it's not clearly specified.
     :param keys: list of gcloud.datastore.entity.key
-    :return: list of gcloud.datastore.entity
+    :return: list of gcloud.datastore.entity matching keys, None for a key without entity in database
     """
-    entities = datastore_client.get_multi(keys)
-    key_to_entity = dict((entity.key, entity) for entity in entities)
-    return [key_to_entity[key] for key in keys]
+    key_to_entity = {}
+    for entities in _RequestPool.map(
+            datastore_client, lambda client, chunk: client.get_multi(chunk), _split(keys, _MAX_GET_MULTI_SIZE)):
+        key_to_entity.update((entity.key, entity) for entity in entities)
+    return [key_to_entity.get(key) for key in keys]
+
+
+def _put_multi(datastore_client, entities):
+    """
+    Wrapper around put_multi datastore function that splits entities in chunks of the max size accepted by datastore,
+    saved concurrently. NB: chunks are not saved in a single transaction.
+    :param entities: list of gcloud.datastore.entity
+    """
+    _RequestPool.map(datastore_client, lambda client, chunk: client.put_multi(chunk),
+                     _split(entities, _MAX_PUT_MULTI_SIZE))
 
 
 # Dal userDocMatching
@@ -156,6 +247,7 @@ class DalFeatureSet(object):
     def __init__(self, datastore_client):
         self._ds_client = datastore_client
         self._ref_feature_set_id = u"ref_feature_set_id"
+        self._model_migration = u"model_migration"
 
     def get_ref_feature_set_id(self):
         key = self._ds_client.key(u'ConfigKey', self._ref_feature_set_id)
@@ -168,6 +260,27 @@ class DalFeatureSet(object):
         entity['value'] = new_ref_feature_set_id
         self._ds_client.put(entity)
 
+    def get_model_migration(self):
+        """
+        :return: struct.ModelMigration of the last model migration, None if there has never been one
+        """
+        key = self._ds_client.key(u'ConfigKey', self._model_migration)
+        db_model_migration = self._ds_client.get(key)
+        if db_model_migration is None:
+            return None
+        return struct.ModelMigration(db_model_migration['target_feature_set_id'], db_model_migration['last_user_id'],
+                                     db_model_migration['is_done'])
+
+    def save_model_migration(self, model_migration):
+        """
+        :param model_migration: struct.ModelMigration, checkpoint of the migration in progress
+        """
+        entity = _make_named_entity(self._ds_client, u'ConfigKey', self._model_migration, [])
+        entity['target_feature_set_id'] = model_migration.target_feature_set_id
+        entity['last_user_id'] = model_migration.last_user_id
+        entity['is_done'] = model_migration.is_done
+        self._ds_client.put(entity)
+
     def get_feature_set(self, feature_set_id):
         """
         :param feature_set_id: string
@@ -198,15 +311,38 @@ class DalFeatureVector(object):
     def _to_db_feature_vector(self, feature_vector):
         db_feature_vector = _make_entity(self._ds_client, u'FeatureVector', not_indexed=('vector',))
         db_feature_vector['feature_set_key'] = self._ds_client.key(u'FeatureSet', feature_vector.feature_set_id)
-        non_zero_entries = [(ind, elt) for ind, elt in enumerate(feature_vector.vector) if elt != 0]
-        db_feature_vector['vector_indexes'] = [ind for ind, _ in non_zero_entries]
-        db_feature_vector['vector_values'] = [elt for _, elt in non_zero_entries]
-        db_feature_vector['vector_length'] = len(feature_vector.vector)
+        if isinstance(feature_vector, struct.SparseFeatureVector):
+            db_feature_vector['vector_indexes'] = feature_vector.indexes.tolist()
+            db_feature_vector['vector_values'] = feature_vector.values.tolist()
+            db_feature_vector['vector_length'] = feature_vector.length
+        else:
+            non_zero_indexes = np.flatnonzero(feature_vector.vector)
+            db_feature_vector['vector_indexes'] = non_zero_indexes.tolist()
+            db_feature_vector['vector_values'] = feature_vector.vector[non_zero_indexes].tolist()
+            db_feature_vector['vector_length'] = len(feature_vector.vector)
         return db_feature_vector
 
 
+def _doc_weight(doc):
+    """
+    :return: approximate memory size in bytes of a struct.Document
+    """
+    texts_size = sum(len(text) for text in (doc.url, doc.url_hash, doc.title, doc.summary) if text is not None)
+    feature_vector = doc.feature_vector
+    if isinstance(feature_vector, struct.SparseFeatureVector):
+        vector_size = feature_vector.indexes.nbytes + feature_vector.values.nbytes
+    else:
+        vector_size = feature_vector.vector.nbytes
+    return 1000 + 4 * texts_size + vector_size  # 1000 is the overhead of python objects, unicode is 4 bytes by char
+
+
 class DalDoc(object):
 
+    # Documents are not modified once saved (but by model conversion, that saves them again), so they are cached by
+    # url_hash for the whole process, shared by all Dal instances. Docs are written-through by save_documents and
+    # the TTL bounds how long a doc converted by another process can be seen with its previous feature vector.
+    _docs_cache = LruTtlCache(max_size=200 * 2 ** 20, ttl_seconds=3600, weigher=_doc_weight)
+
     def __init__(self, datastore_client, dal_feature_vector):
         self._ds_client = datastore_client
         self._dal_feature_vector = dal_feature_vector
@@ -217,10 +353,13 @@ class DalDoc(object):
         """
         docs_with_order = [doc for doc in documents]
         db_docs = [self._to_db_doc(doc) for doc in docs_with_order]
-        self._ds_client.put_multi(db_docs)
+        _put_multi(self._ds_client, db_docs)
         db_doc_keys = [db_doc.key for db_doc in db_docs]
         for (doc, key) in zip(docs_with_order, db_doc_keys):
             doc._db_key = key  # pylint: disable=protected-access
+        for db_doc in db_docs:
+            # cached doc is decoded from the saved entity, so it is the same as a doc read from database
+            self._docs_cache.put(db_doc.key.name, _to_doc(db_doc))
 
     def _to_db_doc(self, doc):
         not_indexed = ('title', 'summary', 'feature_vector')
@@ -230,30 +369,41 @@ class DalDoc(object):
         db_doc['summary'] = doc.summary
         db_doc['feature_vector'] = self._dal_feature_vector._to_db_feature_vector(  # pylint: disable=protected-access
             doc.feature_vector)
-        db_doc['datetime'] = doc.datetime or datetime.datetime.utcnow()
+        db_doc['datetime'] = doc.datetime or utcnow()  # timezone aware, like datetimes read from datastore
         return db_doc
 
     def get_doc(self, url_hash):
         """
         :param url_hash: string corresponding to the field 'url_hash' of a struct.Document
-        :return: struct.Document
+        :return: struct.Document, None if there is no doc for url_hash in database
         """
         return self.get_docs([url_hash])[0]
 
     def get_docs(self, url_hashes):
         """
         :param url_hashes: list of string corresponding to the field 'url_hash' of a struct.Document
-        :return: list of struct.Document matching url_hashes list
-        """
-        LOGGER.debug('get docs nb_docs[%s]', len(url_hashes))
-        db_keys = [self._ds_client.key('Document', url_hash) for url_hash in url_hashes]
-        db_docs = _get_multi(self._ds_client, db_keys)
-        return [_to_doc(db_doc) for db_doc in db_docs]
+        :return: list of struct.Document matching url_hashes list, None for a url_hash without doc in database
+        """
+        docs = [self._docs_cache.get(url_hash) for url_hash in url_hashes]
+        missing_hashes = list(set(url_hash for url_hash, doc in zip(url_hashes, docs) if doc is None))
+        LOGGER.debug('get docs nb_docs[%s], nb_docs_not_cached[%s], cache hits[%s] misses[%s]',
+                     len(url_hashes), len(missing_hashes), self._docs_cache.hits, self._docs_cache.misses)
+        if missing_hashes:
+            db_keys = [self._ds_client.key('Document', url_hash) for url_hash in missing_hashes]
+            db_docs = _get_multi(self._ds_client, db_keys)
+            hash_to_doc = {}
+            for db_doc in db_docs:
+                if db_doc is not None:
+                    doc = _to_doc(db_doc)
+                    self._docs_cache.put(doc.url_hash, doc)
+                    hash_to_doc[doc.url_hash] = doc
+            docs = [doc if doc is not None else hash_to_doc.get(url_hash) for url_hash, doc in zip(url_hashes, docs)]
+        return docs
 
     def get_recent_doc_url_hashes(self, from_datetime, max_nb_docs=None):
         """
         :param from_datetime: datetime
-        :param max_nb_docs: int, set 1000 if you want to use get_multi on result
+        :param max_nb_docs: int
         :return: list of hashes of max_nb_docs most recent docs whose datetime is after from_datetime
         """
         # nb: query is ordered as a way to ensure we get the max_nb_docs most recent
@@ -288,12 +438,37 @@ class DalUserActionOnDoc(object):
 
     def save_user_action_on_doc(self, user_id, doc_url_hash, action_on_doc):
         """
+        Save the action and flag the user as dirty (user with actions not taken in account yet by its profile)
         :param user_id
         :param document: frontendstructs.Document
         :param action_on_doc: frontendstructs.UserActionTypeOnDoc
         """
         db_action = self._to_db_user_action_on_doc(user_id, doc_url_hash, action_on_doc)
-        self._ds_client.put(db_action)
+        db_dirty_user = _make_named_entity(self._ds_client, u'DirtyUser', user_id, not_indexed=())
+        db_dirty_user['datetime'] = db_action['datetime']
+        self._ds_client.put_multi([db_action, db_dirty_user])
+
+    def get_dirty_user_ids(self):
+        """
+        :return: list of user_id of users with actions saved since their flag has been cleared
+        """
+        query = self._ds_client.query(kind=u'DirtyUser')
+        query.keys_only()
+        return [entity.key.name for entity in query.fetch()]
+
+    def clear_dirty_users(self, user_ids, until_datetime):
+        """
+        Remove dirty flag of users, only if their last action is before until_datetime: a user with an action saved
+        during its profile update stays dirty.
+        :param user_ids: list of frontendstructs.User.user_id
+        :param until_datetime: timezone aware datetime until which actions of the users have been taken in account
+        """
+        keys = [self._ds_client.key(u'DirtyUser', user_id) for user_id in user_ids]
+        db_dirty_users = _get_multi(self._ds_client, keys)
+        keys_to_delete = [db_dirty_user.key for db_dirty_user in db_dirty_users
+                          if db_dirty_user is not None and db_dirty_user['datetime'] <= until_datetime]
+        _RequestPool.map(self._ds_client, lambda client, chunk: client.delete_multi(chunk),
+                         _split(keys_to_delete, _MAX_PUT_MULTI_SIZE))
 
     def _to_db_user_action_on_doc(self, user_id, doc_url_hash, action_on_doc):
         db_action = _make_entity(self._ds_client, 'UserActionOnDoc', not_indexed=())
@@ -314,12 +489,8 @@ class DalUserActionOnDoc(object):
         actions_query = self._ds_client.query(kind='UserActionOnDoc')
         actions_query.add_filter('datetime', '>', from_datetime)
         db_actions = list(actions_query.fetch())
-        # NB: we only filter on datetime (and not the users) on the query because you can't mix
-        # an 'IN something' query with other filter in datastore.
-        # Moreover, request with filter 'IN users' is limited to 30 elements and is very inefficient
-        # a long term solution if we need scalability is to replace users list by a range (min_user, max_user).
-        # fetch(10000) is not scalable either, but I won't make something complex because I think
-        # this second point would be solved if the first one (filter on user range) is solved
+        # NB: all the actions after from_datetime are read, whatever their user: profile updates use
+        # get_actions_by_users, which queries only the actions of the users, by pages
 
         # 2) retrieve docs present in actions from database
         doc_url_hashes = list(set(action['document_url_hash'] for action in db_actions))
@@ -333,12 +504,54 @@ class DalUserActionOnDoc(object):
             zip(user_ids, range(len(user_ids))))  # pylint: disable=protected-access
         for db_action in db_actions:
             doc = doc_hash_to_doc[db_action['document_url_hash']]
+            if doc is None:  # doc removed from database
+                continue
             action = _to_user_action_on_doc(doc, db_action)
             user_index = user_id_to_index.get(db_action['user_id'])
             if user_index is not None:  # because we did not filter query on users
                 actions_by_user[user_index].append(action)
         return actions_by_user
 
+    def get_actions_by_users(self, user_ids, from_datetimes, until_datetime, nb_users_by_partition=200,
+                             nb_users_by_request=25, page_size=500):
+        """
+        Actions are queried user by user, filtered on their datetime by datastore (composite index on user_id and
+        datetime, cf. server/index.yaml), so only the new actions are read and not the whole history of the users.
+        Each query is read by pages of page_size actions with the cursor of the previous page, and the actions are
+        yielded by partition of users, so memory is bounded by the actions of a partition and not of all users.
+        Queries of a partition are sent concurrently by chunks of nb_users_by_request users.
+        :param user_ids: list of frontendstructs.User.user_id
+        :param from_datetimes: list matching user_ids, the actions of a user are retrieved after this datetime
+        :param until_datetime: actions are retrieved until this datetime (included), so an action saved during a profile
+        update computed until this datetime is only retrieved by the next update
+        :return: generator of lists, one by partition of nb_users_by_partition consecutive users of user_ids, in the
+        order of user_ids. Each list matches the users of its partition, each element is the list of
+        frontendstructs.UserActionOnDoc of the user
+        """
+        def query_actions(datastore_client, user_id_to_from_datetime_chunk):
+            db_actions_by_user = []
+            for user_id, from_datetime in user_id_to_from_datetime_chunk:
+                query = datastore_client.query(kind='UserActionOnDoc')
+                query.add_filter('user_id', '=', user_id)
+                query.add_filter('datetime', '>', from_datetime)
+                query.add_filter('datetime', '<=', until_datetime)
+                db_actions_by_user.append([db_action for page in _fetch_by_page(query, page_size) for db_action in page])
+            return db_actions_by_user
+
+        for partition in _split(zip(user_ids, from_datetimes), nb_users_by_partition):
+            db_actions_by_user = [
+                db_actions
+                for chunk_db_actions_by_user in _RequestPool.map(
+                    self._ds_client, query_actions, _split(partition, nb_users_by_request))
+                for db_actions in chunk_db_actions_by_user]
+            doc_url_hashes = list(set(
+                db_action['document_url_hash'] for db_actions in db_actions_by_user for db_action in db_actions))
+            doc_hash_to_doc = dict(zip(doc_url_hashes, self._dal_doc.get_docs(doc_url_hashes)))
+            yield [[_to_user_action_on_doc(doc_hash_to_doc[db_action['document_url_hash']], db_action)
+                    for db_action in db_actions
+                    if doc_hash_to_doc[db_action['document_url_hash']] is not None]  # doc removed from database
+                   for db_actions in db_actions_by_user]
+
 
 class DalUserComputedProfile(object):
 
@@ -350,9 +563,12 @@ class DalUserComputedProfile(object):
         not_indexed = ('explicit_feedback_vector', 'positive_feedback_vector', 'negative_feedback_vector',
                        'positive_feedback_sum_coeff', 'negative_feedback_sum_coeff')
         db_user_profile_model_data = _make_entity(self._ds_client, u'UserProfileModelData', not_indexed)
-        db_user_profile_model_data['explicit_feedback_vector'] = user_profile_model_data.explicit_feedback_vector
-        db_user_profile_model_data['positive_feedback_vector'] = user_profile_model_data.positive_feedback_vector
-        db_user_profile_model_data['negative_feedback_vector'] = user_profile_model_data.negative_feedback_vector
+        db_user_profile_model_data['explicit_feedback_vector'] = _to_db_vector(
+            user_profile_model_data.explicit_feedback_vector)
+        db_user_profile_model_data['positive_feedback_vector'] = _to_db_vector(
+            user_profile_model_data.positive_feedback_vector)
+        db_user_profile_model_data['negative_feedback_vector'] = _to_db_vector(
+            user_profile_model_data.negative_feedback_vector)
         db_user_profile_model_data['positive_feedback_sum_coeff'] = user_profile_model_data.positive_feedback_sum_coeff
         db_user_profile_model_data['negative_feedback_sum_coeff'] = user_profile_model_data.negative_feedback_sum_coeff
 
@@ -381,16 +597,17 @@ class DalUserComputedProfile(object):
             # by setting as key the key previously referenced by the user, we will overwrite the previous profile in db
             db_profile.key = user._user_computed_profile_db_key  # pylint: disable=protected-access
             db_profiles.append(db_profile)
-        self._ds_client.put_multi(db_profiles)
+        _put_multi(self._ds_client, db_profiles)
 
     def get_user_computed_profiles(self, users):
         """
         :param users: list of Struct.User
-        :return: list of struct.UserComputedProfile matching 'users' list
+        :return: list of struct.UserComputedProfile matching 'users' list, None for a user without profile in database
         """
         keys = [user._user_computed_profile_db_key for user in users]  # pylint: disable=protected-access
         db_profiles = _get_multi(self._ds_client, keys)
-        profiles = [_to_user_computed_profile(db_profile) for db_profile in db_profiles]
+        profiles = [_to_user_computed_profile(db_profile) if db_profile is not None else None
+                    for db_profile in db_profiles]
         return profiles
 
     def get_user_feature_vector(self, user):
@@ -403,11 +620,11 @@ class DalUserComputedProfile(object):
     def get_users_feature_vectors(self, users):
         """
         :param users: list of struct.User
-        :return: list of struct.FeatureVector matching 'users' list
+        :return: list of struct.FeatureVector matching 'users' list, None for a user without profile in database
         """
         # NB: this could be probably optimized by projection query if we need, but it would require to index vector property.
         profiles = self.get_user_computed_profiles(users)
-        return [profile.feature_vector for profile in profiles]
+        return [profile.feature_vector if profile is not None else None for profile in profiles]
 
 
 class DalUserDoc(object):
@@ -415,6 +632,21 @@ class DalUserDoc(object):
     def __init__(self, datastore_client, dal_doc):
         self._ds_client = datastore_client
         self._dal_doc = dal_doc
+        self._user_docs_generation = u"user_docs_generation"
+
+    def get_user_docs_generation(self):
+        """
+        :return: value changed each time the user docs of all users are saved by save_users_docs (None if they have never
+        been saved), so a client caching user docs can detect they are outdated with a single lookup
+        """
+        key = self._ds_client.key(u'ConfigKey', self._user_docs_generation)
+        db_generation = self._ds_client.get(key)
+        return db_generation['value'] if db_generation is not None else None
+
+    def _new_user_docs_generation(self):
+        entity = _make_named_entity(self._ds_client, u'ConfigKey', self._user_docs_generation, [])
+        entity['value'] = datetime.datetime.utcnow()
+        self._ds_client.put(entity)
 
     def _to_user_docs(self, db_user_doc_set):
         if 'user_documents' not in db_user_doc_set:  # cannot save an empty list in datastore: field would be removed
@@ -422,7 +654,8 @@ class DalUserDoc(object):
         db_user_docs = db_user_doc_set['user_documents']
         doc_url_hashes = [user_doc['document_url_hash'] for user_doc in db_user_docs]
         docs = self._dal_doc.get_docs(doc_url_hashes)
-        user_docs = [_to_user_doc(doc, db_user_doc) for doc, db_user_doc in zip(docs, db_user_docs)]
+        # docs removed from database are skipped
+        user_docs = [_to_user_doc(doc, db_user_doc) for doc, db_user_doc in zip(docs, db_user_docs) if doc is not None]
         return user_docs
 
     def save_user_docs(self, user, user_docs):
@@ -436,6 +669,8 @@ class DalUserDoc(object):
         db_user_docs = self._to_db_user_docs(user_docs)
         db_user_doc_set['user_documents'] = db_user_docs
         self._ds_client.put(db_user_doc_set)
+        # generation is not changed: it's a single entity (about 1 write/s), and it would clear the docs cached for all
+        # users at each new user. A client saving the docs of a single user must invalidate them in its own cache
 
     def _to_db_user_docs(self, user_docs):
         db_user_docs = [self._to_db_user_doc(user_doc) for user_doc in user_docs]
@@ -458,9 +693,13 @@ class DalUserDoc(object):
             user_set_db_keys.append(user._user_doc_set_db_key)  # pylint: disable=protected-access
             users_docs.append(user_docs)
         db_user_sets = _get_multi(self._ds_client, user_set_db_keys)
-        for (db_user_set, user_docs) in zip(db_user_sets, users_docs):
+        for index, (db_user_set, user_docs) in enumerate(zip(db_user_sets, users_docs)):
+            if db_user_set is None:  # re-create a user doc set missing in database
+                db_user_set = datastore.entity.Entity(user_set_db_keys[index], exclude_from_indexes=('user_documents',))
+                db_user_sets[index] = db_user_set
             db_user_set['user_documents'] = self._to_db_user_docs(user_docs)
-        self._ds_client.put_multi(db_user_sets)
+        _put_multi(self._ds_client, db_user_sets)
+        self._new_user_docs_generation()
 
     def get_user_docs(self, user):
         """
@@ -475,14 +714,15 @@ class DalUserDoc(object):
         :param users: list of struct.User
         :return: list matching 'users' list, each list being a list of struct.UserDocument
         """
-        def to_user_doc(db_user_doc):
-            return _to_user_doc(hashes_to_docs[db_user_doc['document_url_hash']], db_user_doc)
-
         def db_set_to_user_doc_list(db_user_doc_set):
-            db_user_docs = db_docs(db_user_doc_set)
-            return [to_user_doc(db_user_doc) for db_user_doc in db_user_docs]
+            # docs removed from database are skipped
+            return [_to_user_doc(hashes_to_docs[db_user_doc['document_url_hash']], db_user_doc)
+                    for db_user_doc in db_docs(db_user_doc_set)
+                    if hashes_to_docs[db_user_doc['document_url_hash']] is not None]
 
         def db_docs(db_user_doc_set):
+            if db_user_doc_set is None:  # user doc set missing in database
+                return []
             return db_user_doc_set.get('user_documents', [])
 
         user_doc_set_db_keys = [user._user_doc_set_db_key for user in users]  # pylint: disable=protected-access
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import numpy as np
 
 
 class Document(object):
@@ -61,17 +62,62 @@ class FeatureSet(object):
         self.model_id = model_id
 
 
+class ModelMigration(object):
+    """
+    Progress of the conversion of profiles and docs to the feature set of a new topic model
+    """
+
+    def __init__(self, target_feature_set_id, last_user_id, is_done):
+        """
+        :param target_feature_set_id: unicode, feature set of the new topic model
+        :param last_user_id: unicode, users are migrated by increasing user_id, profile and docs of users with
+        user_id <= last_user_id are migrated. None if no user has been migrated.
+        :param is_done: bool, True when profiles and docs of all users are migrated
+        """
+        self.target_feature_set_id = target_feature_set_id
+        self.last_user_id = last_user_id
+        self.is_done = is_done
+
+
 class FeatureVector(object):
 
     def __init__(self, vector, feature_set_id):
         """
-        :param vector: list of float
+        :param vector: array-like of float, stored as a float64 numpy.ndarray (not copied if it is already one)
         :param feature_set_id: unicode
         """
-        self.vector = vector
+        self.vector = np.asarray(vector, dtype=np.float64)
         self.feature_set_id = feature_set_id
 
 
+class SparseFeatureVector(object):
+    """
+    FeatureVector stored as its non-zero entries only, as in the database. Topic classifications have few non zero
+    elements, so it is the representation to use for big collections of documents.
+    """
+
+    def __init__(self, indexes, values, length, feature_set_id):
+        """
+        :param indexes: array-like of int, indexes of the non-zero entries of the vector
+        :param values: array-like of float, values of the non-zero entries of the vector, same size as indexes
+        :param length: int, size of the dense vector
+        :param feature_set_id: unicode
+        """
+        self.indexes = np.asarray(indexes, dtype=np.intp)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.length = length
+        self.feature_set_id = feature_set_id
+
+    @property
+    def vector(self):
+        """
+        :return: dense float64 numpy.ndarray of size length, built at each call
+        """
+        vector = np.zeros(self.length)
+        vector[self.indexes] = self.values
+        return vector
+
+
 class UserActionTypeOnDoc(object):
     # NB: when we manage dependencies in server, we can reference enum34 and make this class an enum
     up_vote = 1
@@ -115,9 +161,9 @@ class UserProfileModelData(object):
                  positive_feedback_vector, negative_feedback_vector,
                  positive_feedback_sum_coeff, negative_feedback_sum_coeff):
         """
-        :param explicit_feedback_vector: list, the vector associated to interests of the user
-        :param positive_feedback_vector: list, the vector associated to positive actions of the user
-        :param negative_feedback_vector: list, the vector associated to negative actions of the user
+        :param explicit_feedback_vector: array-like, the vector associated to interests of the user
+        :param positive_feedback_vector: array-like, the vector associated to positive actions of the user
+        :param negative_feedback_vector: array-like, the vector associated to negative actions of the user
         :param positive_feedback_sum_coeff: sum of the discounted positive actions of the user
         :param negative_feedback_sum_coeff: sum of the discounted negative actions of the user
         """
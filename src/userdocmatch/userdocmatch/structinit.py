@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 import datetime
 import logging
-from common.datehelper import utcnow
-from learner.topicmodelapprox import TopicModelApproxClassifier
-from learner.userprofiler import UserProfiler
-from learner.userdocaccumulator import UserDocumentsAccumulator, UserData
+import os
+import shutil
+import tempfile
+import threading
+import time
 import nltk
+import numpy as np
+from scipy.sparse import csr_matrix
+import common.crypto as crypto
+from common.datehelper import utcnow
+from learner.topicmodelapprox import TopicModelApproxClassifier, get_approx_classifier
+from learner.userprofiler import UserProfiler, ActionsOnDocs
+from learner.nearestneighbours import BruteForceCosineIndex
 from . import frontendstructs as struct
 
 
@@ -14,69 +22,268 @@ LOGGER = logging.getLogger(__name__)
 
 class UserCreator(object):
 
-    def __init__(self):
-        self._profile_initializer = None
-        self._doc_duration = datetime.timedelta(hours=12)
+    def __init__(self, profile_initializers=None, recent_docs_indexes=None):
+        """
+        :param profile_initializers: ProfileInitializerCache, default is the cache shared by the process
+        :param recent_docs_indexes: RecentDocsIndexCache, default is the cache shared by the process
+        """
+        self._profile_initializers = profile_initializers or PROFILE_INITIALIZERS
+        self._recent_docs_indexes = recent_docs_indexes or RECENT_DOCS_INDEXES
         self._nb_user_docs = 30
 
     def create_user_in_db(self, user_id, interests, dal):
-        if self._profile_initializer is None:
-            self._profile_initializer = _get_profile_initializer(dal)
-
         user = struct.User.make_from_scratch(user_id, interests)
-        profile = self._profile_initializer.get_new_profile(interests)
-        user_docs = _get_user_docs(dal, profile.feature_vector, utcnow() - self._doc_duration, self._nb_user_docs)
+        profile = self._profile_initializers.get(dal).get_new_profile(interests)
+        user_docs = self._recent_docs_indexes.get_user_docs(dal, profile.feature_vector, self._nb_user_docs)
         dal.user.save_user(user)
         dal.user_computed_profile.save_user_computed_profiles([(user, profile)])
         dal.user_doc.save_user_docs(user, user_docs)
         return user
 
+    def warm_up(self, dal_factory):
+        self._profile_initializers.warm_up(dal_factory)
+
+
+# bump it when the files saved by TopicModelApproxClassifier.save change, so previous artifacts are not loaded
+_ARTIFACTS_FORMAT_VERSION = 1
+# prefix of the temporary directories where artifacts are being written, artifacts are named by feature set id hash
+_TMP_ARTIFACT_PREFIX = 'tmp_'
+
+
+class ProfileInitializerCache(object):
+    """
+    Cache of the _ProfileInitializer of the ref feature set.
+    A feature set and its topic model are never modified once saved (a new model has a new feature set), so the
+    feature_set_id is the version of an initializer: the cache only has to follow the ref feature set id.
+    The classifier of a feature set is also saved in artifacts_dir, so the other processes of the machine (gunicorn
+    workers) memory-map it instead of reading the topic model in database and rebuilding the classifier. Artifacts of
+    the previous ref feature sets are deleted when the ref changes.
+    """
+
+    def __init__(self, artifacts_dir=os.path.join(tempfile.gettempdir(), 'gator_model_artifacts'),
+                 ref_check_seconds=60, clock=time.time):
+        """
+        :param artifacts_dir: local directory where classifiers are saved, shared by the processes of the machine
+        :param ref_check_seconds: min duration between two checks of the ref feature set id in database
+        :param clock: function returning the current time in seconds, injected for tests
+        """
+        self._artifacts_dir = os.path.join(artifacts_dir, 'v' + str(_ARTIFACTS_FORMAT_VERSION))
+        self._ref_check_seconds = ref_check_seconds
+        self._clock = clock
+        # tuple (feature_set_id, _ProfileInitializer), replaced in a single assignment so readers need no lock
+        self._ref_initializer = None
+        self._next_ref_check_time = None
+        self._refresh_thread = None
+        self._refresh_lock = threading.Lock()
+
+    def get(self, dal):
+        """
+        :return: _ProfileInitializer of the ref feature set. If the background refresh is not started, the ref
+        feature set id is checked in database at most every ref_check_seconds.
+        """
+        ref_initializer = self._ref_initializer
+        if ref_initializer is None or (self._refresh_thread is None and self._clock() >= self._next_ref_check_time):
+            self.refresh(dal)
+            ref_initializer = self._ref_initializer
+        return ref_initializer[1]
+
+    def refresh(self, dal):
+        """
+        Read the ref feature set id in database and load its initializer if it has changed
+        """
+        with self._refresh_lock:  # an initializer is built by one thread at a time
+            ref_feature_set_id = dal.feature_set.get_ref_feature_set_id()
+            if self._ref_initializer is None or self._ref_initializer[0] != ref_feature_set_id:
+                classifier = self._load_or_build_classifier(dal, ref_feature_set_id)
+                self._ref_initializer = (ref_feature_set_id, _ProfileInitializer(ref_feature_set_id, classifier))
+                LOGGER.info(u'profile initializer loaded, feature_set_id[%s]', ref_feature_set_id)
+                _remove_other_artifacts(self._artifacts_dir, crypto.hash_str(ref_feature_set_id))
+            self._next_ref_check_time = self._clock() + self._ref_check_seconds
+
+    def warm_up(self, dal_factory):
+        """
+        Load the initializer of the ref feature set and start a daemon thread refreshing it every ref_check_seconds.
+        It's called at server start, so the first users created don't wait for the loading.
+        :param dal_factory: function returning a Dal, called in the refresh thread
+        """
+        try:
+            self.refresh(dal_factory())
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception(u'profile initializer warm up failed, it will be loaded by the background refresh')
+        if self._refresh_thread is None:
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, args=(dal_factory,))
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def _refresh_loop(self, dal_factory):
+        while True:
+            time.sleep(self._ref_check_seconds)
+            try:
+                self.refresh(dal_factory())
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception(u'profile initializer refresh failed')
+
+    def _load_or_build_classifier(self, dal, feature_set_id):
+        artifact_dir = os.path.join(self._artifacts_dir, crypto.hash_str(feature_set_id))
+        if os.path.isdir(artifact_dir):
+            LOGGER.info(u'load classifier from artifact[%s]', artifact_dir)
+            try:
+                return TopicModelApproxClassifier.load(artifact_dir)
+            except (IOError, OSError):  # artifact deleted meanwhile by a process with a newer ref, classifier is rebuilt
+                LOGGER.warning(u'classifier artifact not loaded[%s]', artifact_dir, exc_info=True)
+        feature_set = dal.feature_set.get_feature_set(feature_set_id)
+        classifier = get_approx_classifier(dal.topic_model.get(feature_set.model_id))
+        _save_classifier_artifact(classifier, artifact_dir)
+        return classifier
+
+
+def _save_classifier_artifact(classifier, artifact_dir):
+    """
+    Classifier is saved in a temporary directory renamed at the end, so a process never loads a partial artifact.
+    Artifacts are only an optimization, so errors are logged and ignored.
+    """
+    tmp_dir = None
+    try:
+        parent_dir = os.path.dirname(artifact_dir)
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir)
+        tmp_dir = tempfile.mkdtemp(prefix=_TMP_ARTIFACT_PREFIX, dir=parent_dir)
+        classifier.save(tmp_dir)
+        os.rename(tmp_dir, artifact_dir)
+        LOGGER.info(u'classifier artifact saved[%s]', artifact_dir)
+    except (IOError, OSError):  # OSError also if artifact has been saved meanwhile by another process
+        LOGGER.warning(u'classifier artifact not saved[%s]', artifact_dir, exc_info=True)
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-def _get_profile_initializer(dal):
-    ref_feature_set_id = dal.feature_set.get_ref_feature_set_id()
-    feature_set = dal.feature_set.get_feature_set(ref_feature_set_id)
-    model = dal.topic_model.get(feature_set.model_id)
-    return _ProfileInitializer(ref_feature_set_id, model)
+
+def _remove_other_artifacts(artifacts_dir, artifact_name):
+    """
+    Delete the artifacts other than artifact_name. Temporary directories are kept, as they may be written by other
+    processes. A process using a deleted artifact is not affected: its memory-mapped files stay readable until unmapped.
+    """
+    try:
+        names = os.listdir(artifacts_dir)
+    except OSError:  # no artifact saved
+        return
+    for name in names:
+        if name != artifact_name and not name.startswith(_TMP_ARTIFACT_PREFIX):
+            LOGGER.info(u'remove classifier artifact[%s]', name)
+            shutil.rmtree(os.path.join(artifacts_dir, name), ignore_errors=True)
+
+
+PROFILE_INITIALIZERS = ProfileInitializerCache()
 
 
 class _ProfileInitializer(object):
 
-    def __init__(self, ref_feature_set_id, model_description):
+    def __init__(self, ref_feature_set_id, classifier):
+        """
+        :param classifier: learner.topicmodelapprox.TopicModelApproxClassifier of the model of the ref feature set
+        """
         self._ref_feature_set_id = ref_feature_set_id
-        self._classifier = TopicModelApproxClassifier(model_description)
+        self._classifier = classifier
         self._profiler = UserProfiler()
-        self._nb_topics = len(model_description.topics)
+        self._nb_topics = classifier.nb_topics
 
     def get_new_profile(self, interests):
-        words = []
-        if LOGGER.isEnabledFor(logging.DEBUG):
-            LOGGER.debug('tokenize interests [%s]', '-'.join(interests))
-        for sentence in interests:
-            words_this_sentence = nltk.word_tokenize(sentence)
-            words += [word.lower()for word in words_this_sentence]
-        if LOGGER.isEnabledFor(logging.DEBUG):
-            LOGGER.debug('classify interests [%s]', '-'.join(words))
-        explicit_vector = self._classifier.compute_classified_vector(words)
-        zero_vec = [0] * self._nb_topics
-        model_data = struct.UserProfileModelData(explicit_vector, zero_vec, zero_vec, 0, 0)
+        return self.get_new_profiles([interests])[0]
+
+    def get_new_profiles(self, interests_list):
+        """
+        :param interests_list: list of interests (list of sentences) of each new user
+        :return: list of struct.UserComputedProfile matching interests_list, all classified by a single projection
+        """
+        words_list = [_tokenize_interests(interests) for interests in interests_list]
+        explicit_matrix = self._classifier.compute_classified_vectors(words_list)
+        zero_vec = np.zeros(self._nb_topics)
+        model_data_list = [struct.UserProfileModelData(explicit_vector, zero_vec, zero_vec, 0, 0)
+                           for explicit_vector in explicit_matrix]
         now = utcnow()
-        profile = self._profiler.compute_user_profile(model_data, now, [], now)
-        feature_vector = struct.FeatureVector(profile.feedback_vector, self._ref_feature_set_id)
-        user_profile = struct.UserComputedProfile(feature_vector, profile.model_data)
-        return user_profile
+        profiles = self._profiler.compute_user_profiles(
+            model_data_list, [now] * len(model_data_list),
+            ActionsOnDocs.make_from_actions([[]] * len(model_data_list), self._nb_topics), now)
+        return [struct.UserComputedProfile(struct.FeatureVector(profile.feedback_vector, self._ref_feature_set_id),
+                                           profile.model_data)
+                for profile in profiles]
+
+
+def _tokenize_interests(interests):
+    words = []
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('tokenize interests [%s]', '-'.join(interests))
+    for sentence in interests:
+        words_this_sentence = nltk.word_tokenize(sentence)
+        words += [word.lower()for word in words_this_sentence]
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('classify interests [%s]', '-'.join(words))
+    return words
+
 
+class RecentDocsIndexCache(object):
+    """
+    Index of the recent docs, shared by the user creations of the process: recent docs are read and indexed at most every
+    ttl_seconds (or when the feature set of the users changes), instead of at each user creation. The docs of a new user
+    can then be a bit older than doc_duration, or miss the docs scraped in the last ttl_seconds.
+    """
 
-def _get_user_docs(dal, user_feature_vector, min_date_docs, nb_user_docs):
-    # limit to 1000 so we can call dal.doc.get_docs (fails above 1000 in datastore)
-    LOGGER.debug('get user docs, nb_user_docs[%s] min_date_docs[%s]', nb_user_docs, min_date_docs)
-    docs = dal.doc.get_recent_docs(min_date_docs, max_nb_docs=1000)
+    def __init__(self, doc_duration=datetime.timedelta(hours=12), max_nb_docs=1000, ttl_seconds=300, clock=time.time):
+        """
+        :param doc_duration: max age of the docs of a new user
+        :param max_nb_docs: max number of most recent docs indexed
+        :param ttl_seconds: max duration between two readings of the recent docs
+        :param clock: function returning the current time in seconds, injected for tests
+        """
+        self._doc_duration = doc_duration
+        self._max_nb_docs = max_nb_docs
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        # tuple (feature_set_id, expiration time, docs, index), replaced in a single assignment so readers need no lock.
+        # Two threads can rebuild an expired index at the same time, the last one built is kept
+        self._cached_index = None
+
+    def get_user_docs(self, dal, user_feature_vector, nb_user_docs):
+        """
+        :return: list of struct.UserDocument, the nb_user_docs recent docs the most similar to user_feature_vector
+        """
+        cached_index = self._cached_index
+        feature_set_id = user_feature_vector.feature_set_id
+        if cached_index is None or cached_index[0] != feature_set_id or self._clock() >= cached_index[1]:
+            docs, doc_index = _build_recent_docs_index(dal, utcnow() - self._doc_duration, self._max_nb_docs,
+                                                       user_feature_vector)
+            cached_index = (feature_set_id, self._clock() + self._ttl_seconds, docs, doc_index)
+            self._cached_index = cached_index
+        _, _, docs, doc_index = cached_index
+        doc_indexes, grades = doc_index.query(user_feature_vector.vector, nb_user_docs)
+        # grades are numpy.float32, converted to float to be saved in datastore
+        return [struct.UserDocument(docs[index], float(grade)) for index, grade in zip(doc_indexes, grades)]
+
+
+RECENT_DOCS_INDEXES = RecentDocsIndexCache()
+
+
+def _build_recent_docs_index(dal, min_date_docs, max_nb_docs, user_feature_vector):
+    """
+    :return: tuple (list of the recent docs with the feature set of user_feature_vector, index of learner.nearestneighbours
+    of their vectors)
+    """
+    LOGGER.debug('index recent docs, min_date_docs[%s] max_nb_docs[%s]', min_date_docs, max_nb_docs)
+    docs = dal.doc.get_recent_docs(min_date_docs, max_nb_docs=max_nb_docs)
     user_feat_set_id = user_feature_vector.feature_set_id
     valid_docs = [doc for doc in docs if doc.feature_vector.feature_set_id == user_feat_set_id]
-    LOGGER.debug('accumulate docs, nb valid_docs[%s]', len(valid_docs))
-    doc_accu = UserDocumentsAccumulator([UserData(user_feature_vector.vector, [])], nb_user_docs)
-    for doc in valid_docs:
-        doc_accu.add_doc(doc, doc.feature_vector.vector)
-    lrn_docs = doc_accu.build_user_docs()[0]
-    to_user_doc = lambda lrn_doc: struct.UserDocument(lrn_doc.doc_id, lrn_doc.grade)
-    user_docs = [to_user_doc(lrn_doc) for lrn_doc in lrn_docs]
-    return user_docs
+    LOGGER.debug('recent docs indexed, nb valid_docs[%s]', len(valid_docs))
+    nb_features = len(user_feature_vector.vector)
+    # exact search: max_nb_docs recent docs are few enough to be all scored for each new user
+    return valid_docs, BruteForceCosineIndex(_to_sparse_matrix([doc.feature_vector for doc in valid_docs], nb_features))
+
+
+def _to_sparse_matrix(sparse_feature_vectors, nb_features):
+    """
+    :param sparse_feature_vectors: list of struct.SparseFeatureVector
+    :param nb_features: size of the vectors
+    :return: scipy.sparse.csr_matrix of dimension (len(sparse_feature_vectors), nb_features), one row by vector
+    """
+    indptr = np.cumsum([0] + [len(vector.indexes) for vector in sparse_feature_vectors])
+    indexes = np.concatenate([vector.indexes for vector in sparse_feature_vectors] or [np.zeros(0, dtype=np.intp)])
+    values = np.concatenate([vector.values for vector in sparse_feature_vectors] or [np.zeros(0)])
+    return csr_matrix((values, indexes, indptr), shape=(len(sparse_feature_vectors), nb_features))